@@ -8,16 +8,39 @@ from .protocol_monitor_summary import ProtMonitorSummary
 from .summary_provider import SummaryProvider
 from .protocol_monitor_ctf import ProtMonitorCTF, MonitorCTF, CTF_LOG_SQLITE
 from .protocol_monitor_system import ProtMonitorSystem
-from .protocol_monitor_movie_gain import ProtMonitorMovieGain, MonitorMovieGain
+from .protocol_monitor_movie_gain import (ProtMonitorMovieGain, MonitorMovieGain,
+                                          GAIN_LOG_SQLITE)
 from .protocol_monitor_2d_streamer import ProtMonitor2dStreamer
 from .protocol_good_classes_extractor import ProtGoodClassesExtractor
 from .protocol_volume_extractor import ProtVolumeExtractor
 
 from .report_html import ReportHtml
+from .movie_facts import MovieFacts, MOVIE_FACTS_SQLITE
+from .pipeline_funnel import PipelineFunnel, PIPELINE_FUNNEL_SQLITE
+from .rate_estimator import RateEstimator
+from .defocus_planner import DefocusPlanner, DEFOCUS_PLAN_JSON
 
 from .protocol_trackUsedItems import UsedItemsTracker
-try:
-    from .getnifs import *
-except ImportError:
-    print("System monitor functionality compromised.")
-from .pynvml import nvmlInit, NVMLError
+
+
+# names of getnifs that can be used from this package
+GETNIFS_NAMES = ('get_network_interfaces', 'NetworkInterface', 'ifap_iter',
+                 'getfamaddr')
+
+
+def __getattr__(name):
+    """ The network interface and NVML helpers load ctypes libraries,
+    so they are only imported when used. """
+    if name in ('nvmlInit', 'NVMLError'):
+        from . import pynvml
+        return getattr(pynvml, name)
+    if name not in GETNIFS_NAMES:
+        # including getnifs and pynvml, so they are imported as submodules
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name))
+    try:
+        from . import getnifs
+    except ImportError:
+        print("System monitor functionality compromised.")
+        raise AttributeError(name)
+    return getattr(getnifs, name)
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Export of the monitor databases of many sessions to a columnar dataset
+(Parquet or Arrow IPC files) partitioned by project and date:
+
+    <output>/<table>/project=<project>/date=<YYYY-MM-DD>/<session>.<format>
+
+Each run only adds the rows written since the previous export, so it can
+be called periodically. There is one file per session and date, the file
+of a date that gets new rows is rewritten with them:
+
+    python -m emfacilities.protocols.columnar_export \\
+        ~/ScipionUserData/projects --output /data/facility_stats
+"""
+
+import argparse
+import json
+import os
+import sqlite3 as lite
+import sys
+import time
+
+from pyworkflow.utils import red
+
+from .facility_dashboard import findMonitorRuns, getRunProject
+from .pipeline_funnel import PIPELINE_FUNNEL_SQLITE
+from .protocol_monitor_ctf import CTF_LOG_SQLITE
+from .protocol_monitor_movie_gain import GAIN_LOG_SQLITE
+from .protocol_monitor_system import SYSTEM_LOG_SQLITE
+from .report_data import atomicWrite, toJson
+
+try:  # optional, only needed to export
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+# --------------------- CONSTANTS -----------------------------------
+EXPORT_STATE = 'export_state.json'
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+# table -> database it is read from
+EXPORT_TABLES = {'ctf': CTF_LOG_SQLITE,
+                 'gain': GAIN_LOG_SQLITE,
+                 'system': SYSTEM_LOG_SQLITE,
+                 'latency': PIPELINE_FUNNEL_SQLITE}
+# columns of the log tables, the ones a database lacks (written by older
+# versions of the monitors) are exported as nulls
+EXPORT_COLUMNS = {'ctf': [('id', 'INTEGER'),
+                          ('timestamp', 'DATE'),
+                          ('ctfID', 'INTEGER'),
+                          ('defocusU', 'FLOAT'),
+                          ('defocusV', 'FLOAT'),
+                          ('defocus', 'FLOAT'),
+                          ('astigmatism', 'FLOAT'),
+                          ('ratio', 'FLOAT'),
+                          ('resolution', 'FLOAT'),
+                          ('fitQuality', 'FLOAT'),
+                          ('phaseShift', 'FLOAT'),
+                          ('micPath', 'STRING'),
+                          ('psdPath', 'STRING'),
+                          ('shiftPlotPath', 'STRING')],
+                  'gain': [('id', 'INTEGER'),
+                           ('movieName', 'TEXT'),
+                           ('movieId', 'INTEGER'),
+                           ('stddev', 'FLOAT'),
+                           ('perc25', 'FLOAT'),
+                           ('perc975', 'FLOAT'),
+                           ('maxVal', 'FLOAT'),
+                           ('ratio1', 'FLOAT'),
+                           ('ratio2', 'FLOAT'),
+                           ('mtime', 'FLOAT'),
+                           ('timestamp', 'FLOAT')]}
+BATCH_ROWS = 100000
+BATCH_SAMPLES = 10000
+NO_DATE = 'unknown'
+
+
+def _arrowType(declType):
+    """ Arrow type of a sqlite declared column type. """
+    declType = (declType or '').upper()
+    if 'INT' in declType:
+        return pa.int64()
+    if any(t in declType for t in ('FLOAT', 'REAL', 'DOUB')):
+        return pa.float64()
+    return pa.string()
+
+
+def _localDate(seconds):
+    if seconds is None:
+        return NO_DATE
+    return time.strftime('%Y-%m-%d', time.localtime(seconds))
+
+
+def _textDate(timestamp):
+    """ Date of a 'YYYY-MM-DD HH:MM:SS' sqlite timestamp. """
+    return timestamp[:10] if timestamp else NO_DATE
+
+
+class ColumnarExport:
+    """ Append the new rows of the monitor databases of each run to the
+    dataset in outputDir. The last id exported of each run and table is
+    kept in a state file, updated after every file written.
+    """
+    def __init__(self, outputDir, fmt='parquet', tables=None):
+        if pa is None:
+            raise ImportError("pyarrow is needed to export the monitor "
+                              "data, install it with: pip install pyarrow")
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError("Unknown export format: %s" % fmt)
+        self.outputDir = outputDir
+        self.format = fmt
+        self.tables = list(tables or EXPORT_TABLES)
+        os.makedirs(outputDir, exist_ok=True)
+        self._statePath = os.path.join(outputDir, EXPORT_STATE)
+        self.state = {}  # run folder -> {table: last id}
+        if os.path.exists(self._statePath):
+            with open(self._statePath) as f:
+                self.state = json.load(f)
+
+    def exportRoots(self, roots):
+        """ Export all the runs found under roots. Return the number of
+        rows written. """
+        dbNames = [EXPORT_TABLES[t] for t in self.tables]
+        return sum(self.exportRun(runDir)
+                   for runDir in sorted(findMonitorRuns(roots, dbNames)))
+
+    def exportRun(self, runDir):
+        runDir = os.path.abspath(runDir)
+        exporters = {'ctf': self._exportCtf,
+                     'gain': self._exportGain,
+                     'system': self._exportSystem,
+                     'latency': self._exportLatency}
+        rows = 0
+        for table in self.tables:
+            dbPath = os.path.join(runDir, EXPORT_TABLES[table])
+            if not os.path.exists(dbPath):
+                continue
+            conn = lite.connect('file:%s?mode=ro' % dbPath, uri=True)
+            try:
+                rows += exporters[table](runDir, conn.cursor())
+            except lite.Error as e:
+                print(red("%s: cannot export %s: %s" % (runDir, table, e)))
+            finally:
+                conn.close()
+        return rows
+
+    # ------------------------ state and files ------------------------
+    def _getLast(self, runDir, table):
+        return self.state.get(runDir, {}).get(table, 0)
+
+    def _setLast(self, runDir, table, value):
+        self.state.setdefault(runDir, {})[table] = value
+        atomicWrite(self._statePath, toJson(self.state))
+
+    def _getPath(self, table, runDir, date):
+        folder = os.path.join(self.outputDir, table,
+                              'project=%s' % getRunProject(runDir),
+                              'date=%s' % date)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, '%s%s' % (os.path.basename(runDir),
+                                              EXPORT_FORMATS[self.format]))
+
+    def _readTable(self, path):
+        if self.format == 'parquet':
+            return pq.ParquetFile(path).read()
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def _writeTable(self, table, path):
+        tmpPath = path + '.tmp'
+        if self.format == 'parquet':
+            pq.write_table(table, tmpPath)
+        else:
+            with pa.OSFile(tmpPath, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        os.replace(tmpPath, path)
+
+    def _writeRows(self, table, runDir, schema, rows, dateOf, append=True):
+        """ Write rows (tuples in schema order, the first column is an
+        increasing id) to the file of the session for each date.
+        :param append: keep the rows already in the files with an id
+                       lower than the new ones, otherwise replace them
+        """
+        byDate = {}
+        for row in rows:
+            byDate.setdefault(dateOf(row), []).append(row)
+        session = os.path.basename(runDir)
+        for date, dateRows in byDate.items():
+            columns = list(zip(*dateRows))
+            arrays = [pa.array(column, type=field.type)
+                      for column, field in zip(columns, schema)]
+            arrays.append(pa.array([session] * len(dateRows), pa.string()))
+            data = pa.Table.from_arrays(
+                arrays, schema=schema.append(pa.field('session', pa.string())))
+            path = self._getPath(table, runDir, date)
+            if append and os.path.exists(path):
+                # rows over the first new id were written by an export
+                # that stopped before saving its state
+                old = self._readTable(path)
+                old = old.filter(pc.less(old.column(0), dateRows[0][0]))
+                data = pa.concat_tables([old, data])
+            self._writeTable(data, path)
+
+    # ------------------------ tables ---------------------------------
+    def _exportLog(self, table, runDir, cur, dateColumn, dateOf):
+        """ Append the rows of the log table with an id over the last
+        one exported. """
+        cur.execute("PRAGMA table_info(log)")
+        existing = {row[1] for row in cur.fetchall()}
+        if dateColumn not in existing:
+            print(red("%s: cannot export %s, its log has no %s column, "
+                      "open the project with the monitor to update it"
+                      % (runDir, table, dateColumn)))
+            return 0
+        columns = EXPORT_COLUMNS[table]
+        schema = pa.schema([(name, _arrowType(declType))
+                            for name, declType in columns])
+        dateIndex = schema.get_field_index(dateColumn)
+        cur.execute("SELECT %s FROM log WHERE id > ? ORDER BY id"
+                    % ', '.join(name if name in existing else 'NULL'
+                                for name, _ in columns),
+                    (self._getLast(runDir, table),))
+        count = 0
+        while True:
+            rows = cur.fetchmany(BATCH_ROWS)
+            if not rows:
+                return count
+            self._writeRows(table, runDir, schema, rows,
+                            lambda r: dateOf(r[dateIndex]))
+            self._setLast(runDir, table, rows[-1][0])
+            count += len(rows)
+
+    def _exportCtf(self, runDir, cur):
+        # local time written by the ctf monitor
+        return self._exportLog('ctf', runDir, cur, 'timestamp', _textDate)
+
+    def _exportGain(self, runDir, cur):
+        # seconds since the epoch when the movie was processed
+        return self._exportLog('gain', runDir, cur, 'timestamp', _localDate)
+
+    def _exportSystem(self, runDir, cur):
+        """ One row per sample and metric, with UTC timestamps. """
+        schema = pa.schema([('sampleId', pa.int64()),
+                            ('timestamp', pa.string()),
+                            ('host', pa.string()),
+                            ('name', pa.string()),
+                            ('value', pa.float64())])
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM log")
+        maxId = cur.fetchone()[0]
+        lastId = self._getLast(runDir, 'system')
+        count = 0
+        # whole samples per batch, so the cursor is always exact
+        for firstId in range(lastId + 1, maxId + 1, BATCH_SAMPLES):
+            endId = min(firstId + BATCH_SAMPLES - 1, maxId)
+            cur.execute("SELECT l.id, l.timestamp, m.host, m.name, v.value "
+                        "FROM log_value v "
+                        "JOIN log l ON l.id = v.sampleId "
+                        "JOIN log_metric m ON m.id = v.metricId "
+                        "WHERE v.sampleId BETWEEN ? AND ? "
+                        "ORDER BY v.sampleId, v.metricId", (firstId, endId))
+            rows = cur.fetchall()
+            if rows:
+                self._writeRows('system', runDir, schema, rows,
+                                lambda r: _textDate(r[1]))
+            self._setLast(runDir, 'system', endId)
+            count += len(rows)
+        return count
+
+    def _exportLatency(self, runDir, cur):
+        """ Time each micrograph reached each stage and its latency since
+        it was first seen. The funnel has no row order to follow, so the
+        file of a session is rewritten when its database changes. """
+        dbPath = os.path.join(runDir, PIPELINE_FUNNEL_SQLITE)
+        mtime = os.stat(dbPath).st_mtime_ns
+        if mtime == self._getLast(runDir, 'latency'):
+            return 0
+        schema = pa.schema([('micId', pa.int64()),
+                            ('protId', pa.int64()),
+                            ('outputName', pa.string()),
+                            ('label', pa.string()),
+                            ('time', pa.float64()),
+                            ('latency', pa.float64())])
+        cur.execute("SELECT f.micId, s.protId, s.outputName, s.label, "
+                    "f.time, f.time - m.first "
+                    "FROM seen f JOIN stage s ON s.stageId = f.stageId "
+                    "JOIN (SELECT micId, MIN(time) AS first FROM seen "
+                    "      GROUP BY micId) m ON m.micId = f.micId "
+                    "ORDER BY f.micId, f.time")
+        rows = cur.fetchall()
+        if rows:
+            # the whole session in the partition of its first micrograph
+            date = _localDate(min(r[4] for r in rows))
+            self._writeRows('latency', runDir, schema, rows,
+                            lambda r: date, append=False)
+        self._setLast(runDir, 'latency', mtime)
+        return len(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export the monitor databases of several Scipion "
+                    "projects to Parquet or Arrow files, partitioned by "
+                    "project and date. Only new rows are exported.")
+    parser.add_argument('roots', nargs='+',
+                        help="project folders, or folders with projects")
+    parser.add_argument('--output', required=True,
+                        help="folder of the dataset")
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS),
+                        default='parquet')
+    parser.add_argument('--tables', nargs='+', choices=sorted(EXPORT_TABLES),
+                        default=sorted(EXPORT_TABLES))
+    args = parser.parse_args(argv)
+
+    try:
+        exporter = ColumnarExport(args.output, args.format, args.tables)
+    except ImportError as e:
+        print(red(str(e)))
+        return 1
+    rows = exporter.exportRoots(args.roots)
+    print("%d rows exported to %s" % (rows, args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Defocus histograms updated with the new CTF values only, and a planner
+that compares the achieved defocus with a target range to recommend the
+next defocus values to acquire.
+"""
+
+import time
+
+import numpy as np
+
+# --------------------- CONSTANTS -----------------------------------
+DEFOCUS_PLAN_JSON = 'defocus_plan.json'
+RECENT_MICS = 50
+# bins with less than this fraction of the mean count are under covered
+UNDER_COVERED_FRACTION = 0.5
+
+
+class DefocusHistogram:
+    """ Counts of defocus values (A) by bin, including the values below
+    the first edge and above the last one, and the counts of the latest
+    values added.
+    """
+    def __init__(self, edges, recent=RECENT_MICS):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        # below, one per bin, above
+        self._counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self._recentCounts = np.zeros_like(self._counts)
+        self._recent = np.empty(0, dtype=np.int64)  # slot of the latest
+        self.recentSize = recent
+
+    @property
+    def total(self):
+        return int(self._counts.sum())
+
+    def _getSlots(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        slots = np.searchsorted(self.edges, values, side='right')
+        # the last bin includes its upper edge, as in np.histogram
+        slots[values == self.edges[-1]] = len(self.edges) - 1
+        return slots
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        slots = self._getSlots(values)
+        self._counts += np.bincount(slots, minlength=len(self._counts))
+        recent = np.concatenate([self._recent, slots[-self.recentSize:]])
+        dropped = recent[:-self.recentSize]
+        self._recent = recent[-self.recentSize:]
+        self._recentCounts += np.bincount(slots[-self.recentSize:],
+                                          minlength=len(self._counts))
+        self._recentCounts -= np.bincount(dropped,
+                                          minlength=len(self._counts))
+
+    def getCounts(self, recent=False):
+        """ Return (below, counts by bin, above). """
+        counts = self._recentCounts if recent else self._counts
+        return int(counts[0]), counts[1:-1].copy(), int(counts[-1])
+
+
+def getReportEdges(minDefocus, maxDefocus, step):
+    """ Edges of the defocus histogram of the report: multiples of step
+    from minDefocus to maxDefocus. """
+    edges = np.arange(0, maxDefocus + step, step)
+    return np.insert(edges[edges > minDefocus], 0, minDefocus)
+
+
+class DefocusPlanner:
+    """ Compare the defocus achieved with an even coverage of the target
+    range, in bins of the given step (A), and recommend the defocus of the
+    next exposures.
+    """
+    def __init__(self, minDefocus, maxDefocus, step, numTargets=5):
+        if maxDefocus <= minDefocus or step <= 0:
+            raise ValueError("Wrong defocus target range: %s-%s, step %s"
+                             % (minDefocus, maxDefocus, step))
+        edges = np.arange(minDefocus, maxDefocus, step)
+        self.histogram = DefocusHistogram(np.append(edges, maxDefocus))
+        self.numTargets = numTargets
+
+    def add(self, values):
+        self.histogram.add(values)
+
+    def getNextTargets(self):
+        """ Centers of the least covered bins, counting each recommended
+        exposure in its bin, most needed first. """
+        _, counts, _ = self.histogram.getCounts()
+        edges = self.histogram.edges
+        centers = (edges[:-1] + edges[1:]) / 2
+        planned = counts.astype(np.float64)
+        targets = []
+        for _ in range(self.numTargets):
+            i = int(np.argmin(planned))
+            targets.append(float(centers[i]))
+            planned[i] += 1
+        return targets
+
+    def getPlan(self, now=None):
+        below, counts, above = self.histogram.getCounts()
+        edges = self.histogram.edges
+        inRange = int(counts.sum())
+        # each bin should have the same share of the micrographs
+        expected = (inRange + self.numTargets) / float(len(counts))
+        minCount = UNDER_COVERED_FRACTION * inRange / len(counts)
+        bins = [{'min': float(low), 'max': float(high), 'count': int(count),
+                 'deficit': round(max(expected - count, 0.), 1)}
+                for low, high, count in zip(edges, edges[1:], counts)]
+        return {'updated': time.time() if now is None else now,
+                'units': 'A',
+                'minDefocus': float(edges[0]),
+                'maxDefocus': float(edges[-1]),
+                'micrographs': self.histogram.total,
+                'inRange': inRange,
+                'below': below,
+                'above': above,
+                'bins': bins,
+                'underCovered': [[b['min'], b['max']] for b in bins
+                                 if inRange == 0 or b['count'] < minCount],
+                'nextTargets': self.getNextTargets()}
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Overview of the sessions of a facility: finds the databases written by the
+summary monitors of several projects, reads their new rows on each refresh
+and writes a combined dashboard (dashboard.json and index.html).
+
+    python -m emfacilities.protocols.facility_dashboard \\
+        ~/ScipionUserData/projects --output /var/www/html/facility
+"""
+
+import argparse
+import bisect
+import glob
+import html
+import os
+import sqlite3 as lite
+import sys
+import time
+from collections import deque
+from statistics import median
+
+from pyworkflow.utils import red
+
+from .protocol_monitor_ctf import CTF_LOG_SQLITE
+from .protocol_monitor_movie_gain import GAIN_LOG_SQLITE
+from .protocol_monitor_system import SYSTEM_LOG_SQLITE
+from .report_data import atomicWrite, toJson
+
+# --------------------- CONSTANTS -----------------------------------
+DASHBOARD_JSON = 'dashboard.json'
+DASHBOARD_HTML = 'index.html'
+REFRESH_SECS = 60
+# micrographs per hour are counted in this window
+THROUGHPUT_WINDOW = 3600
+# quality values are the median of the latest micrographs (and movies)
+RECENT_MICS = 50
+# sessions whose databases changed in this time are active
+ACTIVE_SECS = 900
+SYSTEM_METRICS = ['cpu', 'mem', 'swap']
+
+
+def _parseTime(timestamp):
+    """ Seconds since the epoch of the local time stored by the ctf
+    monitor, None if unknown. """
+    try:
+        return time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _median(values):
+    return median(values) if values else None
+
+
+def findMonitorRuns(roots, dbNames):
+    """ Return the set of run folders with any of the given databases.
+    Each root may be a project folder or a folder with projects. """
+    runDirs = set()
+    for root in roots:
+        for projectPattern in [root, os.path.join(root, '*')]:
+            for dbName in dbNames:
+                pattern = os.path.join(projectPattern, 'Runs', '*', dbName)
+                runDirs.update(os.path.dirname(os.path.abspath(p))
+                               for p in glob.glob(pattern))
+    return runDirs
+
+
+def getRunProject(runDir):
+    """ Name of the project of a run folder (<project>/Runs/<run>). """
+    return os.path.basename(os.path.dirname(os.path.dirname(runDir)))
+
+
+class SessionStats:
+    """ Running statistics of one summary monitor run, updated with the
+    rows added to its databases since the previous refresh. """
+    def __init__(self, runDir):
+        self.runDir = runDir
+        self.run = os.path.basename(runDir)
+        self.project = getRunProject(runDir)
+        self._conns = {}
+        self._lastCtfId = 0
+        self._lastGainId = 0
+        self._lastSampleId = None
+        self.mics = 0
+        self.movies = 0
+        self.lastMicTime = None
+        # sorted times in the throughput window, the ctf rows are not
+        # stored in the order of their micrographs
+        self._micTimes = []
+        self._resolution = deque(maxlen=RECENT_MICS)
+        self._defocus = deque(maxlen=RECENT_MICS)
+        self._astigmatism = deque(maxlen=RECENT_MICS)
+        self._gainStd = deque(maxlen=RECENT_MICS)
+        self._gainRatio1 = deque(maxlen=RECENT_MICS)
+        self._gainRatio2 = deque(maxlen=RECENT_MICS)
+        self.system = {}  # metric -> latest value
+
+    def _getCursor(self, fileName):
+        conn = self._conns.get(fileName)
+        if conn is None:
+            path = os.path.join(self.runDir, fileName)
+            if not os.path.exists(path):
+                return None
+            conn = lite.connect('file:%s?mode=ro' % path, uri=True)
+            self._conns[fileName] = conn
+        return conn.cursor()
+
+    def _readCtf(self):
+        cur = self._getCursor(CTF_LOG_SQLITE)
+        if cur is None:
+            return
+        cur.execute("SELECT id, timestamp, defocusU, astigmatism, resolution "
+                    "FROM log WHERE id > ? ORDER BY id", (self._lastCtfId,))
+        for ctfId, timestamp, defocusU, astigmatism, resolution in cur:
+            self._lastCtfId = ctfId
+            self.mics += 1
+            micTime = _parseTime(timestamp)
+            if micTime is not None:
+                self.lastMicTime = max(micTime, self.lastMicTime or micTime)
+                bisect.insort(self._micTimes, micTime)
+            for values, value in [(self._defocus, defocusU),
+                                  (self._astigmatism, astigmatism),
+                                  (self._resolution, resolution)]:
+                if value is not None:
+                    values.append(value)
+
+    def _readGain(self):
+        cur = self._getCursor(GAIN_LOG_SQLITE)
+        if cur is None:
+            return
+        cur.execute("SELECT id, stddev, ratio1, ratio2 FROM log "
+                    "WHERE id > ? ORDER BY id", (self._lastGainId,))
+        for gainId, stddev, ratio1, ratio2 in cur:
+            self._lastGainId = gainId
+            self.movies += 1
+            for values, value in [(self._gainStd, stddev),
+                                  (self._gainRatio1, ratio1),
+                                  (self._gainRatio2, ratio2)]:
+                if value is not None:
+                    values.append(value)
+
+    def _readSystem(self):
+        cur = self._getCursor(SYSTEM_LOG_SQLITE)
+        if cur is None:
+            return
+        if self._lastSampleId is None:
+            # only the latest values are shown
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM log")
+            self._lastSampleId = cur.fetchone()[0] - 1
+        cur.execute("SELECT v.sampleId, m.name, v.value FROM log_value v "
+                    "JOIN log_metric m ON m.id = v.metricId "
+                    "WHERE v.sampleId > ? AND m.host = '' "
+                    "ORDER BY v.sampleId", (self._lastSampleId,))
+        for sampleId, name, value in cur:
+            self._lastSampleId = sampleId
+            self.system[name] = value
+
+    def refresh(self, now=None):
+        now = time.time() if now is None else now
+        for read in [self._readCtf, self._readGain, self._readSystem]:
+            try:
+                read()
+            except lite.Error as e:
+                # e.g. being created or written by an older version
+                print(red("%s: cannot read %s: %s" % (self.runDir,
+                                                      read.__name__, e)))
+        del self._micTimes[:bisect.bisect_left(self._micTimes,
+                                               now - THROUGHPUT_WINDOW)]
+
+    def getLastChange(self):
+        """ Modification time of the newest database of the session. """
+        times = [os.path.getmtime(os.path.join(self.runDir, f))
+                 for f in self._conns
+                 if os.path.exists(os.path.join(self.runDir, f))]
+        return max(times) if times else None
+
+    def getSummary(self, now=None):
+        now = time.time() if now is None else now
+        lastChange = self.getLastChange()
+        gpuUse = [v for k, v in self.system.items() if k.startswith('gpuUse_')]
+        summary = {'project': self.project,
+                   'run': self.run,
+                   'runDir': self.runDir,
+                   'active': lastChange is not None
+                             and now - lastChange < ACTIVE_SECS,
+                   'lastChange': lastChange,
+                   'micrographs': self.mics,
+                   'micsPerHour': len(self._micTimes)
+                                  * 3600. / THROUGHPUT_WINDOW,
+                   'resolution': _median(self._resolution),
+                   'defocus': _median(self._defocus),
+                   'astigmatism': _median(self._astigmatism),
+                   'movies': self.movies,
+                   'gainStd': _median(self._gainStd),
+                   'gainRatio1': _median(self._gainRatio1),
+                   'gainRatio2': _median(self._gainRatio2),
+                   'gpuUse': sum(gpuUse) / len(gpuUse) if gpuUse else None}
+        for name in SYSTEM_METRICS:
+            summary[name] = self.system.get(name)
+        return summary
+
+    def close(self):
+        for conn in self._conns.values():
+            conn.close()
+        self._conns.clear()
+
+
+class FacilityDashboard:
+    """ Sessions of all the projects found under some folders. """
+    def __init__(self, roots):
+        self.roots = roots
+        self.sessions = {}  # run folder -> SessionStats
+
+    def discover(self):
+        runDirs = findMonitorRuns(self.roots,
+                                  [CTF_LOG_SQLITE, GAIN_LOG_SQLITE,
+                                   SYSTEM_LOG_SQLITE])
+        for runDir in set(self.sessions) - runDirs:
+            self.sessions.pop(runDir).close()
+        for runDir in runDirs - set(self.sessions):
+            self.sessions[runDir] = SessionStats(runDir)
+
+    def refresh(self, now=None):
+        self.discover()
+        for session in self.sessions.values():
+            session.refresh(now)
+
+    def getSummary(self, now=None):
+        """ Return the summary dicts of the sessions, active ones first. """
+        summaries = [s.getSummary(now) for s in self.sessions.values()]
+        return sorted(summaries, key=lambda s: (not s['active'],
+                                                s['project'], s['run']))
+
+    def write(self, outputDir, now=None):
+        now = time.time() if now is None else now
+        os.makedirs(outputDir, exist_ok=True)
+        sessions = self.getSummary(now)
+        atomicWrite(os.path.join(outputDir, DASHBOARD_JSON),
+                    toJson({'time': now, 'sessions': sessions}))
+        atomicWrite(os.path.join(outputDir, DASHBOARD_HTML),
+                    renderHtml(sessions, now))
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+
+# column title -> (summary key, format)
+HTML_COLUMNS = [('Project', 'project', '%s'),
+                ('Run', 'run', '%s'),
+                ('Micrographs', 'micrographs', '%d'),
+                ('Mics/hour', 'micsPerHour', '%0.1f'),
+                (u'Resolution (Å)', 'resolution', '%0.2f'),
+                (u'Defocus (Å)', 'defocus', '%0.0f'),
+                (u'Astigmatism (Å)', 'astigmatism', '%0.0f'),
+                ('Gain std', 'gainStd', '%0.3f'),
+                ('Gain 97.5/2.5%', 'gainRatio1', '%0.2f'),
+                ('Gain max/97.5%', 'gainRatio2', '%0.2f'),
+                ('CPU %', 'cpu', '%0.0f'),
+                ('Mem %', 'mem', '%0.0f'),
+                ('GPU %', 'gpuUse', '%0.0f')]
+
+HTML_TEMPLATE = u"""<!DOCTYPE html>
+<HTML>
+<HEAD>
+<META charset="utf-8">
+<META http-equiv="refresh" content="%(refresh)d">
+<TITLE>Facility sessions</TITLE>
+<STYLE>
+body {font-family: sans-serif; margin: 20px;}
+table {border-collapse: collapse;}
+th, td {padding: 4px 10px; border-bottom: 1px solid #ddd; text-align: right;}
+th:nth-child(-n+2), td:nth-child(-n+2) {text-align: left;}
+tr.inactive {color: #999;}
+</STYLE>
+</HEAD>
+<BODY>
+<H1>Facility sessions</H1>
+<P>Updated: %(date)s. Quality and gain values are the median of the last %(recent)d micrographs and movies.</P>
+<TABLE>
+<THEAD><TR>%(header)s</TR></THEAD>
+<TBODY>
+%(rows)s
+</TBODY>
+</TABLE>
+</BODY>
+</HTML>
+"""
+
+
+def renderHtml(sessions, now):
+    def cell(session, key, fmt):
+        value = session.get(key)
+        return html.escape(fmt % value) if value is not None else '-'
+
+    rows = ['<TR class="%s">%s</TR>'
+            % ('active' if s['active'] else 'inactive',
+               ''.join('<TD>%s</TD>' % cell(s, key, fmt)
+                       for _, key, fmt in HTML_COLUMNS))
+            for s in sessions]
+    return HTML_TEMPLATE % {
+        'refresh': REFRESH_SECS,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+        'recent': RECENT_MICS,
+        'header': ''.join('<TH>%s</TH>' % html.escape(title)
+                          for title, _, _ in HTML_COLUMNS),
+        'rows': '\n'.join(rows)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Combined dashboard of the summary monitors of "
+                    "several Scipion projects.")
+    parser.add_argument('roots', nargs='+',
+                        help="project folders, or folders with projects")
+    parser.add_argument('--output', required=True,
+                        help="folder where the dashboard is written")
+    parser.add_argument('--interval', type=float, default=REFRESH_SECS,
+                        help="seconds between refreshes")
+    parser.add_argument('--once', action='store_true',
+                        help="write the dashboard once and exit")
+    args = parser.parse_args(argv)
+
+    dashboard = FacilityDashboard(args.roots)
+    try:
+        while True:
+            dashboard.refresh()
+            dashboard.write(args.output)
+            if args.once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dashboard.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Spatial statistics of the residual gain images written by the movie gain
+protocol. Images are memory mapped and processed in blocks of rows, so
+memory use does not depend on the detector size.
+"""
+
+import os
+
+import numpy as np
+
+# --------------------- CONSTANTS -----------------------------------
+CHUNK_ROWS = 256
+RADIAL_BINS = 32
+SPIDER_EXTENSIONS = ('.xmp', '.spi', '.stk', '.vol', '.psd')
+MRC_EXTENSIONS = ('.mrc', '.mrcs', '.map')
+
+
+def _mapSpider(path):
+    """ Memory map the first image of a SPIDER file (the format of the
+    xmipp .xmp gains). Return None if the header is not understood. """
+    for endian in ('<', '>'):
+        header = np.fromfile(path, dtype=endian + 'f4', count=23)
+        if len(header) < 23:
+            return None
+        nz, ny, iform = int(header[0]), int(header[1]), int(header[4])
+        nx, labbyt = int(header[11]), int(header[21])
+        if iform in (1, 3) and nz >= 1 and ny > 0 and nx > 0 \
+                and labbyt >= 1024:
+            break
+    else:
+        return None
+    if os.path.getsize(path) < labbyt + nx * ny * 4:
+        return None
+    return np.memmap(path, dtype=endian + 'f4', mode='r', offset=labbyt,
+                     shape=(ny, nx))
+
+
+def _firstImage(data):
+    return data[0] if data.ndim == 3 else data
+
+
+def openImage(path):
+    """ Return the image at path as a 2D array-like, memory mapped for
+    SPIDER files. MRC files are better read with analyzeFile, that closes
+    the map when done. """
+    ext = os.path.splitext(path)[1].lower()
+    data = None
+    if ext in SPIDER_EXTENSIONS:
+        data = _mapSpider(path)
+    if data is None:
+        # other formats are read in memory
+        from pwem.emlib.image import ImageHandler
+        data = ImageHandler().read(path).getData()
+    return _firstImage(data)
+
+
+class GainImageAnalyzer:
+    """ Compute row, column and radial profiles and the number of hot,
+    cold and defective pixels, rows and columns of a gain image.
+    """
+    def __init__(self, hotSigma=5.0, defectSigma=5.0, chunkRows=CHUNK_ROWS,
+                 radialBins=RADIAL_BINS):
+        self.hotSigma = hotSigma
+        self.defectSigma = defectSigma
+        self.chunkRows = chunkRows
+        self.radialBins = radialBins
+
+    def _chunks(self, data):
+        for y0 in range(0, data.shape[0], self.chunkRows):
+            yield y0, np.asarray(data[y0:y0 + self.chunkRows],
+                                 dtype=np.float64)
+
+    def analyze(self, data):
+        """ Return a dict with the statistics of a 2D array-like. """
+        ny, nx = data.shape
+        n = float(nx * ny)
+
+        # first pass: moments and profiles
+        total = totalSq = 0.
+        rowProfile = np.empty(ny)
+        colSum = np.zeros(nx)
+        radialSum = np.zeros(self.radialBins)
+        radialCount = np.zeros(self.radialBins)
+        cy, cx = (ny - 1) / 2., (nx - 1) / 2.
+        maxRadius = np.hypot(cy, cx)
+        x2 = (np.arange(nx) - cx) ** 2
+        for y0, chunk in self._chunks(data):
+            total += chunk.sum()
+            totalSq += np.square(chunk).sum()
+            rowProfile[y0:y0 + len(chunk)] = chunk.mean(axis=1)
+            colSum += chunk.sum(axis=0)
+            y2 = (np.arange(y0, y0 + len(chunk)) - cy) ** 2
+            radius = np.sqrt(y2[:, None] + x2[None, :])
+            bins = np.minimum((radius / maxRadius * self.radialBins)
+                              .astype(np.int64), self.radialBins - 1).ravel()
+            radialSum += np.bincount(bins, chunk.ravel(), self.radialBins)
+            radialCount += np.bincount(bins, minlength=self.radialBins)
+
+        mean = total / n
+        std = np.sqrt(max(totalSq / n - mean * mean, 0.))
+        colProfile = colSum / ny
+        radialProfile = radialSum / np.maximum(radialCount, 1)
+
+        # second pass: outlier pixels
+        hotPixels = coldPixels = 0
+        if std > 0:
+            hot = mean + self.hotSigma * std
+            cold = mean - self.hotSigma * std
+            for _, chunk in self._chunks(data):
+                hotPixels += int(np.count_nonzero(chunk > hot))
+                coldPixels += int(np.count_nonzero(chunk < cold))
+
+        inner = radialProfile[:self.radialBins // 4].mean()
+        outer = radialProfile[-self.radialBins // 4:].mean()
+
+        return {'mean': float(mean),
+                'std': float(std),
+                'hotPixels': hotPixels,
+                'coldPixels': coldPixels,
+                'badRows': self._countDefects(rowProfile),
+                'badColumns': self._countDefects(colProfile),
+                'radialDrop': float(outer / inner) if inner else 0.,
+                'rowProfile': rowProfile,
+                'columnProfile': colProfile,
+                'radialProfile': radialProfile}
+
+    def _countDefects(self, profile):
+        """ Number of values further than defectSigma robust deviations
+        from the median of the profile. """
+        median = np.median(profile)
+        mad = np.median(np.abs(profile - median)) * 1.4826
+        if mad == 0:
+            return 0
+        return int(np.count_nonzero(np.abs(profile - median)
+                                    > self.defectSigma * mad))
+
+    def analyzeFile(self, path):
+        if os.path.splitext(path)[1].lower() in MRC_EXTENSIONS:
+            import mrcfile
+            with mrcfile.mmap(path, mode='r', permissive=True) as mrc:
+                return self.analyze(_firstImage(mrc.data))
+        return self.analyze(openImage(path))
+
+
+class GainTrend:
+    """ Detect detector degradation comparing the latest values of a
+    statistic with the first ones of the session.
+    """
+    def __init__(self, window=20, factor=2.0):
+        self.window = window
+        self.factor = factor
+
+    def isDegrading(self, values):
+        """ values: counts (e.g. hot pixels) ordered by movie. True when
+        the mean of the last window is factor times the first one. """
+        if len(values) < 2 * self.window:
+            return False
+        baseline = float(np.mean(values[:self.window]))
+        latest = float(np.mean(values[-self.window:]))
+        return latest > self.factor * max(baseline, 1.)
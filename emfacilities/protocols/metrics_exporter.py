@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import math
+import re
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# --------------------- CONSTANTS -----------------------------------
+METRICS_PREFIX = 'scipion'
+METRICS_PATH = '/metrics'
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def metricName(*parts):
+    """ Join parts into a valid OpenMetrics metric name. """
+    name = '_'.join(str(p) for p in parts if p)
+    name = re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+    if name[:1].isdigit():
+        name = '_' + name
+    return name
+
+
+def formatValue(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def escapeLabel(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+class MetricsExporter:
+    """ Serve the latest values of the monitors in OpenMetrics text format,
+    so Prometheus can scrape them. Values are kept in an in-memory
+    snapshot that monitors update after each step, scrapes never touch
+    the monitor databases.
+    """
+    def __init__(self, port, host='', labels=None):
+        """
+        :param port: TCP port to listen on, 0 to pick a free one
+        :param host: interface to bind, all of them by default
+        :param labels: dict with labels added to every sample
+                       (e.g. the project name)
+        """
+        self.host = host
+        self.port = port
+        self.labels = labels or {}
+        self._snapshot = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def update(self, monitorName, values):
+        """ Replace the values of a monitor by a new dict name -> value.
+        A name can also be a (name, labels) tuple, with labels as (label,
+        value) pairs that tell apart the samples of the same metric, e.g.
+        ('gpu_mem', (('gpu', 0),)).
+        Values that can not be converted to float are ignored. """
+        if not values:
+            return
+        samples = {}
+        for key, value in values.items():
+            name, labels = key if isinstance(key, tuple) else (key, ())
+            try:
+                samples[(metricName(METRICS_PREFIX, monitorName, name),
+                         tuple(sorted((metricName(k), str(v))
+                                      for k, v in labels)))] = \
+                    float(value)
+            except (TypeError, ValueError):
+                pass
+        samples[(metricName(METRICS_PREFIX, monitorName,
+                            'last_update_seconds'), ())] = time.time()
+        with self._lock:
+            self._snapshot[monitorName] = samples
+
+    def render(self):
+        """ Return the snapshot as OpenMetrics text. """
+        commonLabels = [(metricName(k), v)
+                        for k, v in sorted(self.labels.items())]
+        with self._lock:
+            snapshot = [(m, sorted(s.items()))
+                        for m, s in sorted(self._snapshot.items())]
+        lines = []
+        for monitorName, samples in snapshot:
+            lastName = None
+            for (name, sampleLabels), value in samples:
+                if name != lastName:
+                    lines.append('# TYPE %s gauge' % name)
+                    lastName = name
+                labels = ','.join('%s="%s"' % (k, escapeLabel(v))
+                                  for k, v in commonLabels
+                                  + list(sampleLabels))
+                labels = '{%s}' % labels if labels else ''
+                lines.append('%s%s %s' % (name, labels, formatValue(value)))
+        lines.append('# EOF\n')
+        return '\n'.join(lines)
+
+    def start(self):
+        """ Start serving in a background thread. """
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in (METRICS_PATH, '/'):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                accept = self.headers.get('Accept', '')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 OPENMETRICS_TYPE
+                                 if 'application/openmetrics-text' in accept
+                                 else PROMETHEUS_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # do not fill the protocol log with scrapes
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def getUrl(self):
+        return 'http://%s:%d%s' % (self.host or 'localhost', self.port,
+                                   METRICS_PATH)
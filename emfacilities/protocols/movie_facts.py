@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import math
+import os
+import sqlite3 as lite
+
+from pyworkflow.utils import red
+
+# --------------------- CONSTANTS -----------------------------------
+MOVIE_FACTS_SQLITE = 'movie_facts.sqlite'
+
+# column -> type of the facts table, besides movieId
+FACT_COLUMNS = [('movieName', 'TEXT'),
+                ('acquisitionTime', 'FLOAT'),
+                # gain monitor
+                ('gainStddev', 'FLOAT'),
+                ('gainRatio1', 'FLOAT'),
+                ('gainRatio2', 'FLOAT'),
+                # movie alignment
+                ('totalShift', 'FLOAT'),
+                ('maxShift', 'FLOAT'),
+                # ctf monitor
+                ('defocusU', 'FLOAT'),
+                ('defocusV', 'FLOAT'),
+                ('defocus', 'FLOAT'),
+                ('astigmatism', 'FLOAT'),
+                ('resolution', 'FLOAT'),
+                ('fitQuality', 'FLOAT')]
+
+# columns that can be used to sort the movies, all of them are indexed
+FACT_METRICS = [name for name, columnType in FACT_COLUMNS
+                if columnType == 'FLOAT']
+
+
+def alignmentShifts(movie):
+    """ Return (totalShift, maxShift) of the frame to frame shifts of an
+    aligned movie, or (None, None) if it has no alignment. """
+    if not movie.hasAlignment():
+        return None, None
+    xshifts, yshifts = movie.getAlignment().getShifts()
+    xshifts, yshifts = list(xshifts), list(yshifts)
+    steps = [math.hypot(x1 - x0, y1 - y0) for x0, x1, y0, y1
+             in zip(xshifts, xshifts[1:], yshifts, yshifts[1:])]
+    if not steps:
+        return None, None
+    return sum(steps), max(steps)
+
+
+class MovieFacts:
+    """ One row per movie (micrograph id) joining the values the monitors
+    compute for it, so movies can be compared by any metric with a single
+    indexed query. Monitors only update the columns they know about.
+    """
+    def __init__(self, workingDir, dbName=MOVIE_FACTS_SQLITE,
+                 tableName='movie'):
+        self._tableName = tableName
+        self.conn = lite.connect(os.path.join(workingDir, dbName),
+                                 isolation_level=None)
+        self.cur = self.conn.cursor()
+        self._createTable()
+        # movies of the alignment protocol already read, the ids may be
+        # appended out of order so the highest one is not enough
+        self.cur.execute("SELECT movieId FROM %s WHERE totalShift IS NOT NULL"
+                         % self._tableName)
+        self._alignIds = {row[0] for row in self.cur.fetchall()}
+        self._lastAlignId = max(self._alignIds, default=0)
+        self._alignScanned = 0
+
+    def _createTable(self):
+        columns = ''.join(',\n%s %s' % c for c in FACT_COLUMNS)
+        self.cur.execute("CREATE TABLE IF NOT EXISTS %s("
+                         "movieId INTEGER PRIMARY KEY%s)"
+                         % (self._tableName, columns))
+        for name in FACT_METRICS:
+            self.cur.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s(%s)"
+                             % (self._tableName, name, self._tableName, name))
+
+    def updateMany(self, rows):
+        """ Insert or update the given columns of several movies.
+        :param rows: list of dicts with a movieId key
+        """
+        known = dict(FACT_COLUMNS)
+        self.cur.execute("BEGIN")
+        try:
+            for row in rows:
+                names = [k for k in row if k in known and row[k] is not None]
+                if row.get('movieId') is None or not names:
+                    continue
+                sql = ("INSERT INTO %s (movieId, %s) VALUES (:movieId, %s) "
+                       "ON CONFLICT(movieId) DO UPDATE SET %s"
+                       % (self._tableName, ', '.join(names),
+                          ', '.join(':' + n for n in names),
+                          ', '.join('%s=excluded.%s' % (n, n) for n in names)))
+                self.cur.execute(sql, row)
+            self.cur.execute("COMMIT")
+        except lite.Error as e:
+            self.cur.execute("ROLLBACK")
+            print(red("MovieFacts, ERROR updating movies: %s" % e))
+
+    def update(self, movieId, **values):
+        values['movieId'] = movieId
+        self.updateMany([values])
+
+    def readAlignment(self, alignProtocol):
+        """ Store the shifts of the movies aligned since the last call. """
+        movies = getattr(alignProtocol, 'outputMovies', None)
+        if movies is None:
+            return
+        rows = []
+
+        def addMovie(movie):
+            totalShift, maxShift = alignmentShifts(movie)
+            fileName = movie.getFileName()
+            rows.append({'movieId': movie.getObjId(),
+                         'movieName': os.path.basename(fileName),
+                         'acquisitionTime': (os.path.getmtime(fileName)
+                                             if os.path.exists(fileName)
+                                             else None),
+                         'totalShift': totalShift,
+                         'maxShift': maxShift})
+            self._alignIds.add(movie.getObjId())
+
+        for movie in movies.iterItems(orderBy='id',
+                                      where='id > %d' % self._lastAlignId):
+            addMovie(movie)
+            self._lastAlignId = movie.getObjId()
+        # movies appended with a lower id than the cursor
+        size = len(movies)
+        if size > len(self._alignIds) and size != self._alignScanned:
+            for movie in movies.iterItems(
+                    orderBy='id', where='id <= %d' % self._lastAlignId):
+                if movie.getObjId() not in self._alignIds:
+                    addMovie(movie)
+            self._alignScanned = size
+        movies.close()
+        if rows:
+            self.updateMany(rows)
+
+    def getWorst(self, metric, limit=50, descending=True):
+        """ Return the movies with the highest (or lowest) value of
+        metric as a list of dicts. """
+        if metric not in FACT_METRICS:
+            raise ValueError("Unknown movie metric: %s" % metric)
+        self.cur.execute("SELECT * FROM %s WHERE %s IS NOT NULL "
+                         "ORDER BY %s %s LIMIT ?"
+                         % (self._tableName, metric, metric,
+                            'DESC' if descending else 'ASC'), (limit,))
+        names = [d[0] for d in self.cur.description]
+        return [dict(zip(names, row)) for row in self.cur.fetchall()]
+
+    def getMovie(self, movieId):
+        self.cur.execute("SELECT * FROM %s WHERE movieId = ?"
+                         % self._tableName, (movieId,))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip([d[0] for d in self.cur.description], row))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+First time each micrograph is seen in the outputs of the processing
+protocols, to follow its latency through the pipeline and the backlog
+of items waiting for each stage.
+"""
+
+import math
+import os
+import sqlite3 as lite
+import time
+
+from pyworkflow.object import Set
+from pyworkflow.utils import red
+from pwem.protocols import ProtImportImages
+
+# --------------------- CONSTANTS -----------------------------------
+PIPELINE_FUNNEL_SQLITE = 'pipeline_funnel.sqlite'
+LATENCY_PERCENTILES = [50, 90, 99]
+# relative width of the bins of the latency histograms
+LATENCY_BIN_RATIO = 1.01
+LATENCY_TOTAL = 0
+LATENCY_STAGE = 1
+
+
+def getItemMicId(item):
+    """ Id of the micrograph (or movie) of an item of an output set.
+    Coordinates and particles have a micId, movies, micrographs and ctfs
+    share the id of their micrograph. """
+    getMicId = getattr(item, 'getMicId', None)
+    if getMicId is not None:
+        return getMicId()
+    return item.getObjId()
+
+
+def getLatencyBin(seconds):
+    """ Bin of the latency histograms: 0 below one second, then bins of
+    growing width LATENCY_BIN_RATIO. """
+    if seconds < 1:
+        return 0
+    return int(math.log(seconds) / math.log(LATENCY_BIN_RATIO)) + 1
+
+
+def getBinLatency(latencyBin):
+    """ Seconds at the center of a bin of the latency histograms. """
+    if latencyBin <= 0:
+        return 0.
+    return float(LATENCY_BIN_RATIO ** (latencyBin - 0.5))
+
+
+def formatSeconds(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(round(seconds))
+    if seconds < 3600:
+        return '%d:%02d' % (seconds // 60, seconds % 60)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+
+class PipelineFunnel:
+    """ One stage per output set of the input protocols. For each stage
+    the micrograph ids it has produced, with the time they were first
+    seen, are stored in a sqlite database, reading only the items added
+    since the previous call. The stage counts and latency histograms are
+    updated as the micrographs are stored, so getStages does not need
+    to join the whole table.
+    """
+    def __init__(self, workingDir, dbName=PIPELINE_FUNNEL_SQLITE):
+        self.conn = lite.connect(os.path.join(workingDir, dbName),
+                                 isolation_level=None)
+        self.cur = self.conn.cursor()
+        self._createTables()
+
+    def _createTables(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS stage("
+                         "stageId INTEGER PRIMARY KEY,"
+                         "protId INTEGER,"
+                         "outputName TEXT,"
+                         "label TEXT,"
+                         # last item id read
+                         "lastId INTEGER DEFAULT 0,"
+                         # items read, to notice those appended with
+                         # lower ids than lastId
+                         "itemCount INTEGER DEFAULT 0,"
+                         # modification time of the sets that are
+                         # rewritten (classes)
+                         "lastMtime INTEGER DEFAULT 0,"
+                         "count INTEGER DEFAULT 0,"
+                         "firstTime FLOAT,"
+                         "UNIQUE(protId, outputName))")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS seen("
+                         "stageId INTEGER,"
+                         "micId INTEGER,"
+                         "time FLOAT,"
+                         "PRIMARY KEY(stageId, micId)) WITHOUT ROWID")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS seen_mic "
+                         "ON seen(micId)")
+        # kind is LATENCY_TOTAL or LATENCY_STAGE
+        self.cur.execute("CREATE TABLE IF NOT EXISTS latency("
+                         "stageId INTEGER,"
+                         "kind INTEGER,"
+                         "bin INTEGER,"
+                         "count INTEGER,"
+                         "PRIMARY KEY(stageId, kind, bin)) WITHOUT ROWID")
+
+    def _getStage(self, protId, outputName, label):
+        self.cur.execute("INSERT OR IGNORE INTO stage(protId, outputName, "
+                         "label) VALUES (?, ?, ?)",
+                         (protId, outputName, label))
+        self.cur.execute("SELECT stageId, lastId, lastMtime, itemCount "
+                         "FROM stage "
+                         "WHERE protId=? AND outputName=?",
+                         (protId, outputName))
+        return self.cur.fetchone()
+
+    def readProtocol(self, prot, now=None):
+        """ Read the new items of all the output sets of a protocol. """
+        isImport = isinstance(prot, ProtImportImages)
+        for outName, outSet in prot.iterOutputAttributes(Set):
+            self.readOutput(prot.getObjId(), outName, outSet,
+                            label='%s.%s' % (prot.getRunName(), outName),
+                            useFileTime=isImport, now=now)
+
+    def readOutput(self, protId, outputName, outSet, label=None,
+                   useFileTime=False, now=None):
+        """ Store when the micrographs of the items of outSet were first
+        seen.
+        :param useFileTime: use the modification time of the item files
+                            (e.g. the arrival of the imported movies)
+        """
+        now = time.time() if now is None else now
+        stageId, lastId, lastMtime, itemCount = self._getStage(
+            protId, outputName, label or outputName)
+        rows = {}
+        try:
+            if hasattr(outSet, 'iterClassItems'):
+                # classes are rewritten, read them again if they changed,
+                # but only the items added since the last time: streaming
+                # classifiers add the particles in the order of their input
+                fileName = outSet.getFileName()
+                mtime = (os.stat(fileName).st_mtime_ns
+                         if os.path.exists(fileName) else 0)
+                if mtime == lastMtime:
+                    return
+                maxId = lastId
+                for cls in outSet.iterItems():
+                    if not cls.isEnabled():
+                        continue
+                    for item in cls.iterItems(where='id > %d' % lastId):
+                        if item.isEnabled():
+                            rows.setdefault(getItemMicId(item), now)
+                        maxId = max(maxId, item.getObjId())
+                lastId, lastMtime = maxId, mtime
+            else:
+                def addItem(item):
+                    micId = getItemMicId(item)
+                    if micId not in rows:
+                        fileName = item.getFileName() if useFileTime else None
+                        rows[micId] = (os.path.getmtime(fileName)
+                                       if fileName and os.path.exists(fileName)
+                                       else now)
+
+                for item in outSet.iterItems(orderBy='id',
+                                             where='id > %d' % lastId):
+                    addItem(item)
+                    lastId = item.getObjId()
+                    itemCount += 1
+                # items appended with a lower id than the cursor, only
+                # the micrographs not in this stage yet are stored
+                size = len(outSet)
+                if size > itemCount:
+                    self.cur.execute("SELECT micId FROM seen "
+                                     "WHERE stageId=?", (stageId,))
+                    seenMics = {row[0] for row in self.cur.fetchall()}
+                    for item in outSet.iterItems(orderBy='id',
+                                                 where='id <= %d' % lastId):
+                        if getItemMicId(item) not in seenMics:
+                            addItem(item)
+                    itemCount = size
+        finally:
+            outSet.close()
+
+        self.cur.execute("BEGIN")
+        try:
+            self._addSeen(stageId, rows)
+            self.cur.execute("UPDATE stage SET lastId=?, lastMtime=?, "
+                             "itemCount=? WHERE stageId=?",
+                             (lastId, lastMtime, itemCount, stageId))
+            self.cur.execute("COMMIT")
+        except lite.Error as e:
+            self.cur.execute("ROLLBACK")
+            print(red("PipelineFunnel, ERROR storing %s: %s" % (label, e)))
+
+    def _addSeen(self, stageId, rows):
+        """ Store the new micrographs of a stage and update its counters. """
+        bins = {}
+        added = []
+        for micId, t in rows.items():
+            if micId is None:
+                continue
+            self.cur.execute("SELECT micId, stageId, time FROM seen "
+                             "WHERE micId=?", (micId,))
+            micRows = self.cur.fetchall()
+            if any(s == stageId for _, s, _ in micRows):
+                continue
+            self.cur.execute("INSERT INTO seen(stageId, micId, time) "
+                             "VALUES (?, ?, ?)", (stageId, micId, t))
+            # the latencies of the other stages of this micrograph change
+            # if it is seen here before them
+            self._addBins(bins, micRows, -1)
+            self._addBins(bins, micRows + [(micId, stageId, t)], 1)
+            added.append(t)
+        if added:
+            self.cur.execute("UPDATE stage SET count=count+?, firstTime="
+                             "MIN(COALESCE(firstTime, ?), ?) "
+                             "WHERE stageId=?",
+                             (len(added), min(added), min(added), stageId))
+            self._updateBins(bins)
+
+    @staticmethod
+    def _addBins(bins, micRows, sign):
+        """ Add to bins the latency bins of the stages of a micrograph. """
+        micRows = sorted(micRows, key=lambda r: (r[2], r[1]))
+        for i, (_, stageId, t) in enumerate(micRows):
+            for kind, since in [(LATENCY_TOTAL, micRows[0][2]),
+                                (LATENCY_STAGE, micRows[max(i - 1, 0)][2])]:
+                key = (stageId, kind, getLatencyBin(t - since))
+                bins[key] = bins.get(key, 0) + sign
+
+    def _updateBins(self, bins):
+        self.cur.executemany("INSERT INTO latency(stageId, kind, bin, count) "
+                             "VALUES (?, ?, ?, ?) ON CONFLICT(stageId, kind, "
+                             "bin) DO UPDATE SET count=count+excluded.count",
+                             [key + (n,) for key, n in bins.items() if n])
+        self.cur.execute("DELETE FROM latency WHERE count <= 0")
+
+    def _latencies(self, stageId, kind):
+        self.cur.execute("SELECT bin, count FROM latency "
+                         "WHERE stageId=? AND kind=? ORDER BY bin",
+                         (stageId, kind))
+        counts = self.cur.fetchall()
+        total = sum(n for _, n in counts)
+        if not total:
+            return [None] * len(LATENCY_PERCENTILES)
+        values = []
+        for p in LATENCY_PERCENTILES:
+            # nearest rank
+            rank = max(int(math.ceil(p / 100. * total)), 1)
+            cumulative = 0
+            for latencyBin, n in counts:
+                cumulative += n
+                if cumulative >= rank:
+                    values.append(getBinLatency(latencyBin))
+                    break
+        return values
+
+    def getStages(self):
+        """ Return a list of dicts, one per stage ordered by the time of
+        their first item, with:
+        - count: micrographs in the stage
+        - backlog: micrographs of the previous stage not in this one yet
+        - latency: percentiles of the seconds since the micrograph was
+                   first seen
+        - stageLatency: percentiles of the seconds since the micrograph
+                        reached its previous stage
+        The latencies are read from histograms with bins of
+        LATENCY_BIN_RATIO.
+        """
+        self.cur.execute("SELECT stageId, label, count FROM stage "
+                         "WHERE count > 0 ORDER BY firstTime, stageId")
+        stages = []
+        for stageId, label, count in self.cur.fetchall():
+            stages.append({'stageId': stageId, 'label': label,
+                           'count': count,
+                           # the stages are a funnel: every micrograph in a
+                           # stage is in the previous one
+                           'backlog': max(stages[-1]['count'] - count, 0)
+                           if stages else 0,
+                           'percentiles': LATENCY_PERCENTILES})
+        for stage in stages:
+            stage['latency'] = self._latencies(stage['stageId'],
+                                               LATENCY_TOTAL)
+            stage['stageLatency'] = self._latencies(stage['stageId'],
+                                                    LATENCY_STAGE)
+        return stages
+
+    def close(self):
+        self.conn.close()
@@ -1,30 +1,22 @@
 import logging
 from os.path import abspath, join, dirname, splitext
 
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-from matplotlib import pyplot as plt
-import mrcfile
-
 import pyworkflow.protocol.params as params
-import xmipp3
 from pwem.objects import Class2D, Class3D
 from pwem.protocols import EMProtocol
 
-from pwem import emlib
-
 import numpy as np
 import json
-import yaml
 import os
 
 from pyworkflow import NEW
-from pyworkflow.utils import weakImport, cyanStr
+from pyworkflow.utils import cyanStr
+
+from .thumbnails import ThumbnailCache, getThumbnailCacheDir, makeThumbnail
 
 logger = logging.getLogger(__name__)
 
-program_fso = None
-with weakImport("xmipp3"):
-    program_fso = 'xmipp_resolution_fso'
+program_fso = 'xmipp_resolution_fso'
 
 
 INPUT_MOVIES = 0
@@ -278,27 +270,16 @@ class ProtOSCEM(EMProtocol):
         extra_folder = self._getExtraPath()
         file_keys = [_gainFile, _darkFile]
         valid_file_keys = [key for key in file_keys if input_movies[key] is not None]
+        cache = ThumbnailCache(getThumbnailCacheDir(self.getProject()))
         for key in valid_file_keys:
-            with mrcfile.open(input_movies[key], 'r') as mrc:
-                # Read the data from the MRC file
-                data = mrc.data
-
-            # Normalize the data to 8-bit (0-255) range
-            min_val = np.min(data)
-            max_val = np.max(data)
-            normalized_data = 255 * (data - min_val) / (max_val - min_val)
-            normalized_data = normalized_data.astype(np.uint8)
-
-            # Apply Histogram Equalization
-            image = Image.fromarray(normalized_data)
-            image = ImageOps.equalize(image)
-
+            # Save with histogram equalization
             base_filename = os.path.splitext(os.path.basename(input_movies[key]))[0]
             png_path = os.path.join(extra_folder, f'{base_filename}.jpg')
-            image.save(png_path)
+            cache.get(input_movies[key], png_path, makeThumbnail, equalize=True)
 
             image_path = os.path.basename(png_path)
             input_movies[key] = os.path.basename(image_path)
+        cache.close()
 
         # Creating the dictionary
         import_movies = {}
@@ -343,6 +324,9 @@ class ProtOSCEM(EMProtocol):
         return micrographs
 
     def CTF_generation(self):
+        import mrcfile
+        from PIL import Image, ImageDraw, ImageFont
+        from matplotlib import pyplot as plt
         CTFs = self.CTF.get()
 
         defocus_list = []
@@ -530,6 +514,9 @@ class ProtOSCEM(EMProtocol):
         return CTF_estimation
 
     def particles_generation(self):
+        import mrcfile
+        from PIL import Image, ImageDraw
+        from matplotlib import pyplot as plt
         parts = self.particles.get()
         mic_dict = {}
 
@@ -637,6 +624,8 @@ class ProtOSCEM(EMProtocol):
         return particles
 
     def classes2D_generation(self):
+        import mrcfile
+        from PIL import Image, ImageDraw, ImageFont
         classes2D = self.classes2D.get()
 
         # Creation of a list (copy) of classes2D
@@ -739,7 +728,12 @@ class ProtOSCEM(EMProtocol):
                                   th, front_view_img, side_view_img, top_view_img)
 
         resolution = None
-        if program_fso:
+        try:
+            import xmipp3
+            from pwem import emlib
+        except ImportError:
+            xmipp3 = None
+        if xmipp3 is not None:
             try:
                 half_maps = volume.getHalfMaps()
                 half_maps1, half_maps2 = half_maps.split(',')
@@ -846,6 +840,8 @@ class ProtOSCEM(EMProtocol):
         return volume
 
     def classes3D_generation(self):
+        import mrcfile
+        from PIL import Image, ImageDraw, ImageFont
         classes3D = self.classes3D.get()
 
         extra_folder = self._getExtraPath()
@@ -1079,6 +1075,7 @@ class ProtOSCEM(EMProtocol):
         """
         Function to create the max shift descriptor
         """
+        from matplotlib import pyplot as plt
         ###### MAX SHIFT DESCRIPTOR######
         MaxShiftProt = self.maxShift.get()
         movie_maxshift = {'descriptor_name': MaxShiftProt.getClassName()}
@@ -1182,6 +1179,7 @@ class ProtOSCEM(EMProtocol):
             return data
 
     def saveMetadataFile(self):
+        import yaml
         file_path = self.getOutFile()
         # with open(file_path, 'w', encoding='utf-8') as json_file:
         #     json.dump(self.processing_json, json_file, ensure_ascii=False, indent=4)
@@ -1249,10 +1247,12 @@ class ProtOSCEM(EMProtocol):
 
     # Convert slices to images
     def slices_to_images(self, slices):
+        from PIL import Image
         images = [Image.fromarray(slice) for slice in slices]
         return images
 
     def create_collage(self, images, collage_filename):
+        from PIL import Image
         img_width, img_height = images[0].size
 
         # Define the number of rows and columns for the collage
@@ -1274,6 +1274,7 @@ class ProtOSCEM(EMProtocol):
         collage.save(collage_filename)
 
     def readMap(self, fnMap):
+        import xmipp3
         return xmipp3.Image(fnMap)
 
     def generateChimeraView(self, fnWorkingDir, fnMap, fnView, isMap=True, threshold=0, angX=0, angY=0, angZ=0):
@@ -1344,12 +1345,14 @@ class ProtOSCEM(EMProtocol):
 
     # Resize images to make text appear larger
     def resize_image(self, image, scale):
+        from PIL import Image
         width, height = image.size
         new_size = (int(width * scale), int(height * scale))
         return image.resize(new_size, Image.Resampling.LANCZOS)
 
     # Resize images back to original size
     def resize_back(self, image, original_size):
+        from PIL import Image
         width, height = original_size
         enlarge_factor= 1.5
         new_size = (int(width * enlarge_factor), int(height * enlarge_factor))
@@ -27,7 +27,6 @@ from datetime import datetime
 import os
 import time
 import sys
-import matplotlib.pyplot as plt
 
 from pyworkflow.utils import prettyTime
 import pyworkflow.protocol.params as params
@@ -305,6 +304,7 @@ def balancePlot(good_particles, bad_particles, fileName):
     particle_counts = [good_particles, bad_particles]
     # Define colors for the bars
     colors = ['#007ACC', '#FF585D']
+    import matplotlib.pyplot as plt
     # Create a bar plot with custom colors and formal style
     _, ax = plt.subplots(figsize=(8, 6))  # Adjust the figure size
     ax.bar(classes, particle_counts, color=colors, edgecolor='black', linewidth=1.2)
@@ -320,6 +320,7 @@ def balancePlot(good_particles, bad_particles, fileName):
     plt.savefig(fileName, dpi=300, bbox_inches='tight')
 
 def balanceOverTimePlot(cumulative_good, cumulative_bad, fileName):
+    import matplotlib.pyplot as plt
     time_points = range(1, len(cumulative_good)+1)
     # Create a plot for the cumulative distributions over time
     plt.figure(figsize=(10, 6))  # Adjust the figure size
@@ -82,6 +82,36 @@ class ProtMonitor(EMProtocol):
                    label='SMTP Mail server',
                    help='Provide the address of SMTP mail server.')
 
+    def _clusterParams(self, form):
+        g = form.addGroup('Cluster')
+
+        g.addParam('doCluster', params.BooleanParam, default=False,
+                   label="Collect samples from other nodes?",
+                   help="Receive the system usage of the worker nodes. In "
+                        "each node run an agent with:\n"
+                        "scipion3 python -m emfacilities.protocols.system_agent"
+                        " --monitor <this host>:<port> --interval 60 "
+                        "[--gpus \"0 1\"] [--nif <interface>] [--disk]")
+
+        g.addParam('clusterPort', params.IntParam, condition='doCluster',
+                   default=9122,
+                   label='Port',
+                   help='TCP port where the agents will send their samples.')
+
+    def _metricsExporterParams(self, form):
+        g = form.addGroup('Metrics exporter')
+
+        g.addParam('doMetricsExporter', params.BooleanParam,
+                   label="Serve metrics to Prometheus?", default=False,
+                   help="Serve the latest monitored values in OpenMetrics "
+                        "text format, so they can be scraped by Prometheus "
+                        "at http://<host>:<port>/metrics")
+
+        g.addParam('metricsPort', params.IntParam, condition='doMetricsExporter',
+                   default=9121,
+                   label='Port',
+                   help='TCP port where the metrics will be served.')
+
     # -------------------------- INSERT steps functions -----------------------
     def _insertAllSteps(self):
         self._insertFunctionStep('monitorStep')
@@ -136,6 +166,38 @@ class ProtMonitor(EMProtocol):
 
         return email
 
+    def createSampleCollector(self):
+        """ Return a started SampleCollector or None if disabled. """
+        if not getattr(self, 'doCluster', False):
+            return None
+
+        from .system_agent import SampleCollector
+        try:
+            collector = SampleCollector(self.clusterPort.get()).start()
+            self.info("Collecting system samples at port %d"
+                      % collector.port)
+        except OSError as e:
+            self.info("Cannot start the system sample collector: %s" % e)
+            return None
+        return collector
+
+    def createMetricsExporter(self):
+        """ Return a started MetricsExporter or None if disabled. """
+        if not getattr(self, 'doMetricsExporter', False):
+            return None
+
+        from .metrics_exporter import MetricsExporter
+        exporter = MetricsExporter(
+            self.metricsPort.get(),
+            labels={'project': self.getProject().getShortName()})
+        try:
+            exporter.start()
+            self.info("Serving metrics at %s" % exporter.getUrl())
+        except OSError as e:
+            self.info("Cannot start the metrics exporter: %s" % e)
+            return None
+        return exporter
+
     @classmethod
     def worksInStreaming(cls):
         # A monitor protocol always work in streaming
@@ -150,6 +212,8 @@ class Monitor:
         self.monitorTime = kwargs.get('monitorTime', None)
 
         self._notifiers = []
+        # Latest values sampled by the monitor, see getLastValues
+        self._lastValues = {}
 
         if kwargs.get('email', None) is not None:
             self._notifiers.append(kwargs['email'])
@@ -186,6 +250,11 @@ class Monitor:
     def addNotifier(self, notifier):
         self._notifiers.append(notifier)
 
+    def getLastValues(self):
+        """ Return a dict (name -> number) with the values read in the
+        last step. Used to export the current state of the monitor. """
+        return dict(self._lastValues)
+
 
 class EmailNotifier:
     def __init__(self, smtpServer, emailFrom, emailTo):
@@ -127,6 +127,8 @@ class MonitorCTF(Monitor):
         self._dataBase = kwargs.get('dbName', CTF_LOG_SQLITE)
         self._tableName = kwargs.get('tableName', 'log')
         self.readCTFs = set()
+        # MovieFacts where the values of each micrograph are joined, if any
+        self.facts = None
 
         self.conn = lite.connect(os.path.join(self.workingDir, self._dataBase),
                                  isolation_level=None)
@@ -165,8 +167,10 @@ class MonitorCTF(Monitor):
         diffSet = CTFset - self.readCTFs
         setOfCTFs = prot.outputCTF
         astigmatism = self.astigmatism
+        facts = []
 
-        for ctfID in diffSet:
+        # by id, so the last values are those of the newest micrograph
+        for ctfID in sorted(diffSet):
             ctf = setOfCTFs[ctfID]
             defocusU = ctf.getDefocusU()
             defocusV = ctf.getDefocusV()
@@ -238,6 +242,21 @@ class MonitorCTF(Monitor):
                 print(e)
                 print(sql)
 
+            facts.append({'movieId': ctf.getMicrograph().getObjId(),
+                          'defocusU': defocusU,
+                          'defocusV': defocusV,
+                          'defocus': defocus,
+                          'astigmatism': astig,
+                          'resolution': resolution,
+                          'fitQuality': fitQuality})
+
+            self._lastValues = {'defocusU': defocusU,
+                                'defocusV': defocusV,
+                                'astigmatism': astig,
+                                'resolution': resolution,
+                                'fitQuality': fitQuality,
+                                'phaseShift': phaseShift}
+
             if abs(defocusU - defocusV) > astigmatism:
                 self.warning("Astigmatism (defocusU - defocusV)  = %f."
                              % abs(defocusU - defocusV))
@@ -253,6 +272,9 @@ class MonitorCTF(Monitor):
                 self.minDefocus = defocusV
 
         self.readCTFs.update(diffSet)
+        if self.facts is not None and facts:
+            self.facts.updateMany(facts)
+        self._lastValues['micrographs'] = len(self.readCTFs)
         # Finish when protocol is not longer running
         return prot.getStatus() != STATUS_RUNNING
 
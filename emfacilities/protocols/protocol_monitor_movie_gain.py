@@ -25,13 +25,24 @@
 # **************************************************************************
 
 import os
+import re
+import time
+import datetime
+import sqlite3 as lite
+
+import pytz
 
 import pyworkflow.protocol.params as params
 from pyworkflow.protocol.constants import STATUS_RUNNING
 from pyworkflow import VERSION_1_1
+from pyworkflow.utils import red
 
 from .protocol_monitor import ProtMonitor, Monitor
 
+GAIN_LOG_SQLITE = 'gain_log.sqlite'
+GAIN_SUMMARY = 'summaryForMonitor.txt'
+GAIN_WARNINGS = 'warningsMonitor.txt'
+
 
 class ProtMonitorMovieGain(ProtMonitor):
     """ check CPU, mem and IO usage.
@@ -66,6 +77,20 @@ class ProtMonitorMovieGain(ProtMonitor):
                            "gain value and the 97.5 percentile is greater "
                            "than given value")
 
+        group = form.addGroup('Residual gain images')
+        group.addParam('doAnalyzeImages', params.BooleanParam, default=False,
+                       label="Analyze residual gain images?",
+                       help="Compute row, column and radial profiles and "
+                            "count hot pixels of the residual gain image of "
+                            "each movie, and raise an alarm if they grow "
+                            "along the session (detector degradation).")
+        group.addParam('hotPixelSigma', params.FloatParam, default=5.0,
+                       condition='doAnalyzeImages',
+                       label="Hot pixel threshold (sigmas)",
+                       help="Pixels further than this number of standard "
+                            "deviations from the mean are counted as hot "
+                            "(or cold) pixels.")
+
         form.addParam('monitorTime', params.FloatParam, default=300,
                       label="Total Logging time (min)",
                       help="Log during this interval")
@@ -93,7 +118,9 @@ class ProtMonitorMovieGain(ProtMonitor):
                                             stdout=True,
                                             stddevValue=self.stddevValue.get(),
                                             ratio1Value=self.ratio1Value.get(),
-                                            ratio2Value=self.ratio2Value.get())
+                                            ratio2Value=self.ratio2Value.get(),
+                                            analyzeImages=self.doAnalyzeImages.get(),
+                                            hotPixelSigma=self.hotPixelSigma.get())
         return movieGainMonitor
 
     # -------------------------- INFO functions -------------------------------
@@ -102,8 +129,10 @@ class ProtMonitorMovieGain(ProtMonitor):
         return []  # no errors
 
     def _summary(self):
-        prot = self.inputProtocol.get()
-        fnWarning = prot._getPath("warningsMonitor.txt")
+        fnWarning = self._getPath(GAIN_WARNINGS)
+        if not os.path.exists(fnWarning):
+            # runs older than the gain log wrote into the input protocol
+            fnWarning = self.inputProtocol.get()._getPath(GAIN_WARNINGS)
         if not os.path.exists(fnWarning):
             summary = ["Monitor movie gain, no warnings yet."]
         else:
@@ -119,6 +148,15 @@ class MonitorMovieGain(Monitor):
     """ This will be monitoring a movie gain estimation protocol.
     It will internally handle a database to store produced
     movie gain values.
+
+    The summary file written by the gain protocol is followed like
+    'tail -f': the byte offset read so far is kept in the database, so
+    each step only parses the lines appended since the previous one and
+    every movie is checked once.
+
+    Each row keeps the movie id, the modification time of the summary
+    file when the line was read (i.e. when the gain protocol processed
+    the movie) and the time it was stored, both as seconds since epoch.
     """
     def __init__(self, protocol, influx=False, **kwargs):
         Monitor.__init__(self, **kwargs)
@@ -129,109 +167,312 @@ class MonitorMovieGain(Monitor):
         self.stddevValue = kwargs['stddevValue']
         self.ratio1Value = kwargs['ratio1Value']
         self.ratio2Value = kwargs['ratio2Value']
+        self._dataBase = kwargs.get('dbName', GAIN_LOG_SQLITE)
+        self._tableName = kwargs.get('tableName', 'log')
         self.influx = influx
+        # MovieFacts where the values of each movie are joined, if any
+        self.facts = None
+        self.analyzer = None
+        if kwargs.get('analyzeImages', False):
+            from .gain_analyzer import GainImageAnalyzer, GainTrend
+            self.analyzer = GainImageAnalyzer(
+                hotSigma=kwargs.get('hotPixelSigma', 5.0))
+            self.trend = GainTrend()
+            self._degradationWarned = False
+            # counts of the first movies, the baseline of the trend
+            self._trendBaseline = []
+
+        self.conn = lite.connect(os.path.join(self.workingDir, self._dataBase),
+                                 isolation_level=None)
+        if self.influx:
+            # get results as a list of dictionaries
+            self.conn.row_factory = \
+                lambda c, r: dict([(col[0], r[idx])
+                                   for idx, col in enumerate(c.description)])
+        self.cur = self.conn.cursor()
+        # plain tuples for internal queries
+        self._cur = self.conn.cursor()
+        self._cur.row_factory = None
 
     def warning(self, msg):
         self.notify("Scipion Movie Gain Monitor WARNING", msg)
 
     def initLoop(self):
-        pass
-
-    def step(self):
-        prot = self.protocol
-        fnSummary = prot._getPath("summaryForMonitor.txt")
-        fnWarning = prot._getPath("warningsMonitor.txt")
-        if not os.path.exists(fnSummary) or os.path.getsize(fnSummary) < 1:
-            return False
-        fhSummary = open(fnSummary, "r")
-        if not os.path.exists(fnWarning):
-            fhWarning = open(fnWarning, "w")
-        else:
-            fhWarning = open(fnWarning, "a")
-
-        line = fhSummary.readlines()[-1]
-        stddev, perc25, perc975, maxVal = map(float, line.split()[1:])
-        movie_name = map(str, line.split()[0])
+        self._createTable()
+
+    def _createTable(self):
+        # ids are never reused, not even when the summary file is parsed
+        # again, so readers can follow the table with the last id read
+        self._cur.execute("""CREATE TABLE IF NOT EXISTS %s(
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                movieName TEXT,
+                                movieId INTEGER,
+                                stddev FLOAT,
+                                perc25 FLOAT,
+                                perc975 FLOAT,
+                                maxVal FLOAT,
+                                ratio1 FLOAT,
+                                ratio2 FLOAT,
+                                mtime FLOAT,
+                                timestamp FLOAT)
+                                """ % self._tableName)
+        self._addMissingColumns()
+        for column in ['movieId', 'timestamp']:
+            self._cur.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s(%s)"
+                              % (self._tableName, column, self._tableName,
+                                 column))
+        # spatial statistics of the residual gain images
+        self._cur.execute("""CREATE TABLE IF NOT EXISTS %s_image(
+                                movieId INTEGER PRIMARY KEY,
+                                mean FLOAT,
+                                std FLOAT,
+                                hotPixels INTEGER,
+                                coldPixels INTEGER,
+                                badRows INTEGER,
+                                badColumns INTEGER,
+                                radialDrop FLOAT)
+                                """ % self._tableName)
+        # read position in the summary file, a single row
+        self._cur.execute("""CREATE TABLE IF NOT EXISTS %s_tail(
+                                id INTEGER PRIMARY KEY CHECK (id = 0),
+                                inode INTEGER,
+                                offset INTEGER)
+                                """ % self._tableName)
+
+    def _addMissingColumns(self):
+        """ Databases created before rows had ids and times. """
+        self._cur.execute("PRAGMA table_info(%s)" % self._tableName)
+        columns = {row[1] for row in self._cur.fetchall()}
+        for column, columnType in [('movieId', 'INTEGER'),
+                                   ('mtime', 'FLOAT'),
+                                   ('timestamp', 'FLOAT')]:
+            if column not in columns:
+                self._cur.execute("ALTER TABLE %s ADD COLUMN %s %s"
+                                  % (self._tableName, column, columnType))
+
+    def _getTail(self):
+        self._cur.execute("SELECT inode, offset FROM %s_tail"
+                          % self._tableName)
+        row = self._cur.fetchone()
+        return row if row is not None else (None, 0)
+
+    @staticmethod
+    def _parseLine(line):
+        """ Parse a summary line, as written by the xmipp movie gain
+        protocol, e.g.:
+        movie_000001_residual: 0.016680 0.976350 1.028174 17.423561
+        """
         values = line.split()
-
-        if float(values[1]) > self.stddevValue:
+        stddev, perc25, perc975, maxVal = map(float, values[1:5])
+        movieName = values[0].rstrip(':')
+        # movie_000001_residual is the movie with id 1 in the input set
+        match = re.search(r'movie_(\d+)', movieName)
+        return {'movieName': movieName,
+                'movieId': int(match.group(1)) if match else None,
+                'stddev': stddev,
+                'perc25': perc25,
+                'perc975': perc975,
+                'maxVal': maxVal,
+                'ratio1': perc975 / perc25,
+                'ratio2': maxVal / perc975}
+
+    def readNewLines(self):
+        """ Parse the lines appended to the summary file since the last
+        call, store them and return the new rows. A partially written
+        last line is left for the next call. """
+        fnSummary = self.protocol._getPath(GAIN_SUMMARY)
+        if not os.path.exists(fnSummary):
+            return []
+
+        inode, offset = self._getTail()
+        stat = os.stat(fnSummary)
+        if inode != stat.st_ino or stat.st_size < offset:
+            # file replaced or truncated, parse it again
+            offset = 0
+        if stat.st_size == offset:
+            return []
+
+        with open(fnSummary, 'rb') as fhSummary:
+            fhSummary.seek(offset)
+            chunk = fhSummary.read()
+        end = chunk.rfind(b'\n') + 1
+        if end == 0:
+            return []
+
+        rows = []
+        now = time.time()
+        self._cur.execute("BEGIN")
+        try:
+            if offset == 0:
+                self._cur.execute("DELETE FROM %s" % self._tableName)
+            for line in chunk[:end].decode('utf-8', 'replace').splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    row = self._parseLine(line)
+                except (ValueError, IndexError, ZeroDivisionError):
+                    print(red("Cannot parse movie gain line: %s" % line))
+                    continue
+                row.update(mtime=stat.st_mtime, timestamp=now)
+                self._cur.execute(
+                    "INSERT INTO %s (movieName, movieId, stddev, perc25, "
+                    "perc975, maxVal, ratio1, ratio2, mtime, timestamp) "
+                    "VALUES (:movieName, :movieId, :stddev, :perc25, "
+                    ":perc975, :maxVal, :ratio1, :ratio2, :mtime, :timestamp)"
+                    % self._tableName, row)
+                row['id'] = self._cur.lastrowid
+                rows.append(row)
+            self._cur.execute("INSERT OR REPLACE INTO %s_tail "
+                              "(id, inode, offset) VALUES (0, ?, ?)"
+                              % self._tableName,
+                              (stat.st_ino, offset + end))
+            self._cur.execute("COMMIT")
+        except Exception:
+            self._cur.execute("ROLLBACK")
+            raise
+        return rows
+
+    def checkRow(self, row, fhWarning):
+        """ Raise the alerts of a movie, writing them to fhWarning. """
+        movieName = row['movieName']
+        if row['stddev'] > self.stddevValue:
             self.warning("Residual gain standard deviation is %f."
-                         % stddev)
+                         % row['stddev'])
             fhWarning.write("%s: Residual gain standard deviation is %f.\n"
-                            % (movie_name, stddev))
+                            % (movieName, row['stddev']))
 
-        if (perc975 / perc25) > self.ratio1Value:
+        if row['ratio1'] > self.ratio1Value:
             self.warning("The ratio between the 97.5 and 2.5 "
-                         "percentiles is %f."
-                         % (perc975 / perc25))
+                         "percentiles is %f." % row['ratio1'])
             fhWarning.write("%s: The ratio between the 97.5 and 2.5 "
                             "percentiles is %f.\n"
-                            % (movie_name, (perc975 / perc25)))
+                            % (movieName, row['ratio1']))
 
-        if (maxVal / perc975) > self.ratio2Value:
+        if row['ratio2'] > self.ratio2Value:
             self.warning("The ratio between the maximum gain value "
-                         "and the 97.5 percentile is %f."
-                         % (maxVal / perc975))
+                         "and the 97.5 percentile is %f." % row['ratio2'])
             fhWarning.write("%s: The ratio between the maximum gain value "
                             "and the 97.5 percentile is %f.\n"
-                            % (movie_name, (maxVal / perc975)))
-        fhSummary.close()
-        fhWarning.close()
+                            % (movieName, row['ratio2']))
+
+    def step(self):
+        prot = self.protocol
+        rows = self.readNewLines()
+        if rows:
+            fnWarning = os.path.join(self.workingDir, GAIN_WARNINGS)
+            with open(fnWarning, "a") as fhWarning:
+                for row in rows:
+                    self.checkRow(row, fhWarning)
+
+            if self.facts is not None:
+                self.facts.updateMany([{'movieId': row['movieId'],
+                                        'movieName': row['movieName'],
+                                        'gainStddev': row['stddev'],
+                                        'gainRatio1': row['ratio1'],
+                                        'gainRatio2': row['ratio2']}
+                                       for row in rows])
+
+            if self.analyzer is not None:
+                self.analyzeImages(rows)
+
+            last = rows[-1]
+            self._lastValues = {'stddev': last['stddev'],
+                                'ratio1': last['ratio1'],
+                                'ratio2': last['ratio2']}
+
         return prot.getStatus() != STATUS_RUNNING
 
+    def _getResidualGainPath(self, movieId):
+        prot = self.protocol
+        if hasattr(prot, 'getResidualGainPath'):
+            return prot.getResidualGainPath(movieId)
+        return prot._getExtraPath("movie_%06d_residual_gain.xmp" % movieId)
+
+    def analyzeImages(self, rows):
+        """ Store the statistics of the residual gain images of the new
+        movies and warn if hot pixels or defective lines keep growing. """
+        for row in rows:
+            if row['movieId'] is None:
+                continue
+            path = self._getResidualGainPath(row['movieId'])
+            if not os.path.exists(path):
+                continue
+            try:
+                stats = self.analyzer.analyzeFile(path)
+            except Exception as e:
+                print(red("Cannot analyze residual gain %s: %s" % (path, e)))
+                continue
+            stats['movieId'] = row['movieId']
+            self._cur.execute(
+                "INSERT OR REPLACE INTO %s_image (movieId, mean, std, "
+                "hotPixels, coldPixels, badRows, badColumns, radialDrop) "
+                "VALUES (:movieId, :mean, :std, :hotPixels, :coldPixels, "
+                ":badRows, :badColumns, :radialDrop)" % self._tableName,
+                stats)
+
+        if self._degradationWarned:
+            return
+        counts = self._getTrendCounts()
+        pixels = [c[1] for c in counts]
+        lines = [c[2] for c in counts]
+        if self.trend.isDegrading(pixels) or self.trend.isDegrading(lines):
+            self._degradationWarned = True
+            self.warning("The number of hot pixels or defective lines in "
+                         "the residual gain is growing, the detector may "
+                         "be degrading.")
+
+    def _getTrendCounts(self):
+        """ (movieId, outlier pixels, defective lines) of the first and
+        the latest trend.window movies, the only ones the trend compares.
+        """
+        window = self.trend.window
+        sql = ("SELECT movieId, hotPixels + coldPixels, badRows + badColumns "
+               "FROM %s_image ORDER BY movieId %%s LIMIT ?" % self._tableName)
+        if len(self._trendBaseline) < window:
+            self._cur.execute(sql % 'ASC', (window,))
+            self._trendBaseline = self._cur.fetchall()
+        self._cur.execute(sql % 'DESC', (window,))
+        # both overlap while there are less than 2 * window movies
+        counts = dict((c[0], c) for c in self._trendBaseline)
+        counts.update((c[0], c) for c in self._cur.fetchall())
+        return [counts[movieId] for movieId in sorted(counts)]
+
     def getData(self, lastId=-1):
         if self.influx:
             return self.getDataInflux(lastId)
         else:
             return self.getDataHtml()
 
-
-    def getDataInflux(self, lastId=None):
-        """retuen data as a list of dictionaries"""
-        prot = self.protocol
-        fnSummary = prot._getPath("summaryForMonitor.txt")
-        data = []
-        if not os.path.exists(fnSummary) < 1:
-            fhSummary = open(fnSummary, "r")
-            for idx, line in enumerate(fhSummary.readlines(), 1):  # star idx in 1
-                                             # in other protocols index start in 1
-                idx = int(idx)
-                if idx > lastId:  # where id > last_id
-                    row={}
-                    stddev, perc25, perc975, maxVal = map(float, line.split()[1:])
-                    row['idx'] = idx
-                    row['stddev'] = stddev
-                    row['ratio1'] = perc975 / perc25
-                    row['ratio2'] = maxVal / perc975
-                    data.append(row)
-            fhSummary.close()
-        # movie_000001: 0.016680 0.976350 1.028174 17.423561
-        return data
-
+    def getDataInflux(self, lastId=-1):
+        """ Return the rows with id > lastId as a list of dictionaries,
+        timestamp is the UTC time the gain protocol processed the movie. """
+        try:
+            self.cur.execute("SELECT id AS idx, movieId, stddev, ratio1, "
+                             "ratio2, COALESCE(mtime, timestamp) AS timestamp "
+                             "FROM %s WHERE id > ? ORDER BY id"
+                             % self._tableName, (lastId,))
+        except lite.OperationalError:
+            return []
+        rows = self.cur.fetchall()
+        for row in rows:
+            if row['timestamp'] is not None:
+                row['timestamp'] = datetime.datetime.fromtimestamp(
+                    row['timestamp'], pytz.utc)
+        return rows
 
     def getDataHtml(self):
-        idValues = []
-        stddevValues = []
-        ratio1Values = []
-        ratio2Values = []
-
-        prot = self.protocol
-        fnSummary = prot._getPath("summaryForMonitor.txt")
-        if not os.path.exists(fnSummary) < 1:
-            fhSummary = open(fnSummary, "r")
-            for idx, line in enumerate(fhSummary.readlines()):
-                stddev, perc25, perc975, maxVal = map(float, line.split()[1:])
-                idValues.append(idx)
-                stddevValues.append(stddev)
-                ratio1Values.append(perc975 / perc25)
-                ratio2Values.append(maxVal / perc975)
-            fhSummary.close()
+        try:
+            self._cur.execute("SELECT id, stddev, ratio1, ratio2, mtime "
+                              "FROM %s ORDER BY id" % self._tableName)
+            rows = self._cur.fetchall()
+        except lite.OperationalError:
+            rows = []
 
         data = {
-            'idValues': idValues,
-            'standard_deviation': stddevValues,
-            'ratio1': ratio1Values,
-            'ratio2': ratio2Values
+            'idValues': [r[0] - 1 for r in rows],
+            'standard_deviation': [r[1] for r in rows],
+            'ratio1': [r[2] for r in rows],
+            'ratio2': [r[3] for r in rows],
+            'mtime': [r[4] for r in rows]
         }
         return data
-
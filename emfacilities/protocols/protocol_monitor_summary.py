@@ -29,17 +29,20 @@ import os.path
 import pyworkflow.utils as pwutils
 import pyworkflow.protocol.params as params
 from pyworkflow import VERSION_1_1
+from pyworkflow.protocol import getUpdatedProtocol
 
 from pwem.protocols import ProtCTFMicrographs, ProtAlignMovies
 from pwem import Domain
 import subprocess
 
-from .report_influx import ReportInflux
 from .report_html import ReportHtml
 from .protocol_monitor import ProtMonitor, Monitor
 from .protocol_monitor_ctf import MonitorCTF
 from .protocol_monitor_movie_gain import MonitorMovieGain
 from .protocol_monitor_system import MonitorSystem
+from .movie_facts import MovieFacts
+from .pipeline_funnel import PipelineFunnel
+from .defocus_planner import DefocusPlanner
 from pyworkflow import BETA, UPDATED, NEW, PROD
 
 
@@ -93,6 +96,28 @@ class ProtMonitorSummary(ProtMonitor):
                       label="Raise Alarm if astigmatism >",
                       help="Raise alarm if astigmatism (defocusU-defocusV)is greater than given "
                            "value")
+        form.addParam('planDefocus', params.BooleanParam, default=False,
+                      label="Plan defocus targets?",
+                      help="Compare the defocus of the micrographs with an "
+                           "even coverage of a target range and write the "
+                           "under covered bins and the defocus recommended "
+                           "for the next exposures to defocus_plan.json in "
+                           "the report folder, so the acquisition software "
+                           "can poll it.")
+        form.addParam('targetMinDefocus', params.FloatParam, default=5000,
+                      condition='planDefocus',
+                      label="Target minimum defocus (A)")
+        form.addParam('targetMaxDefocus', params.FloatParam, default=25000,
+                      condition='planDefocus',
+                      label="Target maximum defocus (A)")
+        form.addParam('targetDefocusStep', params.FloatParam, default=2500,
+                      condition='planDefocus',
+                      label="Target defocus step (A)",
+                      help="Width of the bins that should be evenly "
+                           "covered.")
+        form.addParam('numDefocusTargets', params.IntParam, default=5,
+                      condition='planDefocus',
+                      label="Number of recommended targets")
 
 
 
@@ -123,11 +148,11 @@ class ProtMonitorSummary(ProtMonitor):
         group.addParam('doNetwork', params.BooleanParam, default=False,
                        label="Check Network",
                        help="Set to true if you want to monitor the Network")
-        group.addParam('netInterfaces', params.EnumParam,
-                       choices=MonitorSystem.getNifsNameList(),
-                       default=1,  # usually 0 is the loopback
+        group.addParam('netInterface', params.StringParam, default='',
                        label="Interface", condition='doNetwork',
-                       help="Name of the network interface to be checked")
+                       help="Name of the network interface to be checked "
+                            "(e.g. eth0). If empty, the first interface "
+                            "that is not the loopback is used.")
 
         group = form.addGroup('Disk')
         group.addParam('doDiskIO', params.BooleanParam, default=False,
@@ -151,7 +176,32 @@ class ProtMonitorSummary(ProtMonitor):
                            "that will be replaced with the report folder. "
                            "For example: \n"
                            "rsync -avL %(REPORT_FOLDER)s "
-                           "scipion@webserver:public_html/")
+                           "scipion@webserver:public_html/\n"
+                           "The token %(CHANGED_FILES)s is replaced with a "
+                           "file listing the files changed since the last "
+                           "publication, relative to the report folder: \n"
+                           "rsync -avL --files-from=%(CHANGED_FILES)s "
+                           "%(REPORT_FOLDER)s scipion@webserver:public_html/myProject/"
+                           "\nThe command runs in the background and is "
+                           "only called when the report changes.")
+        form.addParam('doReportServer', params.BooleanParam, default=False,
+                      label="Serve the report?",
+                      help="Serve the HTML report over HTTP from this "
+                           "process. Open pages are updated as soon as "
+                           "the report changes instead of reloading it.")
+        form.addParam('reportServerPort', params.IntParam, default=8000,
+                      condition='doReportServer',
+                      label="Port",
+                      help="TCP port of the report server.")
+        form.addParam('exportReport', params.BooleanParam, default=False,
+                      label="Export the final report?",
+                      help="When the monitor finishes, pack the report, "
+                           "its data and thumbnails in a zip file next to "
+                           "the report folder, for archiving. The "
+                           "thumbnails are stored once and recompressed.")
+
+        ProtMonitor._clusterParams(self, form)
+        ProtMonitor._metricsExporterParams(self, form)
 
     # --------------------------- INSERT steps functions ---------------------
     def _insertAllSteps(self):
@@ -165,6 +215,22 @@ class ProtMonitorSummary(ProtMonitor):
         sysMonitor = self.createSystemMonitor()
         reportHtml = self.createHtmlReport(ctfMonitor, sysMonitor,
                                            movieGainMonitor)
+        exporter = self.createMetricsExporter()
+        sysMonitor.collector = self.createSampleCollector()
+        facts = MovieFacts(self.workingDir.get())
+        funnel = PipelineFunnel(self.workingDir.get())
+        server = None
+        if isinstance(reportHtml, ReportHtml):
+            reportHtml.funnel = funnel
+            server = reportHtml.server = self.createReportServer()
+            reportHtml.defocusPlanner = self.createDefocusPlanner()
+        inputProts = self.getInputProtocols()
+        for m in [ctfMonitor, movieGainMonitor]:
+            if m is not None:
+                m.facts = facts
+        alignProt = self._getAlignProtocol()
+        if alignProt is not None:
+            alignProt.setProject(self.getProject())
 
         monitor = Monitor(workingDir=self.workingDir.get(),
                           samplingInterval=self.samplingInterval.get(),
@@ -188,13 +254,32 @@ class ProtMonitorSummary(ProtMonitor):
                     # Call movie gain step
                     movieGainMonitor.step()
 
+                if alignProt is not None:
+                    facts.readAlignment(getUpdatedProtocol(alignProt))
+
+                for prot in inputProts:
+                    funnel.readProtocol(getUpdatedProtocol(prot))
+
                 # sysmonitor watches all input protocols so
                 # when sysmonitor done all protocols done
                 sysMonitorFinished = sysMonitor.step()
+
+                if exporter is not None:
+                    exporter.update('system', sysMonitor.getLastValues())
+                    if ctfMonitor is not None:
+                        exporter.update('ctf', ctfMonitor.getLastValues())
+                    if movieGainMonitor is not None:
+                        exporter.update('gain',
+                                        movieGainMonitor.getLastValues())
+
                 htmlFinished = reportHtml.generate(finished)
+                if exporter is not None and isinstance(reportHtml, ReportHtml):
+                    exporter.update('rates', reportHtml.rates.getMetrics())
                 if sysMonitorFinished and htmlFinished:
                     finished = True
                     reportHtml.generate(finished)
+                    if self.exportReport and isinstance(reportHtml, ReportHtml):
+                        reportHtml.export()
 
             except Exception as ex:
                 print("An error happened:")
@@ -206,7 +291,53 @@ class ProtMonitorSummary(ProtMonitor):
         monitor.initLoop = initAll
         monitor.step = stepAll
 
-        monitor.loop()
+        try:
+            monitor.loop()
+        finally:
+            if exporter is not None:
+                exporter.stop()
+            if server is not None:
+                server.stop()
+            if sysMonitor.collector is not None:
+                sysMonitor.collector.stop()
+            facts.close()
+            funnel.close()
+            if isinstance(reportHtml, ReportHtml):
+                reportHtml.close()
+
+    def createReportServer(self):
+        """ Return a started ReportServer or None if disabled. """
+        if not self.doReportServer:
+            return None
+
+        from .report_server import ReportServer
+        server = ReportServer(self.reportDir, self.reportServerPort.get())
+        try:
+            server.start()
+            self.info("Serving the report at %s" % server.getUrl())
+        except OSError as e:
+            self.info("Cannot start the report server: %s" % e)
+            return None
+        return server
+
+    def createDefocusPlanner(self):
+        """ Return a DefocusPlanner or None if disabled. """
+        if not self.planDefocus:
+            return None
+        return DefocusPlanner(self.targetMinDefocus.get(),
+                              self.targetMaxDefocus.get(),
+                              self.targetDefocusStep.get(),
+                              self.numDefocusTargets.get())
+
+    def _validate(self):
+        errors = []
+        if self.planDefocus and (
+                self.targetMaxDefocus.get() <= self.targetMinDefocus.get()
+                or self.targetDefocusStep.get() <= 0
+                or self.numDefocusTargets.get() < 1):
+            errors.append("The target defocus range is empty, or its step "
+                          "or the number of targets are not positive.")
+        return errors
 
     def createReportDir(self):
         self.reportDir = os.path.abspath(self._getExtraPath(self.getProject().getShortName()))
@@ -305,8 +436,7 @@ class ProtMonitorSummary(ProtMonitor):
                                gpusToUse=self.gpusToUse.get(),
                                doNetwork=self.doNetwork.get(),
                                doDiskIO=self.doDiskIO.get(),
-                               nif=MonitorSystem.getNifsNameList()[
-                                   self.netInterfaces.get()])
+                               nif=MonitorSystem.getProtocolNifName(self))
 
         return sysMon
 
@@ -320,6 +450,7 @@ class ProtMonitorSummary(ProtMonitor):
         movieGainMonitor = movieGainMonitor or self.createMovieGainMonitor()
         self.createReportDir()
         if self.doInflux:
+            from .report_influx import ReportInflux
             htmlReport = ReportInflux(self, ctfMonitor, sysMonitor, movieGainMonitor,
                                     self.publishCmd.get(),
                                     refreshSecs=self.samplingInterval.get())
@@ -350,7 +481,8 @@ class ProtMonitorSummary(ProtMonitor):
                 self._getExtraPath(self.getProject().getShortName()))
             pwutils.makePath(self.reportDir)
 
-            cmd = str(self.publishCmd) % {'REPORT_FOLDER': self.reportDir}
+            cmd = str(self.publishCmd) % {'REPORT_FOLDER': self.reportDir,
+                                          'CHANGED_FILES': os.devnull}
             p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
                                  stderr=subprocess.PIPE)
             output, err = p.communicate()
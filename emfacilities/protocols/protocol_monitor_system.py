@@ -25,7 +25,6 @@
 # **************************************************************************
 
 import os
-import sys
 import time
 import sqlite3 as lite
 import datetime
@@ -35,9 +34,7 @@ from configparser import ConfigParser
 try:
     import psutil
 except ImportError:
-    print("Cannot import psutil module - this is needed for this application.")
-    print("Exiting...")
-    sys.exit()
+    psutil = None  # reported by _validate
 
 from pyworkflow.utils import red
 import pyworkflow.protocol.params as params
@@ -46,18 +43,19 @@ from pyworkflow import VERSION_1_1
 from pyworkflow.protocol.constants import STATUS_RUNNING
 from pyworkflow.protocol import getUpdatedProtocol
 
-from pynvml import (nvmlInit, nvmlDeviceGetHandleByIndex,
-                    nvmlDeviceGetMemoryInfo, nvmlDeviceGetUtilizationRates,
-                    NVMLError, nvmlDeviceGetTemperature, NVML_TEMPERATURE_GPU,
-                    nvmlDeviceGetComputeRunningProcesses)
-
 from .protocol_monitor import ProtMonitor, Monitor
 
 SYSTEM_LOG_SQLITE = 'system_log.sqlite'
+# metrics averaged over all the hosts in the report
+CLUSTER_METRICS = ['cpu', 'mem']
 
 
 def initGPU():
-    nvmlInit()
+    """ Load and init NVML, only needed when GPUs are monitored.
+    Return the pynvml module. """
+    import pynvml
+    pynvml.nvmlInit()
+    return pynvml
 
 
 class ProtMonitorSystem(ProtMonitor):
@@ -114,11 +112,11 @@ class ProtMonitorSystem(ProtMonitor):
         group.addParam('doNetwork', params.BooleanParam, default=False,
                        label="Check Network",
                        help="Set to true if you want to monitor the Network")
-        group.addParam('netInterfaces', params.EnumParam,
-                       choices=MonitorSystem.getNifsNameList(),
-                       default=1,  # usually 0 is the loopback
+        group.addParam('netInterface', params.StringParam, default='',
                        label="Interface", condition='doNetwork',
-                       help="Name of the network interface to be checked")
+                       help="Name of the network interface to be checked "
+                            "(e.g. eth0). If empty, the first interface "
+                            "that is not the loopback is used.")
 
         group = form.addGroup('Disk')
         group.addParam('doDiskIO', params.BooleanParam, default=False,
@@ -126,10 +124,18 @@ class ProtMonitorSystem(ProtMonitor):
                        help="Set to true if you want to monitor the Disk "
                             "Access")
 
+        ProtMonitor._clusterParams(self, form)
+
     # --------------------------- STEPS functions ----------------------------
 
     def monitorStep(self):
-        self.createMonitor().loop()
+        sysMon = self.createMonitor()
+        sysMon.collector = self.createSampleCollector()
+        try:
+            sysMon.loop()
+        finally:
+            if sysMon.collector is not None:
+                sysMon.collector.stop()
 
     def createMonitor(self):
         protocols = []
@@ -149,32 +155,38 @@ class ProtMonitorSystem(ProtMonitor):
                                doGpu=self.doGpu.get(),
                                doNetwork=self.doNetwork.get(),
                                doDiskIO=self.doDiskIO.get(),
-                               nif=MonitorSystem.getNifsNameList()[
-                                   self.netInterfaces.get()],
+                               nif=MonitorSystem.getProtocolNifName(self),
                                gpusToUse=self.gpusToUse.get())
         return sysMon
 
     # --------------------------- INFO functions -----------------------------
     def _validate(self):
         # TODO if less than 20 sec complain
-        return []  # no errors
+        errors = []
+        if psutil is None:
+            errors.append("psutil module is needed to monitor the system.")
+        return errors
 
     def _summary(self):
         summary = []
         summary.append("GPU running Processes:")
-        initGPU()
+        try:
+            nvml = initGPU()
+        except ImportError as err:
+            summary.append(str(err))
+            return summary
         try:
             gpusToUse = [int(n) for n in (self.gpusToUse.get()).split()]
             for i in gpusToUse:
-                handle = nvmlDeviceGetHandleByIndex(i)
-                cps = nvmlDeviceGetComputeRunningProcesses(handle)
+                handle = nvml.nvmlDeviceGetHandleByIndex(i)
+                cps = nvml.nvmlDeviceGetComputeRunningProcesses(handle)
                 for ps in cps:
                     # p_tags['pid'] = ps.pid
                     msg = " %d) " % i + psutil.Process(ps.pid).name()
                     msg += " (mem =%.2f MB)" % (float(ps.usedGpuMemory) /
                                                 1048576.)
                     summary.append(msg)
-        except NVMLError as err:
+        except nvml.NVMLError as err:
             summary.append(str(err))
 
         return summary
@@ -183,54 +195,37 @@ class ProtMonitorSystem(ProtMonitor):
         return []
 
 
-class MonitorSystem(Monitor):
-    """ This will will be monitoring a System  protocol.
-    It will internally handle a database to store produced
-    system values.
+class SystemSampler:
+    """ Read the usage of CPU, memory, GPUs, network and disk of the
+    machine where it runs. It is shared by the system monitor and by the
+    agents running in other nodes (see system_agent.py).
     """
     mega = 1048576.
 
-    _nifsNameList = None
-
-    @classmethod
-    def getNifsNameList(cls):
-        from . import getnifs
-
-        if cls._nifsNameList is None:
-            # get list with network interfaces
-            nifs = getnifs.get_network_interfaces()
-            cls._nifsNameList = [nif.getName() for nif in nifs]
-        return cls._nifsNameList
-
-    def __init__(self, protocols, influx=False, **kwargs):
-        Monitor.__init__(self, **kwargs)
-        self.protocols = protocols
-        self.cpuAlert = kwargs['cpuAlert']
-        self.memAlert = kwargs['memAlert']
-        self.swapAlert = kwargs['swapAlert']
-        self._dataBase = kwargs.get('dbName', SYSTEM_LOG_SQLITE)
-        self._tableName = kwargs.get('tableName', 'log')
-        self.doGpu = kwargs['doGpu']
-        self.doNetwork = kwargs['doNetwork']
-        self.doDiskIO = kwargs['doDiskIO']
+    def __init__(self, doGpu=False, gpusToUse='', doNetwork=False, nif=None,
+                 doDiskIO=False):
+        self.doGpu = doGpu
+        self.doNetwork = doNetwork
+        self.doDiskIO = doDiskIO
         self.samplingTime = 1.  # seconds
 
         self.labelList = ["cpu", "mem", "swap"]
         if self.doGpu:
             self.gpuLabelList = []
             # get Gpus to monitor
-            self.gpusToUse = [int(n) for n in (kwargs['gpusToUse']).split()]
+            self.gpusToUse = [int(n) for n in (gpusToUse).split()]
             for i in self.gpusToUse:
                 self.gpuLabelList.append("gpuMem_%d" % i)
                 self.gpuLabelList.append("gpuUse_%d" % i)
                 self.gpuLabelList.append("gpuTem_%d" % i)
             # init GPUs
-            nvmlInit()
+            self._nvml = initGPU()
             self.labelList += self.gpuLabelList
         else:
             self.gpusToUse = None
+            self._nvml = None
         if self.doNetwork:
-            self.nif = kwargs['nif']
+            self.nif = MonitorSystem.getNifName(nif)
             self.netLabelList = []  # in the future we may display
             # all the network interfaces
             self.netLabelList.append("%s_send" % self.nif)
@@ -244,61 +239,35 @@ class MonitorSystem(Monitor):
             self.netLabelList.append("disk_read")
             self.netLabelList.append("disk_write")
             self.labelList += self.netLabelList
-        else:
-            pass
-
-        self.conn = lite.connect(os.path.join(self.workingDir,
-                                              self._dataBase),
-                                 isolation_level=None)
-        self.influx = influx
-        if influx:
-            # get results as a list of dictionaries
-            # versus a list of tuples
-            self.conn.row_factory = \
-                lambda c, r: dict([(col[0], r[idx])
-                                   for idx, col in enumerate(c.description)])
-            # read timezone and offset
-            from emfacilities.constants import (SECRETSFILE,
-                                                EMFACILITIES_HOME_VARNAME)
-            _path = os.getenv(EMFACILITIES_HOME_VARNAME)
-            secretsfile = os.path.join(_path, SECRETSFILE)
-            confParser = ConfigParser()
-            confParser.read(secretsfile)
-
-            self.timeDelta = int(confParser.get('influx', 'timeDelta'))
-            self.timeZone = confParser.get('influx', 'timeZone')
-
-        self.cur = self.conn.cursor()
-
-    def warning(self, msg):
-        self.notify("Scipion System Monitor WARNING", msg)
 
-    def initLoop(self):
-        self._createTable()
+    def initSampling(self):
+        """ First call to the counters that measure usage since the
+        previous call. """
         psutil.cpu_percent(True)
         psutil.virtual_memory()
 
-    def step(self):
+    def sample(self):
+        """ Return a dict with the current value of each label. """
         valuesDict = {}
-        valuesDict['table'] = self._tableName
-        cpu = valuesDict['cpu'] = psutil.cpu_percent(interval=0)
-        mem = valuesDict['mem'] = psutil.virtual_memory().percent
-        swap = valuesDict['swap'] = psutil.swap_memory().percent
+        valuesDict['cpu'] = psutil.cpu_percent(interval=0)
+        valuesDict['mem'] = psutil.virtual_memory().percent
+        valuesDict['swap'] = psutil.swap_memory().percent
         # some code examples:
         # https://github.com/ngi644/datadog_nvml/blob/master/nvml.py
         if self.doGpu:
             for i in self.gpusToUse:
                 try:
-                    handle = nvmlDeviceGetHandleByIndex(i)
-                    memInfo = nvmlDeviceGetMemoryInfo(handle)
+                    nvml = self._nvml
+                    handle = nvml.nvmlDeviceGetHandleByIndex(i)
+                    memInfo = nvml.nvmlDeviceGetMemoryInfo(handle)
                     valuesDict["gpuMem_%d" % i] = \
                         float(memInfo.used)*100./float(memInfo.total)
-                    util = nvmlDeviceGetUtilizationRates(handle)
+                    util = nvml.nvmlDeviceGetUtilizationRates(handle)
                     valuesDict["gpuUse_%d" % i] = util.gpu
-                    temp = nvmlDeviceGetTemperature(handle,
-                                                    NVML_TEMPERATURE_GPU)
+                    temp = nvml.nvmlDeviceGetTemperature(
+                        handle, nvml.NVML_TEMPERATURE_GPU)
                     valuesDict["gpuTem_%d" % i] = temp
-                except NVMLError as err:
+                except nvml.NVMLError as err:
                     msg = "ERROR monitoring GPU %d: %s." \
                           " Remove device %d from FORM" % (i, err, i)
                     print(red(msg))
@@ -334,6 +303,122 @@ class MonitorSystem(Monitor):
             except Exception as ex:
                 msg = "cannot get information of disk usage "
 
+        return valuesDict
+
+
+class MonitorSystem(Monitor):
+    """ This will will be monitoring a System  protocol.
+    It will internally handle a database to store produced
+    system values.
+    """
+    mega = 1048576.
+
+    _nifsNameList = None
+
+    @classmethod
+    def getNifsNameList(cls, refresh=False):
+        """ Names of the network interfaces. They are only listed the first
+        time they are needed, not when the protocol form is defined. """
+        if cls._nifsNameList is None or refresh:
+            try:
+                nifs = list(psutil.net_if_addrs())
+            except (AttributeError, OSError):
+                # old psutil, fall back to getifaddrs through ctypes
+                from . import getnifs
+                nifs = [nif.getName()
+                        for nif in getnifs.get_network_interfaces()]
+            cls._nifsNameList = nifs
+        return cls._nifsNameList
+
+    @classmethod
+    def getProtocolNifName(cls, protocol):
+        """ Interface selected in the form of a monitor protocol. Protocols
+        saved when it was chosen from a list store the index of the
+        interface in netInterfaces instead of its name. """
+        nif = protocol.netInterface.get()
+        index = getattr(protocol, 'netInterfaces', None)
+        if not nif and index is not None and index.get() is not None:
+            nifs = cls.getNifsNameList()
+            if 0 <= index.get() < len(nifs):
+                nif = nifs[index.get()]
+        return cls.getNifName(nif)
+
+    @classmethod
+    def getNifName(cls, nif=''):
+        """ Return nif if given, otherwise the first interface that is not
+        the loopback. """
+        if nif:
+            return nif
+        for name in cls.getNifsNameList():
+            if not name.startswith('lo'):
+                return name
+        return None
+
+    def __init__(self, protocols, influx=False, **kwargs):
+        Monitor.__init__(self, **kwargs)
+        self.protocols = protocols
+        self.cpuAlert = kwargs['cpuAlert']
+        self.memAlert = kwargs['memAlert']
+        self.swapAlert = kwargs['swapAlert']
+        self._dataBase = kwargs.get('dbName', SYSTEM_LOG_SQLITE)
+        self._tableName = kwargs.get('tableName', 'log')
+        self._metricTable = '%s_metric' % self._tableName
+        self._valueTable = '%s_value' % self._tableName
+        self._metricIds = {}
+        self.doGpu = kwargs['doGpu']
+        self.doNetwork = kwargs['doNetwork']
+        self.doDiskIO = kwargs['doDiskIO']
+
+        self.sampler = SystemSampler(doGpu=self.doGpu,
+                                     gpusToUse=kwargs.get('gpusToUse', ''),
+                                     doNetwork=self.doNetwork,
+                                     nif=kwargs.get('nif', None),
+                                     doDiskIO=self.doDiskIO)
+        self.labelList = self.sampler.labelList
+        self.gpusToUse = self.sampler.gpusToUse
+        self.nif = self.sampler.nif
+        # SampleCollector receiving samples from other nodes, if any
+        self.collector = None
+
+        self.conn = lite.connect(os.path.join(self.workingDir,
+                                              self._dataBase),
+                                 isolation_level=None)
+        self.influx = influx
+        if influx:
+            # get results as a list of dictionaries
+            # versus a list of tuples
+            self.conn.row_factory = \
+                lambda c, r: dict([(col[0], r[idx])
+                                   for idx, col in enumerate(c.description)])
+            # read timezone and offset
+            from emfacilities.constants import (SECRETSFILE,
+                                                EMFACILITIES_HOME_VARNAME)
+            _path = os.getenv(EMFACILITIES_HOME_VARNAME)
+            secretsfile = os.path.join(_path, SECRETSFILE)
+            confParser = ConfigParser()
+            confParser.read(secretsfile)
+
+            self.timeDelta = int(confParser.get('influx', 'timeDelta'))
+            self.timeZone = confParser.get('influx', 'timeZone')
+
+        self.cur = self.conn.cursor()
+        # this one returns tuples even if a row factory is set
+        self._cur = self.conn.cursor()
+        self._cur.row_factory = None
+
+    def warning(self, msg):
+        self.notify("Scipion System Monitor WARNING", msg)
+
+    def initLoop(self):
+        self._createTable()
+        self.sampler.initSampling()
+
+    def step(self):
+        valuesDict = self.sampler.sample()
+        cpu = valuesDict['cpu']
+        mem = valuesDict['mem']
+        swap = valuesDict['swap']
+
         if self.cpuAlert < 100 and cpu > self.cpuAlert:
             self.warning("CPU allocation =%f." % cpu)
             self.cpuAlert = cpu
@@ -346,24 +431,10 @@ class MonitorSystem(Monitor):
             self.warning("SWAP allocation =%f." % swap)
             self.swapAlert = swap
 
-        sqlCommand = "INSERT INTO %(table)s ("
-        for label in self.labelList:
-            sqlCommand += "%s, " % label
-        # remove last comma
-        sqlCommand = sqlCommand[:-2]
-        sqlCommand += ") VALUES("
-        for label in self.labelList:
-            sqlCommand += "%"+"(%s)f, " % label
-        # remove last comma
-        sqlCommand = sqlCommand[:-2]
-        sqlCommand += ");"
-
-        sql = sqlCommand % valuesDict
-
-        try:
-            self.cur.execute(sql)
-        except Exception as e:
-            print("ERROR: saving one data point (monitor). I continue")
+        hostValues = (self.collector.popSamples()
+                      if self.collector is not None else None)
+        self._insertSample(valuesDict, hostValues)
+        self._lastValues = valuesDict
 
         # Return finished = True if all protocols have finished
         finished = []
@@ -373,18 +444,157 @@ class MonitorSystem(Monitor):
 
         return all(finished)
 
+    def getLastValues(self):
+        """ Values of the last sample. The ones of each GPU and network
+        interface are returned as (name, labels) keys, so they are
+        exported as a single metric with a gpu or iface label. """
+        values = dict(self._lastValues)
+        for i in self.sampler.gpusToUse or []:
+            for name, metric in [('gpuMem', 'gpu_mem'),
+                                 ('gpuUse', 'gpu_use'),
+                                 ('gpuTem', 'gpu_temperature')]:
+                if '%s_%d' % (name, i) in values:
+                    values[(metric, (('gpu', i),))] = \
+                        values.pop('%s_%d' % (name, i))
+        nif = self.sampler.nif
+        for direction in ['send', 'recv']:
+            if '%s_%s' % (nif, direction) in values:
+                # sampled in MB during one second
+                values[('net_%s_bytes' % direction, (('iface', nif),))] = \
+                    values.pop('%s_%s' % (nif, direction)) * self.sampler.mega
+        return values
+
     def _createTable(self):
-        sqlCommand = """CREATE TABLE IF NOT EXISTS  %s(
+        """ Create the tables used to store the system metrics.
+
+        Samples are stored in a narrow layout: one row per sampling tick in
+        the main table, one row per (sample, metric) pair in the values
+        table and a dictionary of metric names. Thus, new metrics (e.g.
+        enabling the GPU on a resumed protocol) can be added at any time
+        without altering the schema.
+        """
+        self._cur.execute("""CREATE TABLE IF NOT EXISTS %s(
                                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                                 timestamp DATE DEFAULT
-                                     (datetime('now')),
-                                """ % self._tableName
-        for label in self.labelList:
-            sqlCommand += "%s FLOAT,\n" % label
-        # remove last comma and new line
-        sqlCommand = sqlCommand[:-2]
-        sqlCommand += ")"
-        self.cur.execute(sqlCommand)
+                                     (datetime('now')))""" % self._tableName)
+        # Metrics are identified by name and by the host where they were
+        # sampled, empty for the host running this monitor
+        self._cur.execute("""CREATE TABLE IF NOT EXISTS %s(
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                host TEXT NOT NULL DEFAULT '',
+                                name TEXT,
+                                UNIQUE (host, name))""" % self._metricTable)
+        # The primary key is a covering index to read a metric time series,
+        # the second one to read all the metrics of the samples > lastId
+        self._cur.execute("""CREATE TABLE IF NOT EXISTS %s(
+                                sampleId INTEGER,
+                                metricId INTEGER,
+                                value FLOAT,
+                                PRIMARY KEY (metricId, sampleId))
+                                WITHOUT ROWID""" % self._valueTable)
+        self._cur.execute("CREATE INDEX IF NOT EXISTS %s_sample "
+                         "ON %s(sampleId, metricId, value)"
+                         % (self._valueTable, self._valueTable))
+        self._migrate()
+
+    def _migrate(self):
+        """ Update databases written by previous versions, the schema
+        version is stored in the user_version pragma. """
+        self._cur.execute("PRAGMA user_version")
+        version = self._cur.fetchone()[0]
+        if version < 1:
+            self._migrateWideTable()
+
+    def _migrateWideTable(self):
+        """ Databases written by previous versions store one column per
+        metric in the main table. Move those values to the narrow layout
+        once, the old columns are left untouched. """
+        self._cur.execute("PRAGMA table_info(%s)" % self._tableName)
+        columns = [r[1] for r in self._cur.fetchall()
+                   if r[1] not in ('id', 'timestamp')]
+        self._cur.execute("BEGIN")
+        for column in columns:
+            self._cur.execute("""INSERT OR IGNORE INTO %s(sampleId, metricId,
+                                                         value)
+                                SELECT id, %d, %s FROM %s
+                                WHERE %s IS NOT NULL"""
+                             % (self._valueTable, self._getMetricId(column),
+                                column, self._tableName, column))
+        self._cur.execute("PRAGMA user_version = 1")
+        self._cur.execute("COMMIT")
+
+    def _getMetricId(self, name, host=''):
+        """ Return the id of the metric in the dictionary, registering it
+        if it is a new one. """
+        metricId = self._metricIds.get((host, name))
+        if metricId is None:
+            self._cur.execute("INSERT OR IGNORE INTO %s(host, name) "
+                              "VALUES (?, ?)" % self._metricTable,
+                              (host, name))
+            self._cur.execute("SELECT id FROM %s WHERE host = ? AND name = ?"
+                              % self._metricTable, (host, name))
+            metricId = self._cur.fetchone()[0]
+            self._metricIds[(host, name)] = metricId
+        return metricId
+
+    def _insertSample(self, valuesDict, hostValues=None):
+        """ Store one sample, valuesDict maps metric names to values.
+        hostValues maps the name of other hosts to their own valuesDict,
+        received at the same sampling time. """
+        rows = [('', name, value) for name, value in valuesDict.items()]
+        for host, values in (hostValues or {}).items():
+            rows.extend((host, name, value) for name, value in values.items())
+        try:
+            self._cur.execute("BEGIN")
+            self._cur.execute("INSERT INTO %s DEFAULT VALUES"
+                              % self._tableName)
+            sampleId = self._cur.lastrowid
+            self._cur.executemany("INSERT INTO %s(sampleId, metricId, value) "
+                                  "VALUES (?, ?, ?)" % self._valueTable,
+                                  [(sampleId, self._getMetricId(name, host),
+                                    float(value))
+                                   for host, name, value in rows])
+            self._cur.execute("COMMIT")
+        except Exception as e:
+            if self.conn.in_transaction:
+                self._cur.execute("ROLLBACK")
+            # the metric cache may contain ids of rolled back metrics
+            self._metricIds.clear()
+            print(red("ERROR: saving one data point (monitor): %s. "
+                      "I continue" % e))
+
+    def getMetricNames(self):
+        """ Return the names of all the metrics stored so far, the ones
+        sampled by this monitor first. """
+        cur = self.conn.cursor()
+        cur.row_factory = None
+        try:
+            cur.execute("SELECT %s FROM %s ORDER BY id"
+                        % (self._labelSql(''), self._metricTable))
+            stored = [r[0] for r in cur.fetchall()]
+        except lite.OperationalError:  # tables not created yet
+            stored = []
+        return self.labelList + [n for n in stored if n not in self.labelList]
+
+    @staticmethod
+    def _labelSql(prefix):
+        """ SQL expression of the label of a metric: its name or
+        host:name for metrics sampled in other hosts. """
+        return ("CASE WHEN %(p)shost = '' THEN %(p)sname "
+                "ELSE %(p)shost || ':' || %(p)sname END" % {'p': prefix})
+
+    def _iterValues(self, lastId=-1):
+        """ Iterate over (sampleId, label, value) of the samples
+        with id > lastId, ordered by sample. """
+        cur = self.conn.cursor()
+        cur.row_factory = None
+        cur.execute("""SELECT v.sampleId, %s, v.value
+                       FROM %s v JOIN %s m ON m.id = v.metricId
+                       WHERE v.sampleId > ?
+                       ORDER BY v.sampleId"""
+                    % (self._labelSql('m.'), self._valueTable,
+                       self._metricTable), (lastId,))
+        return cur
 
     def getLabels(self):
         return self.labelList
@@ -401,13 +611,22 @@ class MonitorSystem(Monitor):
         try:
             self.cur.execute("select * from %s where id > %d "
                              "order by id" % (self._tableName, lastId))
+            # As we are using a row factory, fetchall returns a list of
+            # dictionaries, each item in list(each dictionary)
+            # represents a row of the samples table
+            listOfDictionaries = [{'id': row['id'],
+                                   'timestamp': row['timestamp']}
+                                  for row in self.cur.fetchall()]
+            samples = {d['id']: d for d in listOfDictionaries}
+            # add the metrics of each sample as new keys
+            for sampleId, name, value in self._iterValues(lastId):
+                if sampleId in samples:
+                    samples[sampleId][name] = value
         except Exception as e:
-            print("MonitorCTF, ERROR reading data from db: %s" %
+            print("MonitorSystem, ERROR reading data from db: %s" %
                   os.path.join(self.workingDir, self._dataBase))
-        # As we are using a row factory, fetchall returns a list of
-        # dictionaries, each item in list(each dictionary)
-        # represents a row of the table
-        listOfDictionaries = self.cur.fetchall()
+            return []
+
         for item in listOfDictionaries:
             local = pytz.timezone(self.timeZone)
             # convert dates from scipion to datetime.datetime
@@ -432,53 +651,66 @@ class MonitorSystem(Monitor):
         """Fill a dictionary for each label in self.labeldisk.
         The key is the label name. The value a list with
         data read from the database"""
-        cur = self.cur
+        cur = self.conn.cursor()
+        cur.row_factory = None
+        labels = self.getMetricNames()
 
-        # Starting time
-        cur.execute("select julianday(timestamp)  from %s where id=1" %
-                    self._tableName)
-        data = cur.fetchone()
+        try:
+            # Starting time
+            cur.execute("select julianday(timestamp), timestamp from %s "
+                        "order by id limit 1" % self._tableName)
+            first = cur.fetchone()
+        except lite.OperationalError:  # tables not created yet
+            first = None
 
         # fill list with adquisition times
-        if (data is None) or (len(data) == 0):
-            initTime = 0
-            initTimeTitle = 0
-            idValues = [0]
-        else:
-            initTime = data[0]
-            cur.execute("select timestamp  from %s where id=1" %
-                        self._tableName)
-            initTimeTitle = cur.fetchone()[0]
-            cur.execute("select (julianday(timestamp) - %f)*24  from %s" %
-                        (initTime, self._tableName))
-            idValues = [r[0] for r in cur.fetchall()]
-
-        def get(name):
-            try:
-                cur.execute("select %s from %s" % (name, self._tableName))
-            except Exception as e:
-                print("ERROR readind data (plotter). I continue")
-                print("SQLCOMMAND", "select %s from %s" %
-                      (name, self._tableName))
-            data = cur.fetchall()
-            if len(data) == 0:
-                return [0]
-            else:
-                return [r[0] for r in data]
-
-        # TODO: this multiple calls to get may raise a
-        # race condition. That is data may be added to the DB
-        # between two get call and therefore the lengths of
-        # the list can be different. IT would be better to do a single
-        # call to the database and retrieve all at the same time
-        # see getDataInflux for details
+        if first is None:
+            return dict({'initTime': 0,
+                         'initTimeTitle': 0,
+                         'idValues': [0]},
+                        **{label: [0] for label in labels})
+
+        initTime, initTimeTitle = first
+        # Read sample times and all metric values with a single
+        # query each, samples added in between are just ignored
+        cur.execute("select id, (julianday(timestamp) - %f)*24  from %s "
+                    "order by id" % (initTime, self._tableName))
+        rows = cur.fetchall()
+        index = {sampleId: i for i, (sampleId, _) in enumerate(rows)}
+
         data = {'initTime': initTime,
                 'initTimeTitle': initTimeTitle,
-                'idValues': idValues}
+                'idValues': [r[1] for r in rows]}
 
-        # fill several lists with requested data
-        for label in self.labelList:
-            data[label] = get(label)
+        # metrics not sampled at a given time are left as None
+        for label in labels:
+            data[label] = [None] * len(rows)
+        for sampleId, name, value in self._iterValues():
+            i = index.get(sampleId)
+            if i is None:
+                continue
+            if name not in data:
+                data[name] = [None] * len(rows)
+            data[name][i] = value
+
+        self._addClusterSeries(data, labels)
 
-        # conn.close()
         return data
+
+    @staticmethod
+    def _addClusterSeries(data, labels):
+        """ If there are metrics from other hosts, add the average of
+        CLUSTER_METRICS over all the hosts as cluster:<metric>. """
+        hosts = sorted({label.split(':')[0] for label in labels
+                        if ':' in label})
+        if not hosts:
+            return
+        for name in CLUSTER_METRICS:
+            series = [data[label] for label in
+                      [name] + ['%s:%s' % (h, name) for h in hosts]
+                      if label in data]
+            average = []
+            for values in zip(*series):
+                values = [v for v in values if v is not None]
+                average.append(sum(values) / len(values) if values else None)
+            data['cluster:%s' % name] = average
@@ -32,13 +32,10 @@ from pwem.objects import Micrograph, Particle, Class3D, Class2D
 from pwem.emlib.image import ImageHandler as ih
 from pwem.emlib import MDL_XCOOR, MDL_YCOOR, MDL_MICROGRAPH_ID
 
+from .thumbnails import ThumbnailCache, getThumbnailCacheDir, convertImage
+
 import os
-from joblib import delayed, Parallel
-import networkx as nx
 import numpy as np
-from scipy.spatial.distance import cdist
-from xmipp3.convert import (writeSetOfCoordinates, writeCoordsListToPosFname,
-                            readPosCoordinates, readSetOfCoordsFromPosFnames)
 
 
 class UsedItemsTracker(EMProtocol):
@@ -176,6 +173,8 @@ class UsedItemsTracker(EMProtocol):
       self._defineOutputs(notUsedParticles=self.notParticlesSet)
 
   def trackMicrographsStep(self):
+      from xmipp3.convert import (writeSetOfCoordinates,
+                                  readSetOfCoordsFromPosFnames)
       print('\nTracking used micrographs')
       #Original mics: closest from root
       micSets = self.getOriginalMicrographs()
@@ -411,6 +410,7 @@ class UsedItemsTracker(EMProtocol):
     return particleSets
 
   def generatePSDs(self):
+    from joblib import delayed, Parallel
     outDir = self._getExtraPath('computedPSDs')
     os.mkdir(outDir)
     psdDic, argsList = {}, []
@@ -430,6 +430,7 @@ class UsedItemsTracker(EMProtocol):
     return psdDic
 
   def getNoiseCoordinates(self, coordsDir, outDir, noiseNumber=-1):
+    from joblib import delayed, Parallel
     micsBaseToFullName = {}
     for micId, micPath in self.micDic.items():
       if micPath.endswith(".mrc") or micPath.endswith(".tif"):
@@ -510,7 +511,14 @@ class UsedItemsTracker(EMProtocol):
     return outFile
 
   def exportAsJpg(self, itemPath, jpgPath):
-    ih().convert(itemPath, jpgPath)
+    # itemPath is a file or an (index, file) location
+    index, fileName = itemPath if isinstance(itemPath, tuple) else (0, itemPath)
+    self.getThumbnailCache().get(fileName, jpgPath, convertImage, index=index)
+
+  def getThumbnailCache(self):
+    if getattr(self, '_thumbnailCache', None) is None:
+      self._thumbnailCache = ThumbnailCache(getThumbnailCacheDir(self.getProject()))
+    return self._thumbnailCache
 
   def updateClassSet(self, outClasses, newClass, cl3D):
     '''Updated the set of classes "outClassess" with a "newClass", conformed by the particles
@@ -654,6 +662,7 @@ class UsedItemsTracker(EMProtocol):
 
   def getLongestPath(self, outGraph, node1, node2, dir='both'):
     '''Return the longest path between two nodes in a directed graph'''
+    import networkx as nx
     if nx.has_path(outGraph, node1, node2) and dir in ['both', 'down']:
       allPaths = nx.all_simple_paths(outGraph, node1, node2)
       return max(allPaths, key=len)
@@ -670,6 +679,7 @@ class UsedItemsTracker(EMProtocol):
     return True
 
   def checkPathExists(self, outGraph, oriNode, targetNode, dir='both'):
+    import networkx as nx
     if nx.has_path(outGraph, oriNode, targetNode) and dir in ['both', 'down']:
       return True
     elif nx.has_path(outGraph, targetNode, oriNode) and dir in ['both', 'up']:
@@ -774,10 +784,13 @@ class UsedItemsTracker(EMProtocol):
         outDic[protId][key] = oValue
     return outDic
 
-  def generateOutputsGraphRec(self, curProtId, outGraph=nx.DiGraph(), prevCode=None):
+  def generateOutputsGraphRec(self, curProtId, outGraph=None, prevCode=None):
     '''Generates a directed graph from a project with the protocol outputs as nodes, starting from the
     current protocol Id (curProtId) and moving upwards. Therefore, the resulting outputs graphs contains
     only those outputs necessary for the generation of the input of this protocol (default volume)'''
+    if outGraph is None:
+      import networkx as nx
+      outGraph = nx.DiGraph()
     inpKeys = self.inpDic[curProtId].keys()
     if len(inpKeys) == 0:
       if not 'root' in outGraph:
@@ -923,6 +936,8 @@ def pickNoiseOneMic(baseName, mic_fname, posName, mic_shape, outputRoot,
                     extractNoiseNumber, boxSize):
   """ Pick noise from one micrograph
   """
+  from scipy.spatial.distance import cdist
+  from xmipp3.convert import writeCoordsListToPosFname
 
   #print("pick noise one mic %s %s %s %s %s %s %s" % (baseName, mic_fname, posName, mic_shape,
                                                      #outputRoot, extractNoiseNumber, boxSize))
@@ -952,6 +967,7 @@ def pickNoiseOneMic(baseName, mic_fname, posName, mic_shape, outputRoot,
     writeCoordsListToPosFname(mic_fname, good_new_coords, outputRoot)
 
 def readPosCoordsFromFName(fname, returnAlsoMicId=False):
+  from xmipp3.convert import readPosCoordinates
   mData= readPosCoordinates(fname)
   coords=[]
   mdId=None
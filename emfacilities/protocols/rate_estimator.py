@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Processing rates of the protocol outputs, as exponentially weighted
+moving averages over fixed time windows (like the load average of unix),
+so each update takes constant time and memory whatever the session length.
+"""
+
+import math
+import time
+
+# --------------------- CONSTANTS -----------------------------------
+# window name -> seconds
+RATE_WINDOWS = [('1m', 60), ('5m', 300), ('15m', 900)]
+# window used for the ETA
+ETA_WINDOW = '5m'
+# relative difference between the 1m and 15m rates shown as a trend
+TREND_THRESHOLD = 0.1
+
+
+class OutputRate:
+    """ Rates, in items per second, of one output. """
+    __slots__ = ['count', 'lastTime', 'rates']
+
+    def __init__(self, count, now):
+        self.count = count
+        self.lastTime = now
+        # None until there are two samples
+        self.rates = None
+
+    def update(self, count, now):
+        dt = now - self.lastTime
+        if dt <= 0:
+            return
+        if count < self.count:
+            # the output was reset, start again
+            self.__init__(count, now)
+            return
+        rate = (count - self.count) / dt
+        if self.rates is None:
+            self.rates = {name: rate for name, _ in RATE_WINDOWS}
+        else:
+            for name, seconds in RATE_WINDOWS:
+                alpha = 1. - math.exp(-dt / seconds)
+                self.rates[name] += alpha * (rate - self.rates[name])
+        self.count = count
+        self.lastTime = now
+
+
+class RateEstimator:
+    """ Rates and ETA of the outputs of several protocols, keyed by
+    (protocol id, output name). """
+    def __init__(self):
+        self._outputs = {}
+
+    def update(self, protId, outputName, count, now=None):
+        """ Add a sample of the number of items of an output. """
+        now = time.time() if now is None else now
+        key = (protId, outputName)
+        output = self._outputs.get(key)
+        if output is None:
+            self._outputs[key] = OutputRate(count, now)
+        else:
+            output.update(count, now)
+
+    def getRates(self, protId, outputName):
+        """ Return a dict window -> items per minute, or None if there
+        are not enough samples. """
+        output = self._outputs.get((protId, outputName))
+        if output is None or output.rates is None:
+            return None
+        return {name: rate * 60 for name, rate in output.rates.items()}
+
+    def getTrend(self, protId, outputName):
+        """ Return 1, -1 or 0 if the last minute rate is above, below or
+        close to the 15 minutes one, None if unknown. """
+        rates = self.getRates(protId, outputName)
+        if rates is None:
+            return None
+        shortRate, longRate = rates['1m'], rates['15m']
+        if shortRate > longRate * (1 + TREND_THRESHOLD):
+            return 1
+        if shortRate < longRate * (1 - TREND_THRESHOLD):
+            return -1
+        return 0
+
+    def getEta(self, protId, outputName, target):
+        """ Seconds until the output reaches target items at the current
+        rate, None if it is not growing. """
+        output = self._outputs.get((protId, outputName))
+        if output is None or target is None:
+            return None
+        remaining = target - output.count
+        if remaining <= 0:
+            return 0.
+        rates = self.getRates(protId, outputName)
+        if rates is None or rates[ETA_WINDOW] <= 0:
+            return None
+        return remaining / rates[ETA_WINDOW] * 60
+
+    def getSummary(self, target=None):
+        """ Return a list of dicts with the count, rates (items/min), trend
+        and ETA (seconds to reach target items) of every output. """
+        summary = []
+        for (protId, outputName), output in self._outputs.items():
+            summary.append({'protId': protId,
+                            'output': outputName,
+                            'count': output.count,
+                            'rates': self.getRates(protId, outputName),
+                            'trend': self.getTrend(protId, outputName),
+                            'eta': self.getEta(protId, outputName, target)})
+        return summary
+
+    def getMetrics(self):
+        """ Return a flat dict name -> value, for the metrics exporter. """
+        metrics = {}
+        for (protId, outputName), output in self._outputs.items():
+            rates = self.getRates(protId, outputName) or {}
+            for name, rate in rates.items():
+                metrics['prot%s_%s_per_minute_%s'
+                        % (protId, outputName, name)] = rate
+        return metrics
+
+
+def formatEta(seconds):
+    """ Return seconds as a short h:mm string. """
+    if seconds is None:
+        return '-'
+    minutes = int(round(seconds / 60.))
+    return '%d:%02d' % (minutes // 60, minutes % 60)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+JavaScript, CSS and images of the HTML report, served from the report
+folder so it loads without access to external networks.
+
+The pinned versions of the libraries are kept in the templates/assets
+folder of the plugin. jQuery, Bootstrap and DataTables (MIT) are shipped
+there. Highcharts is not free software, so it is not: it is loaded from
+its CDN, and without internet access the report has no charts, unless it
+is fetched into that folder with:
+
+    python -m emfacilities.protocols.report_assets [assetsDir]
+
+When a file is missing the report falls back to its CDN url, checked
+with its integrity value when there is one.
+"""
+
+import argparse
+import base64
+import hashlib
+import os
+import sys
+import urllib.request
+
+from .report_data import atomicWrite, fileHash
+
+# --------------------- CONSTANTS -----------------------------------
+ASSETS_DIR = 'assets'
+# template field -> (file in the assets folder, CDN url, integrity).
+# The html attributes of the urls are in the <field>Attrs field
+ASSETS = {
+    'jqueryJs': ('js/jquery-3.1.0.min.js',
+                 'https://code.jquery.com/jquery-3.1.0.min.js',
+                 'sha256-cCueBR6CsyA4/9szpPfrX3s49M9vUU5BgtiJj06wt/s='),
+    'highchartsJs': ('js/highcharts-10.3.3.js',
+                     'https://code.highcharts.com/10.3.3/highcharts.js',
+                     None),
+    'highchartsExportingJs': ('js/highcharts-exporting-10.3.3.js',
+                              'https://code.highcharts.com/10.3.3/modules/exporting.js',
+                              None),
+    'bootstrapJs': ('js/bootstrap-3.3.7.min.js',
+                    'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/js/bootstrap.min.js',
+                    'sha384-Tc5IQib027qvyjSMfHjOMaLkfuWVxZxUPnCJA7l2mCWNIpG9mGCD8wGNIcPD7Txa'),
+    'bootstrapCss': ('css/bootstrap-3.3.7.min.css',
+                     'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css',
+                     'sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u'),
+    'dataTablesJs': ('js/jquery.dataTables-1.10.15.min.js',
+                     'https://cdn.datatables.net/1.10.15/js/jquery.dataTables.min.js',
+                     'sha384-NHtbx1Hf6ctHNdZmU28YfhGjB63gcU1YU64ttM+c0RxMKNBj67j+N/axpqTfdffo'),
+    'dataTablesCss': ('css/jquery.dataTables-1.10.15.min.css',
+                      'https://cdn.datatables.net/1.10.15/css/jquery.dataTables.min.css',
+                      'sha384-zm3nV72ZseVXQf1A4MjCECEgArFvdcPEUUc9iF+UBbfALpO2sUdjKGQriXbM4z+R'),
+}
+# files the css refer to by their name, relative to the css folder
+ASSET_RESOURCES = (
+    [('fonts/glyphicons-halflings-regular.%s' % ext,
+      'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/fonts/'
+      'glyphicons-halflings-regular.%s' % ext)
+     for ext in ['eot', 'svg', 'ttf', 'woff', 'woff2']] +
+    [('images/sort_%s.png' % name,
+      'https://cdn.datatables.net/1.10.15/images/sort_%s.png' % name)
+     for name in ['asc', 'desc', 'both', 'asc_disabled', 'desc_disabled']])
+# template field -> image of the scipion resources
+IMAGE_ASSETS = {'logoPng': 'scipion_logo.png',
+                'logoSmallPng': 'scipion_logo_small.png'}
+# the names of the copies change with their content, so they can be
+# cached forever (apache)
+HTACCESS = """<IfModule mod_headers.c>
+    Header set Cache-Control "public, max-age=31536000, immutable"
+</IfModule>
+"""
+
+
+def _copy(srcPath, dstPath):
+    os.makedirs(os.path.dirname(dstPath), exist_ok=True)
+    tmpPath = '%s.tmp%d' % (dstPath, os.getpid())
+    with open(srcPath, 'rb') as fin, open(tmpPath, 'wb') as fout:
+        fout.write(fin.read())
+    os.replace(tmpPath, dstPath)
+
+
+def installHashed(srcPath, dstDir, relPath):
+    """ Copy srcPath to dstDir/relPath adding the hash of its content to
+    the name, if not there yet. Return the path of the copy relative to
+    dstDir. """
+    base, ext = os.path.splitext(relPath)
+    if base.endswith('.min'):
+        base, ext = base[:-4], '.min' + ext
+    hashedPath = '%s.%s%s' % (base, fileHash(srcPath)[:10], ext)
+    dstPath = os.path.join(dstDir, hashedPath)
+    if not os.path.exists(dstPath):
+        _copy(srcPath, dstPath)
+    return hashedPath
+
+
+def installAssets(reportDir, assetsDir, log=print):
+    """ Copy the report assets to reportDir/assets.
+    :param assetsDir: folder with the files of ASSETS and ASSET_RESOURCES
+    :return: dict template field -> url of the asset, relative to
+             reportDir or the CDN url for the assets not found, and
+             <field>Attrs -> html attributes to check the CDN urls
+    """
+    from pyworkflow import findResource
+    dstDir = os.path.join(reportDir, ASSETS_DIR)
+    urls = {}
+    missing = []
+    for field, (relPath, cdnUrl, integrity) in ASSETS.items():
+        srcPath = os.path.join(assetsDir, relPath)
+        urls[field + 'Attrs'] = ''
+        if os.path.exists(srcPath):
+            urls[field] = '%s/%s' % (ASSETS_DIR,
+                                     installHashed(srcPath, dstDir, relPath))
+        else:
+            urls[field] = cdnUrl
+            if integrity:
+                urls[field + 'Attrs'] = (' integrity="%s" crossorigin='
+                                         '"anonymous"' % integrity)
+            missing.append(relPath)
+
+    for relPath, _ in ASSET_RESOURCES:
+        srcPath = os.path.join(assetsDir, relPath)
+        dstPath = os.path.join(dstDir, relPath)
+        if os.path.exists(srcPath) and not os.path.exists(dstPath):
+            _copy(srcPath, dstPath)
+
+    for field, fileName in IMAGE_ASSETS.items():
+        srcPath = findResource(fileName)
+        relPath = 'img/' + fileName
+        urls[field] = ('%s/%s' % (ASSETS_DIR,
+                                  installHashed(srcPath, dstDir, relPath))
+                       if srcPath else '')
+
+    htaccess = os.path.join(dstDir, '.htaccess')
+    if not os.path.exists(htaccess):
+        atomicWrite(htaccess, HTACCESS)
+    if missing:
+        log("Report assets not found in %s, loading them from the "
+            "internet: %s" % (assetsDir, ', '.join(missing)))
+    return urls
+
+
+def getIntegrity(data, algorithm='sha384'):
+    """ Subresource integrity value of data. """
+    return '%s-%s' % (algorithm, base64.b64encode(
+        hashlib.new(algorithm, data).digest()).decode('ascii'))
+
+
+def checkIntegrity(data, integrity):
+    """ True if data matches a subresource integrity value. """
+    return getIntegrity(data, integrity.split('-', 1)[0]) == integrity
+
+
+def downloadAssets(assetsDir, log=print):
+    """ Fetch the pinned versions of the assets into assetsDir. """
+    files = [(relPath, url, integrity)
+             for relPath, url, integrity in ASSETS.values()]
+    files += [(relPath, url, None) for relPath, url in ASSET_RESOURCES]
+    for relPath, url, integrity in files:
+        dstPath = os.path.join(assetsDir, relPath)
+        if os.path.exists(dstPath):
+            continue
+        log("Downloading %s" % url)
+        with urllib.request.urlopen(url, timeout=60) as response:
+            data = response.read()
+        if integrity and not checkIntegrity(data, integrity):
+            raise ValueError("Integrity check failed for %s" % url)
+        if integrity is None and relPath.endswith(('.js', '.css')):
+            # to be pinned in ASSETS
+            log("Integrity of %s: %s" % (url, getIntegrity(data)))
+        os.makedirs(os.path.dirname(dstPath), exist_ok=True)
+        with open(dstPath, 'wb') as f:
+            f.write(data)
+
+
+def main(argv=None):
+    defaultDir = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                              'templates', ASSETS_DIR)
+    parser = argparse.ArgumentParser(
+        description="Download the JavaScript and CSS libraries of the "
+                    "HTML report, to serve them without internet access.")
+    parser.add_argument('assetsDir', nargs='?', default=defaultDir,
+                        help="destination folder (default: %(default)s)")
+    args = parser.parse_args(argv)
+    downloadAssets(args.assetsDir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Data files of the HTML report. index.html is a static page that loads
+data/summary.js, with the charts data and the list of micrograph chunks,
+and only the data/mics_NNNN.js chunks of the table page being shown.
+The files are scripts calling reportData.* so they can be loaded with
+<script> tags also when the report is opened from disk.
+"""
+
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import threading
+
+import numpy as np
+
+from pyworkflow.utils import red
+
+# faster encoder for the data files, when available: loaded on first use,
+# False if not installed
+orjson = None
+
+# --------------------- CONSTANTS -----------------------------------
+DATA_DIR = 'data'
+SUMMARY_JS = 'summary.js'
+MIC_CHUNK_JS = 'mics_%04d.js'
+MIC_CHUNK_SIZE = 500
+MANIFEST = 'manifest.json'
+PUBLISH_TIMEOUT = 600
+
+
+def _jsonDefault(o):
+    if isinstance(o, np.integer):
+        return int(o)
+    if isinstance(o, np.floating):
+        return float(o)
+    raise TypeError("%s is not JSON serializable" % type(o).__name__)
+
+
+def _loadOrjson():
+    global orjson
+    if orjson is None:
+        try:
+            import orjson as module
+        except ImportError:
+            module = False
+        orjson = module
+    return orjson
+
+
+def toJson(obj):
+    if _loadOrjson():
+        try:
+            return orjson.dumps(obj, default=_jsonDefault,
+                                option=orjson.OPT_SERIALIZE_NUMPY
+                                | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:  # e.g. integers over 64 bits
+            pass
+    return json.dumps(obj, default=_jsonDefault, separators=(',', ':'))
+
+
+def atomicWrite(path, text):
+    """ Write text to path through a temporary file in the same folder,
+    so readers (e.g. a web server) see the old or the new file, never a
+    missing or partial one. """
+    tmpPath = '%s.tmp%d' % (path, os.getpid())
+    with open(tmpPath, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmpPath, path)
+
+
+def fileHash(path, blockSize=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ReportDataWriter:
+    """ Write the report data files, only when their content changes.
+
+    The micrograph table is split in chunks of chunkSize rows. A chunk
+    is final when it is full and all its thumbnails are ready: it will
+    not change any more, so it is not built again in later refreshes.
+    """
+    def __init__(self, reportDir, chunkSize=MIC_CHUNK_SIZE):
+        self.dataDir = os.path.join(reportDir, DATA_DIR)
+        os.makedirs(self.dataDir, exist_ok=True)
+        self.chunkSize = chunkSize
+        self.chunkVersions = []
+        self.finalChunks = 0
+        self._versions = {}  # file name -> hash of the content written
+        # (file name, version, call, json list of args) since popChanged
+        self._changed = []
+
+    def writeScript(self, fileName, call, *args):
+        """ Write fileName calling reportData.call(*args). Return the
+        version (content hash) of the file. """
+        argsJson = ','.join(toJson(a) for a in args)
+        text = 'reportData.%s(%s);\n' % (call, argsJson)
+        version = hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+        if self._versions.get(fileName) != version:
+            atomicWrite(os.path.join(self.dataDir, fileName), text)
+            self._versions[fileName] = version
+            self._changed.append((fileName, version, call,
+                                  '[%s]' % argsJson))
+        return version
+
+    def popChanged(self):
+        """ Return the (fileName, version, call, argsJson) of the files
+        written since the last call, argsJson being the json list of the
+        arguments of reportData.call. """
+        changed, self._changed = self._changed, []
+        return changed
+
+    def reset(self):
+        """ Build all the chunks again in the next writeMics. """
+        self.finalChunks = 0
+
+    def writeMics(self, numMics, numReady, getRow):
+        """ Write the chunks that may have changed.
+
+        :param numMics: number of micrographs in the table
+        :param numReady: the first numReady micrographs have thumbnails
+        :param getRow: function returning the table row of a micrograph
+        :return: list with the versions of all chunks
+        """
+        numChunks = (numMics + self.chunkSize - 1) // self.chunkSize
+        del self.chunkVersions[self.finalChunks:]
+        for c in range(self.finalChunks, numChunks):
+            first = c * self.chunkSize
+            last = min(first + self.chunkSize, numMics)
+            rows = [getRow(i) for i in range(first, last)]
+            self.chunkVersions.append(
+                self.writeScript(MIC_CHUNK_JS % c, 'setMics', c, rows))
+            if last - first == self.chunkSize and last <= numReady \
+                    and c == self.finalChunks:
+                self.finalChunks += 1
+        return list(self.chunkVersions)
+
+    def writeSummary(self, summary):
+        return self.writeScript(SUMMARY_JS, 'setSummary', summary)
+
+
+class ReportManifest:
+    """ Content hashes of the files of the report folder, saved in
+    MANIFEST. Files are only hashed again when their size or
+    modification time change. """
+    def __init__(self, reportDir):
+        self.reportDir = reportDir
+        self.path = os.path.join(reportDir, MANIFEST)
+        self.files = {}  # relative path -> [size, mtime_ns, sha1]
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.files = json.load(f)
+            except ValueError:
+                print(red("Report manifest %s is corrupt, all files will "
+                          "be published again." % self.path))
+
+    def _walk(self):
+        for root, dirs, files in os.walk(self.reportDir):
+            for name in files:
+                path = os.path.join(root, name)
+                relPath = os.path.relpath(path, self.reportDir)
+                # skip the manifest and temporary files being written
+                if relPath != MANIFEST and '.tmp' not in name \
+                        and '.part' not in name:
+                    yield relPath, path
+
+    def update(self):
+        """ Return the files added or modified since the last call. """
+        changed = []
+        current = {}
+        for relPath, path in self._walk():
+            try:
+                st = os.stat(path)
+            except OSError:  # deleted meanwhile
+                continue
+            entry = self.files.get(relPath)
+            if entry and entry[:2] == [st.st_size, st.st_mtime_ns]:
+                current[relPath] = entry
+                continue
+            digest = fileHash(path)
+            if entry is None or entry[2] != digest:
+                changed.append(relPath)
+            current[relPath] = [st.st_size, st.st_mtime_ns, digest]
+        self.files = current
+        atomicWrite(self.path, json.dumps(self.files))
+        return sorted(changed)
+
+
+class ReportPublisher:
+    """ Run the publish command in a background thread.
+
+    The command may use the tokens %(REPORT_FOLDER)s and
+    %(CHANGED_FILES)s, the path of a file listing the files to publish
+    relative to the report folder (e.g. for rsync --files-from). While a
+    publication is running new changes are queued for the next one, and
+    files of a failed publication are published again with them.
+    """
+    def __init__(self, cmd, reportDir, timeout=PUBLISH_TIMEOUT, log=print):
+        self.cmd = cmd
+        self.reportDir = reportDir
+        self.timeout = timeout
+        self.log = log
+        self.changedFilesPath = os.path.join(os.path.dirname(reportDir),
+                                             'publish_files.txt')
+        self._pending = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def isRunning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def publish(self, changedFiles):
+        """ Publish changedFiles, plus the ones queued before. Never
+        waits for a running publication. """
+        with self._lock:
+            self._pending.update(changedFiles)
+            if not self._pending or self.isRunning():
+                return False
+            files = sorted(self._pending)
+            self._pending.clear()
+        self._thread = threading.Thread(target=self._run, args=(files,),
+                                        daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self, files):
+        atomicWrite(self.changedFilesPath,
+                    ''.join('%s\n' % f for f in files))
+        cmd = self.cmd % {'REPORT_FOLDER': self.reportDir,
+                          'CHANGED_FILES': self.changedFilesPath}
+        self.log("Publishing %d changed files of the report: %s"
+                 % (len(files), cmd))
+        # in its own process group, so a timeout also stops the commands
+        # started by the shell (rsync, scp...)
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, start_new_session=True)
+        try:
+            _, err = p.communicate(timeout=self.timeout)
+            err = err.decode('utf-8', 'replace')
+            ok = p.returncode == 0
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            p.communicate()
+            err = "timeout after %s seconds" % self.timeout
+            ok = False
+        if err:
+            self.log('Error publishing the report: {}'.format(err))
+        if not ok:
+            with self._lock:
+                self._pending.update(files)
+
+    def wait(self, timeout=None):
+        """ Wait for the running publication. Return True if it ended. """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return not self.isRunning()
+
+    def flush(self, changedFiles=(), timeout=None):
+        """ Publish the queued files and changedFiles, waiting for it. """
+        if self.wait(timeout) and self.publish(changedFiles):
+            self.wait(timeout)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Pack a finished HTML report in a single zip file for archiving. The
+thumbnails are stored once per content, recompressed, under names made
+from their hash; pages and data files are deflated.
+"""
+
+import io
+import os
+import zipfile
+from functools import partial
+
+from .report_data import fileHash
+
+# --------------------- CONSTANTS -----------------------------------
+EXPORT_QUALITY = 60
+EXPORT_IMAGE_DIR = 'images'
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def recompressImage(path, quality=EXPORT_QUALITY):
+    """ Return the content of the image at path, as a progressive JPEG of
+    the given quality if that is smaller than the original. """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if os.path.splitext(path)[1].lower() not in JPEG_EXTENSIONS:
+        return data
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=quality, optimize=True,
+             progressive=True)
+    return out.getvalue() if out.tell() < len(data) else data
+
+
+class ReportArchive:
+    """ Zip file being written, that only replaces archivePath when it is
+    closed without errors. """
+    def __init__(self, archivePath, workers=None, quality=EXPORT_QUALITY):
+        self.archivePath = archivePath
+        self.workers = workers
+        self.quality = quality
+        self._tmpPath = '%s.part%d' % (archivePath, os.getpid())
+        self._zip = zipfile.ZipFile(self._tmpPath, 'w',
+                                    compression=zipfile.ZIP_DEFLATED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is None:
+            self.close()
+        else:
+            self._zip.close()
+            os.remove(self._tmpPath)
+
+    def addImages(self, baseDir, relPaths):
+        """ Add the images baseDir/relPath, recompressed in parallel.
+        Return a dict relPath -> name in the archive, images with the same
+        content share the name. """
+        names = {}
+        unique = {}  # name -> path of the first image with that content
+        for relPath in relPaths:
+            path = os.path.join(baseDir, relPath)
+            if not os.path.exists(path):
+                continue
+            ext = os.path.splitext(relPath)[1].lower()
+            name = '%s/%s%s' % (EXPORT_IMAGE_DIR, fileHash(path)[:20], ext)
+            names[relPath] = name
+            unique.setdefault(name, path)
+
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            contents = executor.map(partial(recompressImage,
+                                            quality=self.quality),
+                                    unique.values(), chunksize=16)
+            for name, data in zip(unique, contents):
+                # already compressed
+                self._zip.writestr(name, data,
+                                   compress_type=zipfile.ZIP_STORED)
+        return names
+
+    def addText(self, name, text):
+        self._zip.writestr(name, text)
+
+    def addFile(self, path, name):
+        self._zip.write(path, name)
+
+    def addTree(self, baseDir, prefix='', exclude=None):
+        """ Add the files under baseDir but those for which
+        exclude(relPath) is True. """
+        for root, dirs, files in os.walk(baseDir):
+            dirs.sort()
+            for fileName in sorted(files):
+                path = os.path.join(root, fileName)
+                relPath = os.path.relpath(path, baseDir)
+                if exclude is None or not exclude(relPath):
+                    self.addFile(path, os.path.join(prefix, relPath))
+
+    def close(self):
+        self._zip.close()
+        os.replace(self._tmpPath, self.archivePath)
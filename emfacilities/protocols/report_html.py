@@ -26,21 +26,28 @@
 # *
 # **************************************************************************
 
-import json
 import os
+import tempfile
+from functools import partial
 from os.path import join, exists, abspath, basename
 import numpy as np
-import subprocess
-import multiprocessing
 from datetime import datetime
-from statistics import median, mean
 
 from pyworkflow.protocol import getUpdatedProtocol
 import pyworkflow.utils as pwutils
 
-from pwem.emlib.image import ImageHandler
-
 from .summary_provider import SummaryProvider
+from .report_data import (ReportDataWriter, ReportManifest, ReportPublisher,
+                          atomicWrite, toJson, DATA_DIR, SUMMARY_JS,
+                          MANIFEST)
+from .defocus_planner import (DefocusHistogram, getReportEdges,
+                              DEFOCUS_PLAN_JSON)
+from .report_export import ReportArchive, EXPORT_QUALITY
+from .report_assets import installAssets, ASSETS_DIR
+from .report_template import ReportTemplate
+from .rate_estimator import RateEstimator, RATE_WINDOWS, formatEta
+from .thumbnails import (ThumbnailPool, copyImage, makeThumbnail,
+                         makePsdThumbnail, cachedImage, getThumbnailCacheDir)
 
 # --------------------- CONSTANTS -----------------------------------
 # These constants are the keys used in the ctfMonitor function
@@ -56,8 +63,52 @@ MIC_THUMBS = 'imgMicThumbs'
 PSD_THUMBS = 'imgPsdThumbs'
 SHIFT_THUMBS = 'imgShiftThumbs'
 MIC_ID = 'micId'
+# ctf values used by the charts, all the micrograph values are
+# in the table data
+CTF_CHART_KEYS = ['defocusCoverage', 'defocusCoverageLast50',
+                  'resolutionHistogram', 'timeSeries']
 DEFOCUS_HIST_BIN_WIDTH = 0.5
 RESOLUTION_HIST_BIN_WIDTH = 0.5
+# table value of the images a micrograph does not have
+NO_IMAGE = '-'
+# rate trend -> runs table symbol
+TREND_SYMBOLS = {None: '', 1: '↑', -1: '↓', 0: '--'}
+
+
+class MicThumbs:
+    """ Source images and report thumbnails of one micrograph. The paths
+    of the images a micrograph does not have are None.
+    """
+    def __init__(self, micId, micPath=None):
+        self.micId = micId
+        self.micPath = micPath
+        self.micThumb = None
+        self.shiftPath = None
+        self.shiftThumb = None
+        self.psdPath = None
+        self.psdThumb = None
+        # all its thumbnail tasks have been sent to the pool
+        self.queued = False
+        # attribute names of the thumbnails being generated
+        self.pending = set()
+        # attribute name -> reason of the thumbnails that failed
+        self.errors = {}
+
+    @property
+    def ready(self):
+        """ All its thumbnails have been generated (or failed). """
+        return self.queued and not self.pending
+
+    def getThumbs(self):
+        return [t for t in (self.micThumb, self.shiftThumb, self.psdThumb)
+                if t is not None]
+
+    def thumbDone(self, attr, error=None):
+        self.pending.discard(attr)
+        if error is not None:
+            # not shown in the report
+            self.errors[attr] = error
+            setattr(self, attr, None)
 
 
 class ReportHtml:
@@ -78,49 +129,77 @@ class ReportHtml:
         self.movieGainMonitor = movieGainMonitor
         self.lastThumbIndex = 0
         self.thumbsReady = 0
-        self.itemsAddedMovies = []
-        self.itemsAddedAlign = []
-        self.itemsAddedCTF = []
-
-        self.diffItemsAddedMovies = []
-        self.diffItemsAddedAlign = []
-        self.diffItemsAddedCTF = []
-
-        self.thresholdRate = 0.1
-
-        self.thumbPaths = {MIC_THUMBS: [],
-                           PSD_THUMBS: [],
-                           SHIFT_THUMBS: [],
-                           MIC_PATH: [],
-                           SHIFT_PATH: [],
-                           PSD_PATH: [],
-                           MIC_ID: []}
+        self.thumbsQueued = 0
+        self.thumbnailPool = ThumbnailPool(kwargs.get('thumbnailWorkers'))
+        self.micScaleFactor = kwargs.get('micScaleFactor', 6)
+        self.dataWriter = ReportDataWriter(self.reportDir)
+        self.reportHash = None
+        self.thumbnailCacheDir = getThumbnailCacheDir(protocol.getProject())
+        self.rates = RateEstimator()
+        # PipelineFunnel set by the summary monitor
+        self.funnel = None
+        # ctf monitor data of the last generate
+        self.ctfData = {}
+        # template field -> url of the js, css and images, set in setUp
+        self.assetUrls = {}
+        # ReportServer pushing the data changes, set by the summary monitor
+        self.server = None
+        # report histogram of defocusU, and the DefocusPlanner set by the
+        # summary monitor, updated with the values read since the last one
+        self.defocusHistogram = None
+        self.defocusPlanner = None
+        self._defocusRead = 0
+
+        # rows of the micrograph table
+        self.mics = []
+        # micrographs read from the input protocol and not in mics yet,
+        # by id, the last id read, the ids read and the size of the set
+        # when all its ids were last looked at
+        self._newMics = {}
+        self._lastMicId = 0
+        self._micIdsRead = set()
+        self._micSetScanned = 0
+        # thumbnail path -> (MicThumbs, attribute) of the queued thumbnails
+        self._thumbsPending = {}
+        self.hasShifts = False
+        self.hasPsds = False
 
         # Get the html template to be used, by default use the one
         # in scipion/config/templates
         self.template = self._getHTMLTemplatePath()
+        # compiled once, reloaded if the file changes
+        self.reportTemplate = ReportTemplate(self._getCustomTemplatePath(),
+                                             self._getDefaultTemplatePath())
 
         self.publishCmd = publishCmd
+        self.manifest = ReportManifest(self.reportDir)
+        self.publisher = (ReportPublisher(publishCmd, self.reportDir,
+                                          log=self.info)
+                          if publishCmd else None)
         self.refreshSecs = kwargs.get('refreshSecs', 60)
-        self.one_minute_freq_operator = self.refreshSecs / 60.0
-        self.five_minute_freq_operator = self.refreshSecs / 300.0
 
     def _getHTMLTemplatePath(self):
         """ Returns the path of the customized template at
         config/execution.summary.html or the standard scipion HTML template"""
         # Try if there is a customized template
-        template = os.path.join(os.path.dirname(pwutils.Config.SCIPION_CONFIG),
-                                'execution.summary.html')
+        template = self._getCustomTemplatePath()
 
         if not os.path.exists(template):
             print("Customized HTML template not found at %s." % template)
-            template = os.path.join(self.protocol.getPlugin().getPluginTemplateDir(),
-                                    'execution.summary.template.html')
+            template = self._getDefaultTemplatePath()
             print("Using provided one at %s." % template)
         else:
             print("Customized HTML template found at %s." % template)
         return template
 
+    def _getCustomTemplatePath(self):
+        return os.path.join(os.path.dirname(pwutils.Config.SCIPION_CONFIG),
+                            'execution.summary.html')
+
+    def _getDefaultTemplatePath(self):
+        return os.path.join(self.protocol.getPlugin().getPluginTemplateDir(),
+                            'execution.summary.template.html')
+
     def getHTMLReportText(self):
         if exists(self.template):
             return open(self.template, encoding="utf-8").read()
@@ -134,18 +213,15 @@ class ReportHtml:
             print(msg)
 
     def checkNewThumbsReady(self):
-        thumbKeys = [MIC_THUMBS]
-        if PSD_THUMBS in self.thumbPaths.keys():
-            lastThumb = min(len(self.thumbPaths[PSD_THUMBS]), len(self.thumbPaths[MIC_THUMBS]))
-            thumbKeys.append(PSD_THUMBS)
-        else:
-            lastThumb = len(self.thumbPaths[MIC_THUMBS])
-        if SHIFT_THUMBS in self.thumbPaths.keys():
-            thumbKeys.append(SHIFT_THUMBS)
-        for i in range(self.thumbsReady, lastThumb):
-            pathsReady = [exists(join(self.reportDir, self.thumbPaths[k][i])) for k in thumbKeys]
-            if all(pathsReady):
-                self.thumbsReady += 1
+        """ Apply the completion events of the thumbnail pool and return
+        how many of the first micrographs are ready. Failed thumbnails
+        are recorded in the micrograph and do not block the others. """
+        for dstPath, error in self.thumbnailPool.popCompleted():
+            mic, attr = self._thumbsPending.pop(dstPath, (None, None))
+            if mic is not None:
+                mic.thumbDone(attr, error)
+        while self.thumbsReady < len(self.mics) and self.mics[self.thumbsReady].ready:
+            self.thumbsReady += 1
         return self.thumbsReady
 
     def setUp(self):
@@ -157,21 +233,21 @@ class ReportHtml:
         pwutils.makePath(join(self.reportDir, MIC_THUMBS),
                          join(self.reportDir, PSD_THUMBS),
                          join(self.reportDir, SHIFT_THUMBS))
+        # local copies of the libraries used by the page
+        self.assetUrls = installAssets(
+            self.reportDir,
+            join(self.protocol.getPlugin().getPluginTemplateDir(), ASSETS_DIR),
+            log=self.info)
         # check if align protocol already has thumbnails
         if (hasattr(self.alignProtocol, 'doComputeMicThumbnail')
                 and self.alignProtocol._doComputeMicThumbnail()):
             self.micThumbSymlinks = True
 
-    def getThumbPaths(self, thumbsDone=0, ctfData=None, ext='jpg', micIdSet=None):
-        """Adds to self.thumbPaths the paths to the report thumbnails
-           that come from the alignment and/or ctf protocol.
-
-            ===== Params =====
-            - thumbsDone: how many thumbnails have already been generated.
-                          we will get paths starting from this index
-            - ctfData: dict resulting from ctfMonitor.getData()
-            - ext: extension of the thumbnail images. Defaults to png.
-            - micIdSet: mic indexes to use
+    def _readNewMics(self, ext='jpg'):
+        """ Read the micrographs added to the output of the alignment
+        protocol (or the ctf one) since the last call, following the ids.
+        Items added with ids lower than the last one read (e.g. by several
+        workers) are looked for when the set has more items than read.
         """
         def getMicSet(alignedProt):
             # TODO get this output names from Protocol constants
@@ -182,204 +258,284 @@ class ReportHtml:
             else:
                 return None
 
-        # get psd thumbs from ctfData
-        if ctfData is not None:
-            for i in range(thumbsDone, len(ctfData[PSD_PATH])):
-                psdPath = ctfData[PSD_PATH][i]
-                movie = basename(os.path.dirname(psdPath))
-                psdThumb = join(PSD_THUMBS, "%s_%s" % (movie, pwutils.replaceExt(basename(psdPath), ext)))
-                self.thumbPaths[PSD_THUMBS].append(psdThumb)
-                self.thumbPaths[PSD_PATH].append(psdPath)
-
-        # get alignment and mic thumbs
         if self.alignProtocol is not None:
             getMicFromCTF = False
-            updatedProt = getUpdatedProtocol(self.alignProtocol)
-            outputSet = getMicSet(updatedProt)
-            if outputSet is not None:
-                if micIdSet is None:
-                    micIdSet = list(outputSet.getIdSet())
-            else:
-                return
-
+            outputSet = getMicSet(getUpdatedProtocol(self.alignProtocol))
         elif self.ctfProtocol is not None:
             getMicFromCTF = True
-            updatedProt = getUpdatedProtocol(self.ctfProtocol)
-            if hasattr(updatedProt, 'outputCTF'):
-                outputSet = updatedProt.outputCTF
-                if micIdSet is None:
-                    micIdSet = list(outputSet.getIdSet())
-            else:
-                return
+            outputSet = getattr(getUpdatedProtocol(self.ctfProtocol), 'outputCTF', None)
         else:
             return
 
-        for micId in micIdSet[thumbsDone:]:
-            mic = outputSet[micId]
-            if getMicFromCTF:
-                mic = mic.getMicrograph()
-            if hasattr(mic, 'thumbnail'):
-                srcMicFn = abspath(mic.thumbnail.getFileName())
+        if outputSet is None:
+            return
+
+        def addMic(item):
+            micId = item.getObjId()
+            mic = item.getMicrograph() if getMicFromCTF else item
+            self._newMics[micId] = self._getMicThumbs(micId, mic, ext)
+            self._micIdsRead.add(micId)
+
+        for item in outputSet.iterItems(orderBy='id',
+                                        where='id > %d' % self._lastMicId):
+            addMic(item)
+            self._lastMicId = item.getObjId()
+        size = len(outputSet)
+        if size > len(self._micIdsRead) and size != self._micSetScanned:
+            for item in outputSet.iterItems(
+                    orderBy='id', where='id <= %d' % self._lastMicId):
+                if item.getObjId() not in self._micIdsRead:
+                    addMic(item)
+            self._micSetScanned = size
+        outputSet.close()
+
+    def _getMicThumbs(self, micId, mic, ext):
+        if hasattr(mic, 'thumbnail'):
+            srcMicFn = abspath(mic.thumbnail.getFileName())
+        else:
+            srcMicFn = abspath(mic.getFileName())
+        micThumbs = MicThumbs(micId, srcMicFn)
+        micThumbs.micThumb = join(MIC_THUMBS, pwutils.replaceExt(basename(srcMicFn), ext))
+
+        shiftPlot = (getattr(mic, 'plotCart', None) or getattr(mic, 'plotGlobal', None))
+        if shiftPlot is not None:
+            micThumbs.shiftPath = abspath(shiftPlot.getFileName())
+            micThumbs.shiftThumb = join(SHIFT_THUMBS,
+                                        pwutils.replaceExt(basename(micThumbs.shiftPath), ext))
+
+        if self.ctfProtocol is None:
+            # psd computed by the alignment protocol
+            psd = getattr(mic, 'psdJpeg', None) or getattr(mic, 'psdCorr', None)
+            if psd is not None:
+                micThumbs.psdPath = psd.getFileName()
+                micThumbs.psdThumb = join(PSD_THUMBS,
+                                          pwutils.replaceExt(basename(micThumbs.psdPath), ext))
+        return micThumbs
+
+    def getThumbPaths(self, ctfData=None, ext='jpg'):
+        """Adds to self.mics the micrographs processed since the last call,
+           with the paths to their report thumbnails, that come from the
+           alignment and/or ctf protocol.
+
+            ===== Params =====
+            - ctfData: dict resulting from ctfMonitor.getData(). If given
+                       the table follows its order and psd files.
+            - ext: extension of the thumbnail images. Defaults to jpg.
+        """
+        self._readNewMics(ext)
+
+        if ctfData is None:
+            newMics = [self._newMics.pop(micId) for micId in sorted(self._newMics)]
+        else:
+            newMics = []
+            for i in range(len(self.mics), len(ctfData['idValues'])):
+                micId = ctfData['idValues'][i]
+                # the ctf of a micrograph not in the alignment output has no mic image
+                micThumbs = self._newMics.pop(micId, None) or MicThumbs(micId)
+                psdPath = ctfData[PSD_PATH][i]
+                if psdPath:
+                    movie = basename(os.path.dirname(psdPath))
+                    micThumbs.psdPath = psdPath
+                    micThumbs.psdThumb = join(PSD_THUMBS, "%s_%s" % (movie, pwutils.replaceExt(basename(psdPath), ext)))
+                newMics.append(micThumbs)
+
+        hasShifts = self.hasShifts or any(m.shiftThumb for m in newMics)
+        hasPsds = self.hasPsds or any(m.psdThumb for m in newMics)
+        if (hasShifts, hasPsds) != (self.hasShifts, self.hasPsds):
+            # new table column, the rows written before have to change
+            self.hasShifts, self.hasPsds = hasShifts, hasPsds
+            self.dataWriter.reset()
+        self.mics.extend(newMics)
+
+    def _cached(self, render, **params):
+        """ Task function rendering through the project thumbnail cache """
+        return partial(cachedImage, cacheDir=self.thumbnailCacheDir,
+                       render=render, **params)
+
+    def getThumbnailTasks(self, i, micScaleFactor=None):
+        """ Return the (attribute, dstPath, function, srcPath) conversions
+        needed to make the thumbnails of the mic at index i of self.mics. """
+        micScaleFactor = micScaleFactor or self.micScaleFactor
+        mic = self.mics[i]
+        tasks = []
+        # mic thumbnails
+        if mic.micThumb is not None:
+            dstImgPath = join(self.reportDir, mic.micThumb)
+            if self.micThumbSymlinks:
+                tasks.append(('micThumb', dstImgPath, copyImage, mic.micPath))
             else:
-                srcMicFn = abspath(mic.getFileName())
-            micThumbFn = join(MIC_THUMBS, pwutils.replaceExt(basename(srcMicFn), ext))
-            self.thumbPaths[MIC_PATH].append(srcMicFn)
-            self.thumbPaths[MIC_THUMBS].append(micThumbFn)
-
-            shiftPlot = (getattr(mic, 'plotCart', None) or getattr(mic, 'plotGlobal', None))
-            if shiftPlot is not None:
-                shiftPath = "" if shiftPlot is None else abspath(shiftPlot.getFileName())
-                shiftCopy = "" if shiftPlot is None else join(SHIFT_THUMBS,
-                                                              pwutils.replaceExt(basename(shiftPath), ext))
-                self.thumbPaths[SHIFT_PATH].append(shiftPath)
-                self.thumbPaths[SHIFT_THUMBS].append(shiftCopy)
+                tasks.append(('micThumb', pwutils.replaceExt(dstImgPath, "jpg"),
+                              self._cached(makeThumbnail, scaleFactor=micScaleFactor),
+                              mic.micPath))
+
+        # shift plots
+        if mic.shiftThumb is not None:
+            dstImgPath = join(self.reportDir, mic.shiftThumb)
+            tasks.append(('shiftThumb', dstImgPath, copyImage, mic.shiftPath))
+
+        # Psd thumbnails, from the ctf protocol or computed
+        # by the movie alignment
+        if mic.psdThumb is not None:
+            srcImgPath = mic.psdPath
+            dstImgPath = join(self.reportDir, mic.psdThumb)
+            if self.ctfProtocol is not None:
+                tasks.append(('psdThumb', pwutils.replaceExt(dstImgPath, "jpg"),
+                              self._cached(makeThumbnail), srcImgPath))
+            elif srcImgPath.endswith('psd'):
+                tasks.append(('psdThumb', pwutils.replaceExt(dstImgPath, "jpg"),
+                              self._cached(makePsdThumbnail), srcImgPath))
             else:
-                if SHIFT_PATH in self.thumbPaths:
-                    self.thumbPaths.pop(SHIFT_PATH, None)
-                if SHIFT_THUMBS in self.thumbPaths:
-                    self.thumbPaths.pop(SHIFT_THUMBS, None)
-
-            self.thumbPaths[MIC_ID].append(micId)
-
-            if self.ctfProtocol is None:
-
-                def getMicPSDPath(mic):
-                    if hasattr(mic, 'psdJpeg'):
-                        return mic.psdJpeg.getFileName()
-                    elif hasattr(mic, 'psdCorr'):
-                        return mic.psdCorr.getFileName()
-                    else:
-                        return None
-
-                psdPath = getMicPSDPath(mic)
-                psdThumb = None
-                if psdPath is None:
-                    psdThumb = join(PSD_THUMBS, pwutils.replaceExt(basename(str(psdPath)), ext))
-                    self.thumbPaths[PSD_THUMBS].append(psdThumb)
-                    self.thumbPaths[PSD_PATH].append(psdPath)
-                else:
-                    if PSD_THUMBS in self.thumbPaths:
-                        self.thumbPaths.pop(PSD_THUMBS, None)
-                    if PSD_PATH in self.thumbPaths:
-                        self.thumbPaths.pop(PSD_PATH, None)
-
-    def generateReportImages(self, firstThumbIndex=0, micScaleFactor=6):
-        """ Function to generate thumbnails for the report. Uses data from
-        self.thumbPaths.
+                tasks.append(('psdThumb', dstImgPath, copyImage, srcImgPath))
+        return tasks
+
+    def generateReportImages(self, firstThumbIndex=0, micScaleFactor=None):
+        """ Function to generate thumbnails for the report in this process.
+        Uses data from self.mics.
 
         ===== Params =====
         - firstThumbIndex: index from which we start generating thumbnails
         - micScaleFactor: how much to reduce in size the micrographs.
+                          Defaults to self.micScaleFactor.
 
         """
-        ih = ImageHandler()
-
-        numMics = len(self.thumbPaths[MIC_PATH])
+        numMics = len(self.mics)
 
         for i in range(firstThumbIndex, numMics):
             print('Generating images for mic %d' % (i+1))
-            # mic thumbnails
-            dstImgPath = join(self.reportDir, self.thumbPaths[MIC_THUMBS][i])
-            if not exists(dstImgPath):
-                if self.micThumbSymlinks:
-                    pwutils.copyFile(self.thumbPaths[MIC_PATH][i], dstImgPath)
-                else:
-                    ih.convert(self.thumbPaths[MIC_PATH][i], pwutils.replaceExt(dstImgPath, "jpg"))
-
-            # shift plots
-            if SHIFT_THUMBS in self.thumbPaths:
-                dstImgPath = join(self.reportDir, self.thumbPaths[SHIFT_THUMBS][i])
+            for _, dstImgPath, func, srcImgPath in self.getThumbnailTasks(i, micScaleFactor):
                 if not exists(dstImgPath):
-                    pwutils.copyFile(self.thumbPaths[SHIFT_PATH][i], dstImgPath)
-
-            # Psd thumbnails
-            # If there ARE thumbnail for the PSD (no ctf protocol and
-            # moviealignment hasn't computed it
-            if PSD_THUMBS in self.thumbPaths:
-                if self.ctfProtocol is None:
-                    srcImgPath = self.thumbPaths[PSD_PATH][i]
-                    dstImgPath = join(self.reportDir, self.thumbPaths[PSD_THUMBS][i])
-                    if not exists(dstImgPath) and srcImgPath is not None:
-                        if srcImgPath.endswith('psd'):
-                            psdImg1 = ih.read(srcImgPath)
-                            psdImg1.convertPSD()
-                            psdImg1.write(dstImgPath)
-                            ih.convert(dstImgPath, pwutils.replaceExt(dstImgPath, "jpg"))
-                        else:
-                            pwutils.copyFile(srcImgPath, dstImgPath)
-                else:
-                    dstImgPath = join(self.reportDir, self.thumbPaths[PSD_THUMBS][i])
-                    if not exists(dstImgPath):
-                        ih.convert(self.thumbPaths[PSD_PATH][i], pwutils.replaceExt(dstImgPath, "jpg"))
-
-        return
-
-    def processDefocusValues(self, defocusList):
-        maxDefocus = self.protocol.maxDefocus.get()*1e-4
-        minDefocus = self.protocol.minDefocus.get()*1e-4
-        # Convert defocus values to microns
-        defocusList = [i*1e-4 for i in defocusList]
-        edges = np.arange(0, maxDefocus+DEFOCUS_HIST_BIN_WIDTH, DEFOCUS_HIST_BIN_WIDTH)
-        edges = np.insert(edges[edges > minDefocus], 0, minDefocus)
-        values, binEdges = np.histogram(defocusList, bins=edges, range=(minDefocus, maxDefocus))
-        belowThresh = 0
-        aboveThresh = 0
-        labels = ["%0.1f-%0.1f" % (x[0], x[1]) for x in zip(binEdges, binEdges[1:])]
-        for v in defocusList:
-            if v < minDefocus:
-                belowThresh += 1
-            elif v > maxDefocus:
-                aboveThresh += 1
-        zipped = list(zip(values, labels))
-        zipped[:0] = [(belowThresh, "0-%0.1f" % minDefocus)]
-        # TODO unresolved method for class Iterator in python3
-        # zipped.append((aboveThresh, "> %0.1f" % (maxDefocus)))
-
+                    func(srcImgPath, dstImgPath)
+
+    def getMicRow(self, i, ctfData):
+        """ Row of the micrograph table for the mic at index i. Thumbnails
+        not generated yet are empty strings. """
+        mic = self.mics[i]
+        row = [mic.micId]
+        for thumb, isColumn in [(mic.micThumb, True),
+                                (mic.shiftThumb, self.hasShifts),
+                                (mic.psdThumb, self.hasPsds)]:
+            if isColumn:
+                row.append(NO_IMAGE if thumb is None
+                           else thumb if mic.ready else '')
+        if 'defocusU' in ctfData:
+            row.extend([ctfData['defocusU'][i] * 1e-4,
+                        ctfData['astigmatism'][i] * 1e-1,
+                        ctfData['resolution'][i],
+                        ctfData['fitQuality'][i],
+                        ctfData['ratio'][i],
+                        ctfData['phaseShift'][i]])
+        return row
+
+    def queueReportImages(self):
+        """ Send the thumbnails not generated yet to the worker pool. Stop
+        when the pool is full, the remaining ones are sent in the next
+        refresh. """
+        numMics = len(self.mics)
+
+        while self.thumbsQueued < numMics:
+            mic = self.mics[self.thumbsQueued]
+            for attr, dst, func, src in self.getThumbnailTasks(self.thumbsQueued):
+                if attr in mic.pending or attr in mic.errors:
+                    continue
+                if not self.thumbnailPool.submit(dst, func, src):
+                    return
+                mic.pending.add(attr)
+                self._thumbsPending[dst] = (mic, attr)
+            mic.queued = True
+            self.thumbsQueued += 1
+
+    def export(self, archivePath=None, workers=None, quality=EXPORT_QUALITY):
+        """ Pack the report in a zip file, by default next to the report
+        folder. Thumbnails are deduplicated and recompressed with the
+        given JPEG quality, the table data is rewritten to point to them.
+        Call it after the last generate().
+        Return the path of the archive.
+        """
+        archivePath = archivePath or self.reportDir + '.zip'
+        thumbs = sorted({t for mic in self.mics if mic.ready
+                         for t in mic.getThumbs()})
+        thumbDirs = (MIC_THUMBS, PSD_THUMBS, SHIFT_THUMBS)
+
+        def exclude(relPath):
+            # files rewritten or not needed to open the report
+            return (relPath.split(os.sep)[0] in thumbDirs
+                    or (relPath.startswith(DATA_DIR + os.sep)
+                        and not relPath.endswith(SUMMARY_JS))
+                    or relPath == MANIFEST or '.tmp' in relPath)
+
+        with ReportArchive(archivePath, workers or self.thumbnailPool.workers,
+                           quality) as archive:
+            names = archive.addImages(self.reportDir, thumbs)
+
+            def getRow(i):
+                return [names.get(v, v) if isinstance(v, str) else v
+                        for v in self.getMicRow(i, self.ctfData)]
+
+            with tempfile.TemporaryDirectory() as tmpDir:
+                writer = ReportDataWriter(tmpDir, self.dataWriter.chunkSize)
+                writer.writeMics(len(self.mics), len(self.mics), getRow)
+                archive.addTree(join(tmpDir, DATA_DIR), prefix=DATA_DIR)
+            archive.addTree(self.reportDir, exclude=exclude)
+
+        self.info("Report exported to %s" % archivePath)
+        return archivePath
+
+    def close(self):
+        """ Stop the thumbnail workers, waiting for the queued tasks, and
+        publish the last changes. """
+        self.thumbnailPool.shutdown()
+        if self.publisher is not None:
+            self.publisher.flush(self.manifest.update(),
+                                 timeout=self.publisher.timeout)
+
+    def updateDefocus(self, defocusList):
+        """ Add the defocus values read since the last call to the
+        histogram of the report and to the planner, if any. """
+        if self.defocusHistogram is None:
+            self.defocusHistogram = DefocusHistogram(getReportEdges(
+                self.protocol.minDefocus.get(), self.protocol.maxDefocus.get(),
+                DEFOCUS_HIST_BIN_WIDTH * 1e4))
+        newValues = defocusList[self._defocusRead:]
+        self._defocusRead = len(defocusList)
+        self.defocusHistogram.add(newValues)
+        if self.defocusPlanner is not None and len(newValues):
+            self.defocusPlanner.add(newValues)
+            plan = toJson(self.defocusPlanner.getPlan())
+            atomicWrite(join(self.reportDir, DEFOCUS_PLAN_JSON), plan)
+            if self.server is not None:
+                self.server.push('defocusPlan', plan)
+
+    def getDefocusCoverage(self, recent=False):
+        """ Chart data of the report histogram as (count, label) pairs,
+        in microns, with the values below the minimum defocus first. """
+        below, counts, _ = self.defocusHistogram.getCounts(recent=recent)
+        if not recent and self.defocusHistogram.total >= 100:
+            # all but the latest ones
+            recentBelow, recentCounts, _ = \
+                self.defocusHistogram.getCounts(recent=True)
+            below -= recentBelow
+            counts -= recentCounts
+        edges = self.defocusHistogram.edges * 1e-4
+        labels = ["%0.1f-%0.1f" % x for x in zip(edges, edges[1:])]
+        zipped = list(zip(counts, labels))
+        zipped[:0] = [(below, "0-%0.1f" % edges[0])]
         return zipped
 
-    def rateCalculation(self, protocol):
-        statusRate = ''
-        if protocol == 'importMovies':
-            itemsAdded = self.itemsAddedMovies
-            diffItemsAdded = self.diffItemsAddedMovies
-        elif protocol == 'CTF':
-            itemsAdded = self.itemsAddedCTF
-            diffItemsAdded = self.diffItemsAddedCTF
-        elif protocol == 'Align':
-            itemsAdded = self.itemsAddedAlign
-            diffItemsAdded = self.diffItemsAddedAlign
-        try:
-            diffItemsAdded.append(float(itemsAdded[-1] - itemsAdded[-2]))
-            medianDiffItems = mean(diffItemsAdded[:-1])
-            threshold = self.thresholdRate * medianDiffItems
-            if medianDiffItems + threshold < diffItemsAdded[-1]:
-                statusRate = '<b> ↑ </b>'
-                #statusRate = '<b style="color:#15c51f";> ↑ </b>' #Why does it not work???
-            elif medianDiffItems - threshold > diffItemsAdded[-1]:
-                statusRate = '<b> ↓  </b>'
-            else:
-                statusRate = '<b> --  </b>'
-            rateFreq = round(diffItemsAdded[-1] * self.one_minute_freq_operator, 2)
-            rate, statusRate = self.estimateTimeRate(rateFreq, statusRate)
-            # print('itemsAdded: {}\ndiffItemsAdded: {}\nmedianDiffItems: {} threshold:{}\nrateFreq: {}, rate: {}, statusRate: {}\n'.format(
-            #     itemsAdded, diffItemsAdded, medianDiffItems, threshold, rateFreq, rate, statusRate))
-
-            return rate, statusRate
-        except Exception as e:
-            #print('e: {}'.format(e))
-            return '-', ' '
-
-    def estimateTimeRate(self, diffItem, statusRate):
-        rate1m = round(diffItem * self.one_minute_freq_operator, 2)
-        rate5m = round(diffItem * self.five_minute_freq_operator, 2)
-        if round(rate1m, 2) == 0.00 or round(rate5m, 1) == 0.00:
-            print('ZERO')
-            rate = ''
-            statusRate = 'No items added last {} secs'.format(self.refreshSecs)
+    def getOutputRate(self, obj):
+        """ Rate columns of the runs table for an output of the summary
+        provider, updating its rates. """
+        self.rates.update(obj.protId, obj.output, obj.outSize)
+        rates = self.rates.getRates(obj.protId, obj.output)
+        trend = self.rates.getTrend(obj.protId, obj.output)
+        eta = self.rates.getEta(obj.protId, obj.output,
+                                self.provider.importedSize)
+        if rates is None:
+            rate = '-'
+        elif rates['5m'] < 0.01:
+            rate = 'No items added last %d mins' % (RATE_WINDOWS[1][1] // 60)
         else:
-            rate = str(rate1m) + ' items/min'
-        #rate = str(rate5m) + ' items/5 mins'
-        return rate, statusRate
+            rate = '%s %0.2f items/min' % (TREND_SYMBOLS[trend], rates['1m'])
+        return {'rate': rate, 'rates': rates, 'eta': formatEta(eta)}
 
     def getTimeSeries(self, data):
         from .protocol_monitor_ctf import (PHASE_SHIFT, TIME_STAMP,
@@ -420,82 +576,61 @@ class ReportHtml:
         values, binEdges = np.histogram(resolutionValues, bins=edges, range=(0, maxValue))
         return list(zip(values, binEdges))
 
+    def getInlineDataArgs(self, summary, ctfData):
+        """ Template args of customized templates written for the
+        previous reports, that had all the data inline. """
+        ctfData = dict(ctfData)
+        for k, attr, isColumn in [(MIC_THUMBS, 'micThumb', True),
+                                  (SHIFT_THUMBS, 'shiftThumb', self.hasShifts),
+                                  (PSD_THUMBS, 'psdThumb', self.hasPsds)]:
+            if isColumn:
+                ctfData[k] = [(getattr(mic, attr) or '') if mic.ready else ''
+                              for mic in self.mics]
+        ctfData[MIC_ID] = [mic.micId for mic in self.mics]
+
+        args = {k: summary[k] for k in ['startTime', 'dateStr', 'projectDuration',
+                                         'projectStatus', 'scipionVersion']}
+        args.update({'acquisitionLines': ','.join(toJson(a) for a in summary['acquisition']),
+                     'runLines': ','.join(toJson(r) for r in summary['runs']),
+                     'ctfData': toJson(ctfData),
+                     'movieGainData': toJson(summary['movieGainData']),
+                     'systemData': toJson(summary['systemData'])})
+        return args
+
     def generate(self, finished):
         self.movieStatus = "-"
-        reportTemplate = self.getHTMLReportText()
-
-        if not reportTemplate:
+        if not self.reportTemplate.load():
             raise Exception("HTML template file '%s' not found. "
                             % self.template)
+        self.template = self.reportTemplate.path
 
         project = self.protocol.getProject()
         projName = project.getShortName()
-        acquisitionLines = ''
         self.provider.refreshObjects()
 
-        for item in self.provider.acquisition:
-            if not acquisitionLines == '':
-                acquisitionLines += ','
-
-            acquisitionLines += '{propertyName:"%s", propertyValue:"%s"}' % item
-        protocolName = ''
-        runLines = ''
-        wasProtocol = None
+        acquisition = [{'propertyName': name, 'propertyValue': value}
+                       for name, value in self.provider.acquisition]
+        runs = []
         for obj in self.provider.getObjects():
-            # If it's a protocol
-            isProtocol = True if obj.name else False
-
-            if isProtocol:
-                protocolName = obj.name
-                if runLines != '':
-                    runLines += ']},'
-                runLines += '{protocolName: "%s", output:[' % obj.name
+            if obj.name:  # a protocol
+                runs.append({'protocolName': obj.name, 'output': []})
             else:
-                try:
-                    if not wasProtocol:
-                        runLines += ','
-                    if obj.output.find('outputMovies') != -1 and \
-                            protocolName.find("import movies") != -1:#TODOO: si cambia el nombre del protocolo ya no entra
-                        self.itemsAddedMovies.append(obj.outSize)
-                        rate, statusRate = self.rateCalculation('importMovies')
-                    elif obj.output.find('outputCTF') != -1 and \
-                        protocolName.find("CTF") != -1 or \
-                            protocolName.find("ctf") != -1:
-                        self.itemsAddedCTF.append(obj.outSize)
-                        rate, statusRate = self.rateCalculation('CTF')
-                    elif protocolName.find("Align") != -1 or\
-                        protocolName.find("align") != -1:
-                        if obj.output.find("outputMicrographs") != -1:
-                            #print('obj.output: {}'.format(obj.output))
-                            self.itemsAddedAlign.append(obj.outSize)
-                        rate, statusRate = self.rateCalculation('Align')
-                    else:
-                        break
-                    runLines += '{name: "%s",  size: "%s", rate: "%s"}' % (
-                        obj.output,
-                        obj.outSize,
-                        str(statusRate) + ' ' + str(rate))
-                except Exception as e:
-                    print(e)
-
-            wasProtocol = isProtocol
-        # End the runLines JSON object
-        runLines += ']}'
-        print(runLines, "\n")
+                output = {'name': obj.output, 'size': str(obj.outSize)}
+                output.update(self.getOutputRate(obj))
+                runs[-1]['output'].append(output)
+
         # Ctf monitor chart data
         data = {} if self.ctfMonitor is None else self.ctfMonitor.getData()
+        self.ctfData = data
 
         if data:
-            numMicsDone = len(self.thumbPaths[PSD_THUMBS])
-            numMics = len(data[PSD_PATH])
-            numMicsToDo = numMics - numMicsDone
-            self.getThumbPaths(ctfData=data, thumbsDone=numMicsDone, micIdSet=data['idValues'])
+            self.getThumbPaths(ctfData=data)
 
-            if len(data['defocusU']) < 100:
-                data['defocusCoverage'] = self.processDefocusValues(data['defocusU'])
-            else:
-                data['defocusCoverage'] = self.processDefocusValues(data['defocusU'][:-50])
-                data['defocusCoverageLast50'] = self.processDefocusValues(data['defocusU'][-50:])
+            self.updateDefocus(data['defocusU'])
+            data['defocusCoverage'] = self.getDefocusCoverage()
+            if self.defocusHistogram.total >= 100:
+                data['defocusCoverageLast50'] = \
+                    self.getDefocusCoverage(recent=True)
 
             data['resolutionHistogram'] = self.getResolutionHistogram(data['resolution'])
 
@@ -503,75 +638,63 @@ class ReportHtml:
 
         else:
             # Thumbnails for Micrograph Table
-            numMicsDone = len(self.thumbPaths[MIC_THUMBS])
-            self.getThumbPaths(thumbsDone=numMicsDone)
-            numMics = len(self.thumbPaths[MIC_PATH])
-            numMicsToDo = numMics - numMicsDone
-
-        if numMicsToDo <= 10:
-            # we have few new images, eg streaming mode, generate thumbnails now
-            self.generateReportImages(firstThumbIndex=numMicsDone)
-        else:
-            # we have many images, generate thumbs in a separate process
-            process = multiprocessing.Process(target=self.generateReportImages,
-                                              args=(numMicsDone,))
-            process.start()
+            self.getThumbPaths()
+        numMics = len(self.mics)
+
+        self.queueReportImages()
+        if finished:
+            self.thumbnailPool.wait()
 
         # send over only thumbnails of the mics that have been fully processed
         self.thumbsReady = self.checkNewThumbsReady()
-        thumbsLoading = numMics - self.thumbsReady
-        for k in [MIC_THUMBS, SHIFT_THUMBS, PSD_THUMBS]:
-            if k in self.thumbPaths:
-                data[k] = self.thumbPaths[k][:self.thumbsReady] + ['']*thumbsLoading
-
-        data[MIC_ID] = self.thumbPaths[MIC_ID]
-
         reportFinished = self.thumbsReady == numMics
 
-        def convert(o):
-            if isinstance(o, np.int64): return int(o)
-            raise TypeError
-
-        ctfData = json.dumps(data, default=convert)
+        chunks = self.dataWriter.writeMics(
+            numMics, self.thumbsReady, lambda i: self.getMicRow(i, data))
 
         # Movie gain monitor chart data
-        data = [] if self.movieGainMonitor is None else self.movieGainMonitor.getData()
-
-        movieGainData = json.dumps(data)
+        movieGainData = [] if self.movieGainMonitor is None else self.movieGainMonitor.getData()
 
         # system monitor chart data
-        data = self.sysMonitor.getData()
-        systemData = json.dumps(data, default=convert)
+        systemData = self.sysMonitor.getData()
         tnow = datetime.now()
+        summary = {'projectName': projName,
+                   'startTime': pwutils.dateStr(project.getCreationTime(), secs=True),
+                   'dateStr': pwutils.prettyTime(dt=tnow, secs=True),
+                   'projectDuration': pwutils.prettyDelta(tnow-project.getCreationTime()),
+                   'projectStatus': "FINISHED" if finished else "RUNNING",
+                   'scipionVersion': os.environ['SCIPION_VERSION'],
+                   'acquisition': acquisition,
+                   'runs': runs,
+                   # only the values used by the charts, the rest
+                   # goes to the micrograph chunks
+                   'ctfData': {k: data[k] for k in CTF_CHART_KEYS if k in data},
+                   'movieGainData': movieGainData,
+                   'systemData': systemData,
+                   'funnel': [] if self.funnel is None else self.funnel.getStages(),
+                   'micColumns': {'shift': self.hasShifts,
+                                  'psd': self.hasPsds,
+                                  'ctf': 'defocusU' in data},
+                   'numMics': numMics,
+                   'chunkSize': self.dataWriter.chunkSize,
+                   'chunks': chunks}
+        self.dataWriter.writeSummary(summary)
+        changedData = self.dataWriter.popChanged()
+        if self.server is not None:
+            self.server.pushData(changedData)
+
+        # The page only changes with the template
         args = {'projectName': projName,
-                'startTime': pwutils.dateStr(project.getCreationTime(), secs=True),
-                'dateStr': pwutils.prettyTime(dt=tnow, secs=True),
-                'projectDuration': pwutils.prettyDelta(tnow-project.getCreationTime()),
-                'projectStatus': "FINISHED" if finished else "RUNNING",
-                'scipionVersion': os.environ['SCIPION_VERSION'],
-                'acquisitionLines': acquisitionLines,
-                'runLines': runLines,
-                'ctfData': ctfData,
-                'movieGainData': movieGainData,
-                'systemData': systemData,
-                'refresh': self.refreshSecs
-                }
-
-        self.info("Writing report html to: %s" % abspath(self.reportPath))
-        pwutils.cleanPath(self.reportPath)
-        reportFile = open(self.reportPath, 'w', encoding="utf-8")
-        reportTemplate = reportTemplate % args
-        reportFile.write(reportTemplate)
-        reportFile.close()
-
-        if self.publishCmd:
-            self.info("Publishing the report:")
-            cmd = self.publishCmd % {'REPORT_FOLDER': self.reportDir}
-            self.info(cmd)
-            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            output, err = p.communicate()
-            self.info('{}\n'.format(output.decode("utf-8")))
-            if err.decode("utf-8") != '':
-                self.info('Error publishing the report: {}'.format(err.decode("utf-8") ))
+                'refresh': self.refreshSecs}
+        args.update(self.assetUrls)
+        if 'ctfData' in self.reportTemplate.fields:
+            args.update(self.getInlineDataArgs(summary, data))
+        reportHash = self.reportTemplate.renderFile(self.reportPath, args,
+                                                    self.reportHash)
+        if reportHash != self.reportHash:
+            self.info("Report html written to: %s" % abspath(self.reportPath))
+            self.reportHash = reportHash
+
+        if self.publisher is not None:
+            self.publisher.publish(self.manifest.update())
         return reportFinished
@@ -27,18 +27,16 @@
 
 import os
 from os.path import basename
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from configparser import ConfigParser
-import urllib3
 import base64
 import time
 from emfacilities.constants import SECRETSFILE
-from .transport import Connect
 
 import pyworkflow.utils as pwutils
-from pwem.emlib.image import ImageHandler
 
 from .summary_provider import SummaryProvider
+from .thumbnails import ThumbnailCache, getThumbnailCacheDir
 
 
 # --------------------- CONSTANTS -----------------------------------
@@ -89,7 +87,9 @@ class ReportInflux:
         self.refreshSecs = kwargs.get('refreshSecs', 60)
         if self.refreshSecs < 10:
             self.refreshSecs = 10
-        self.ih = ImageHandler()
+        self.micScaleFactor = kwargs.get('micScaleFactor', 6)
+        self.thumbnailCache = ThumbnailCache(
+            getThumbnailCacheDir(protocol.getProject()))
 
         # Create a config file to store data we are going to
         # need in other iteration. So far is only used by influx
@@ -121,6 +121,7 @@ class ReportInflux:
         # I put this import here so users with no database
         # can run tratinional html report
         from influxdb import InfluxDBClient
+        import urllib3
         
         confParser = ConfigParser()
         from emfacilities.constants import (SECRETSFILE,
@@ -363,18 +364,21 @@ class ReportInflux:
             tags = {}
             tags['section'] = 'gain'
             pointsDict['tags'] = tags
-            counter = 1
-            tnow = datetime.now()
             for gain in listDictionaryGain:
-                fields = {}
-                for key in gain:
-                    fields[key] = gain[key]
+                fields = dict(gain)
+                # time the gain protocol processed the movie, several movies
+                # may share it (the summary file is read in batches) and
+                # influx keeps one point per time, so the row id is added
+                # as nanoseconds
+                timestamp = fields.pop('timestamp', None) or \
+                    datetime.now(timezone.utc)
+                pointsDict['time'] = (int(timestamp.timestamp()) * 10**9
+                                      + timestamp.microsecond * 1000
+                                      + fields['idx'])
+                if fields.get('movieId') is None:
+                    fields.pop('movieId', None)
                 pointsDict['fields'] = fields
-                # gain has no time information so I just
-                # put current time
-                localNow = tnow + timedelta(seconds=counter)
-                pointsDict['time'] = localNow # .strftime('%Y-%m-%dT%H:%M:%SZ')
-                self.client.write_points([pointsDict])
+                self.client.write_points([pointsDict], time_precision='n')
                 last_id += 1
             self.confParser.set("gain", "lastId", str(last_id))
             with open(self.confFileName, 'w') as confFile:
@@ -410,6 +414,8 @@ class ReportInflux:
 
 
     def transferFiles(self):
+        # paramiko is only needed to publish the influx report
+        from .transport import Connect
         # get images that need to  be transfered
         # in grupos of 10 images
         start_time = time.time()
@@ -447,9 +453,10 @@ class ReportInflux:
                 source.append(pwutils.replaceExt(point['psdPathLocalPng'], 'jpg'))    # psd image
                 source.append(pwutils.replaceExt(point['micPathLocalPng'], 'jpg'))    # micrograph
 
-                self.ih.convert(point['psdPathLocal'], pwutils.replaceExt(point['psdPathLocalPng'], 'jpg'))
+                self.thumbnailCache.get(point['psdPathLocal'], pwutils.replaceExt(point['psdPathLocalPng'], 'jpg'))
 
-                self.ih.convert(point['micPathLocal'], pwutils.replaceExt(point['micPathLocalPng'], 'jpg'))
+                self.thumbnailCache.get(point['micPathLocal'], pwutils.replaceExt(point['micPathLocalPng'], 'jpg'),
+                                        scaleFactor=self.micScaleFactor)
 
                 # add files to transfer list
                 target.append(os.path.join(self.projectName,
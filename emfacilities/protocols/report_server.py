@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Small HTTP server for the HTML report, running an asyncio loop in a
+background thread. Besides the files of the report folder it serves an
+/events stream (Server-Sent Events) that pushes the data of the report
+files to the open pages as soon as they change, so they do not have to
+reload them.
+"""
+
+import asyncio
+import mimetypes
+import os
+import threading
+from urllib.parse import unquote
+
+from .report_data import toJson
+
+# --------------------- CONSTANTS -----------------------------------
+EVENTS_PATH = '/events'
+# seconds between comments sent to keep idle connections open
+KEEPALIVE_SECS = 15
+# events waiting for a client before it is disconnected as too slow
+MAX_CLIENT_EVENTS = 256
+# folders whose files never change (their names have a hash)
+IMMUTABLE_DIRS = ('assets',)
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+          405: 'Method Not Allowed'}
+
+
+class ReportServer:
+    """ Serve reportDir over HTTP and push report updates to the pages.
+    The update methods can be called from any thread.
+    """
+    def __init__(self, reportDir, port, host=''):
+        """
+        :param reportDir: folder with index.html and the report files
+        :param port: TCP port to listen on, 0 to pick a free one
+        :param host: interface to bind, all of them by default
+        """
+        self.reportDir = os.path.realpath(reportDir)
+        self.host = host
+        self.port = port
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._clients = set()  # event queues of the connected pages
+
+    # ------------------- control (any thread) -----------------------
+    def start(self):
+        """ Start serving in a background thread. Raise OSError if the
+        port can not be used. """
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle, self.host or None,
+                                         self.port))
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                self._loop.close()
+                return
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    def stop(self):
+        if self._server is None:
+            return
+
+        def shutdown():
+            self._server.close()
+            for queue in self._clients:
+                queue.put_nowait(None)
+            self._loop.call_later(0.1, self._loop.stop)
+
+        self._loop.call_soon_threadsafe(shutdown)
+        self._thread.join(5)
+        self._server = None
+
+    def getUrl(self):
+        return 'http://%s:%d/' % (self.host or 'localhost', self.port)
+
+    def clientCount(self):
+        return len(self._clients)
+
+    def pushData(self, updates):
+        """ Send the data of the report files to the pages, which pass the
+        args to their reportData.call.
+        :param updates: list of (fileName, version, call, argsJson) of the
+                        files of the report data folder that changed
+        """
+        for fileName, version, call, argsJson in updates:
+            # argsJson is already serialized, do not parse it again
+            self.push('data', '{"file":%s,"version":%s,"call":%s,"args":%s}'
+                      % (toJson(fileName), toJson(version), toJson(call),
+                         argsJson))
+
+    def push(self, event, data):
+        """ Send an event to all the connected pages. data must be a
+        single line. """
+        if self._server is None:
+            return
+        message = ('event: %s\ndata: %s\n\n' % (event, data)).encode('utf-8')
+        self._loop.call_soon_threadsafe(self._broadcast, message)
+
+    # ------------------- event loop ---------------------------------
+    def _broadcast(self, message):
+        for queue in list(self._clients):
+            if queue.full():
+                # too slow, it will reconnect and reload the report
+                self._clients.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(message)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            # skip the headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if len(request) != 3:
+                await self._sendError(writer, 400)
+            elif request[0] != 'GET':
+                await self._sendError(writer, 405)
+            else:
+                path = unquote(request[1].split('?')[0])
+                if path == EVENTS_PATH:
+                    await self._sendEvents(writer)
+                else:
+                    await self._sendFile(writer, path)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _headers(self, status, headers):
+        lines = ['HTTP/1.1 %d %s' % (status, STATUS[status])]
+        lines += ['%s: %s' % h for h in headers]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _sendError(self, writer, status):
+        body = STATUS[status].encode('latin-1')
+        writer.write(self._headers(status, [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', len(body)),
+            ('Connection', 'close')]) + body)
+        await writer.drain()
+
+    def _getFilePath(self, urlPath):
+        """ Path of the file of the report folder for a url, None if it
+        is not there. """
+        path = os.path.realpath(os.path.join(self.reportDir,
+                                             urlPath.lstrip('/')))
+        if path != self.reportDir and \
+                not path.startswith(self.reportDir + os.sep):
+            return None
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        return path if os.path.isfile(path) else None
+
+    async def _sendFile(self, writer, urlPath):
+        path = self._getFilePath(urlPath)
+        if path is None:
+            await self._sendError(writer, 404)
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        relPath = os.path.relpath(path, self.reportDir)
+        cache = ('public, max-age=31536000, immutable'
+                 if relPath.split(os.sep)[0] in IMMUTABLE_DIRS
+                 else 'no-cache')
+        contentType = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        writer.write(self._headers(200, [
+            ('Content-Type', contentType),
+            ('Content-Length', len(body)),
+            ('Cache-Control', cache),
+            ('Connection', 'close')]) + body)
+        await writer.drain()
+
+    async def _sendEvents(self, writer):
+        writer.write(self._headers(200, [
+            ('Content-Type', 'text/event-stream'),
+            ('Cache-Control', 'no-cache'),
+            ('Connection', 'keep-alive')]))
+        await writer.drain()
+        queue = asyncio.Queue(MAX_CLIENT_EVENTS)
+        self._clients.add(queue)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(),
+                                                     KEEPALIVE_SECS)
+                except asyncio.TimeoutError:
+                    message = b': keepalive\n\n'
+                if message is None:
+                    break
+                writer.write(message)
+                await writer.drain()
+        finally:
+            self._clients.discard(queue)
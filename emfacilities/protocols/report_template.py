@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Compiled %-style templates of the HTML report. A template is parsed once
+into literal text and fields, reloaded only when its file changes, and
+rendered streaming the output to the destination file.
+"""
+
+import hashlib
+import os
+import re
+
+# --------------------- CONSTANTS -----------------------------------
+# %(name)s fields, with any conversion, and %% escapes
+FIELD_RE = re.compile(r'%(?:\((\w+)\)([-#0 +]*\d*(?:\.\d+)?[diouxXeEfFgGcrsa])|%)')
+
+
+def compileTemplate(text):
+    """ Return the template text as a list of literal strings and
+    (name, conversion) fields. """
+    parts = []
+    literal = []
+    pos = 0
+    for m in FIELD_RE.finditer(text):
+        literal.append(text[pos:m.start()])
+        pos = m.end()
+        if m.group(1) is None:  # %%
+            literal.append('%')
+        else:
+            parts.append(''.join(literal))
+            literal = []
+            parts.append((m.group(1), '%' + m.group(2)))
+    literal.append(text[pos:])
+    parts.append(''.join(literal))
+    return [p for p in parts if p != '']
+
+
+class ReportTemplate:
+    """ Template file that is compiled once and reloaded when its
+    modification time changes. The first existing path of paths is used,
+    so a customized template takes precedence over the default one as
+    soon as it is created. """
+    def __init__(self, *paths):
+        self.paths = paths
+        self.path = None
+        self._mtime = None
+        self._parts = []
+        self.fields = set()
+
+    def _currentPath(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                return path
+        return None
+
+    def load(self):
+        """ Compile the template if it changed. Return False if there is
+        no template file. """
+        path = self._currentPath()
+        if path is None:
+            return False
+        mtime = os.stat(path).st_mtime_ns
+        if path != self.path or mtime != self._mtime:
+            with open(path, encoding='utf-8') as f:
+                self._parts = compileTemplate(f.read())
+            self.fields = {p[0] for p in self._parts if isinstance(p, tuple)}
+            self.path, self._mtime = path, mtime
+        return True
+
+    def render(self, args, write):
+        """ Call write with each piece of the rendered template. """
+        for part in self._parts:
+            if isinstance(part, tuple):
+                name, conversion = part
+                value = args[name]
+                write(value if conversion == '%s' and isinstance(value, str)
+                      else conversion % (value,))
+            else:
+                write(part)
+
+    def renderText(self, args):
+        pieces = []
+        self.render(args, pieces.append)
+        return ''.join(pieces)
+
+    def renderFile(self, path, args, lastHash=None):
+        """ Stream the rendered template to path through a temporary file,
+        that replaces path only if its content hash is not lastHash.
+        Return the hash of the content. """
+        sha = hashlib.sha1()
+        tmpPath = '%s.tmp%d' % (path, os.getpid())
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            def write(piece):
+                sha.update(piece.encode('utf-8'))
+                f.write(piece)
+            self.render(args, write)
+        digest = sha.hexdigest()
+        if digest == lastHash:
+            os.remove(tmpPath)
+        else:
+            os.replace(tmpPath, path)
+        return digest
@@ -41,6 +41,8 @@ class SummaryProvider(TreeProvider):
                                    ('Number', 100)]
         self._parentDict = {}
         self.acquisition = []
+        # number of items imported, the target of the other outputs
+        self.importedSize = None
         self.refreshObjects()
 
     def getObjects(self):
@@ -50,12 +52,13 @@ class SummaryProvider(TreeProvider):
         objects = []
         objIds = []  # need to store ids too to avoid duplication in runs table
 
-        def addObj(objId, name, output='', size='', parent=None):
+        def addObj(objId, name, output='', size='', parent=None, protId=None):
             if objId not in objIds:
                 obj = pwobj.Object(objId=objId)
                 obj.name = name
                 obj.output = output
                 obj.outSize = size
+                obj.protId = protId
                 obj._objParent = parent
                 objIds.append(objId)
                 objects.append(obj)
@@ -73,12 +76,14 @@ class SummaryProvider(TreeProvider):
                 outSet.loadAllProperties()
                 # outSetId needs to be compound id to avoid duplicate ids
                 outSetId = '%s.%s' % (outSet.getObjId(), prot.getObjId())
-                addObj(outSetId, '', outName, outSet.getSize(), pobj)
+                addObj(outSetId, '', outName, outSet.getSize(), pobj,
+                       prot.getObjId())
                 outSet.close()
                 # Store acquisition parameters in case of the import protocol
                 # NOTE by Yaiza: we force the string containing the Å to be unicode
                 # because this is the encoding used when generating report in report_html.py
                 if isinstance(prot, ProtImportImages):
+                    self.importedSize = outSet.getSize()
                     self.acquisition = [("Microscope Voltage (kV): ",
                                          prot.voltage.get()),
                                         ("Spherical aberration (mm): ",
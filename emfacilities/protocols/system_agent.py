@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Cluster-wide system monitoring.
+
+A SystemAgent runs in each worker node, samples it with the same code used
+by the system monitor and pushes the values to the SampleCollector started
+by the monitor protocol. Samples are sent as one JSON object per line:
+
+    {"host": "gpu01", "values": {"cpu": 12.5, "mem": 40.1, ...}}
+
+To start an agent in a node (e.g. from the queue prologue):
+
+    scipion3 python -m emfacilities.protocols.system_agent \\
+        --monitor monitorhost:9122 --interval 60 --gpus "0 1"
+"""
+
+import argparse
+import json
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+# --------------------- CONSTANTS -----------------------------------
+AGENT_PORT = 9122
+MAX_LINE_LENGTH = 65536
+VALID_NAME = re.compile(r'^[\w.-]{1,64}$')
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SampleCollector:
+    """ TCP server receiving the samples pushed by the agents. Only the
+    latest sample of each host is kept until the monitor pops them.
+    """
+    def __init__(self, port=AGENT_PORT, host=''):
+        self.host = host
+        self.port = port
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def addSample(self, host, values):
+        """ Validate and store a sample, return False if it is rejected. """
+        if not isinstance(host, str) or not VALID_NAME.match(host) \
+                or not isinstance(values, dict):
+            return False
+        sample = {}
+        for name, value in values.items():
+            if isinstance(name, str) and VALID_NAME.match(name):
+                try:
+                    sample[name] = float(value)
+                except (TypeError, ValueError):
+                    pass
+        with self._lock:
+            self._samples[host] = sample
+        return True
+
+    def popSamples(self):
+        """ Return a dict host -> values with the samples received since
+        the previous call. """
+        with self._lock:
+            samples, self._samples = self._samples, {}
+        return samples
+
+    def start(self):
+        collector = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline(MAX_LINE_LENGTH)
+                    if not line:
+                        break
+                    try:
+                        sample = json.loads(line)
+                        collector.addSample(sample.get('host'),
+                                            sample.get('values'))
+                    except (ValueError, AttributeError):
+                        pass  # ignore malformed lines
+
+        self._server = _TCPServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class SystemAgent:
+    """ Sample the node where it runs and push the values to a
+    SampleCollector. Connection errors are not fatal, the agent keeps
+    sampling and reconnects in the next iteration.
+    """
+    def __init__(self, monitorHost, monitorPort, sampler,
+                 samplingInterval=60, hostName=None):
+        self.address = (monitorHost, monitorPort)
+        self.sampler = sampler
+        self.samplingInterval = samplingInterval
+        self.hostName = hostName or socket.gethostname().split('.')[0]
+        self._socket = None
+
+    def send(self, values):
+        line = json.dumps({'host': self.hostName, 'values': values}) + '\n'
+        try:
+            if self._socket is None:
+                self._socket = socket.create_connection(self.address,
+                                                        timeout=10)
+            self._socket.sendall(line.encode('utf-8'))
+            return True
+        except OSError as e:
+            print("Cannot send sample to %s:%d: %s" % (self.address + (e,)))
+            self.close()
+            return False
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def loop(self, count=None):
+        """ Sample and send forever, or count times. """
+        self.sampler.initSampling()
+        sent = 0
+        while count is None or sent < count:
+            time.sleep(self.samplingInterval)
+            self.send(self.sampler.sample())
+            sent += 1
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Push the system usage of this node to a Scipion "
+                    "system monitor.")
+    parser.add_argument('--monitor', required=True,
+                        help="host:port of the monitor collecting samples")
+    parser.add_argument('--interval', type=float, default=60,
+                        help="seconds between samples")
+    parser.add_argument('--hostname', default=None,
+                        help="name of this node in the report")
+    parser.add_argument('--gpus', default='',
+                        help='GPUs to monitor, e.g. "0 1"')
+    parser.add_argument('--nif', default=None,
+                        help="network interface to monitor")
+    parser.add_argument('--disk', action='store_true',
+                        help="monitor disk I/O")
+    parser.add_argument('--count', type=int, default=None,
+                        help="stop after this number of samples")
+    args = parser.parse_args(argv)
+
+    from .protocol_monitor_system import SystemSampler
+
+    host, port = args.monitor.rsplit(':', 1)
+    sampler = SystemSampler(doGpu=bool(args.gpus.split()),
+                            gpusToUse=args.gpus,
+                            doNetwork=args.nif is not None, nif=args.nif,
+                            doDiskIO=args.disk)
+    agent = SystemAgent(host, int(port), sampler,
+                        samplingInterval=args.interval,
+                        hostName=args.hostname)
+    try:
+        agent.loop(args.count)
+    except KeyboardInterrupt:
+        agent.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
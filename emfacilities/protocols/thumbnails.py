@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Thumbnail generation for the HTML report. Images are memory mapped and
+binned before normalizing, so only the small thumbnail is kept in memory.
+The conversions run in a persistent pool of worker processes that receives
+one task per destination file, so the same thumbnail is never generated
+twice.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3 as lite
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import pyworkflow.utils as pwutils
+from pyworkflow.utils import red
+
+from .gain_analyzer import CHUNK_ROWS, MRC_EXTENSIONS, _firstImage, openImage
+
+# --------------------- CONSTANTS -----------------------------------
+MAX_PENDING_PER_WORKER = 8
+JPEG_QUALITY = 80
+THUMBNAIL_CACHE = 'thumbnails'
+THUMBNAIL_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+def _tmpPath(dstPath):
+    base, ext = os.path.splitext(dstPath)
+    return '%s.part%d%s' % (base, os.getpid(), ext)
+
+
+def binImage(data, factor, chunkRows=CHUNK_ROWS):
+    """ Average the factor x factor blocks of a 2D array-like, reading it
+    in blocks of rows so memory mapped images are never fully loaded. """
+    factor = max(1, int(factor))
+    ny = data.shape[0] // factor * factor
+    nx = data.shape[1] // factor * factor
+    out = np.empty((ny // factor, nx // factor), dtype=np.float32)
+    step = max(1, chunkRows // factor) * factor
+    for y0 in range(0, ny, step):
+        block = np.asarray(data[y0:min(y0 + step, ny), :nx], dtype=np.float32)
+        rows = len(block) // factor
+        out[y0 // factor:y0 // factor + rows] = \
+            block.reshape(rows, factor, nx // factor, factor).mean(axis=(1, 3))
+    return out
+
+
+def toUint8(data, lowPercentile=0.5, highPercentile=99.5):
+    """ Scale to 0-255 clipping the tails of the histogram, so a few hot
+    pixels or carbon edges do not flatten the contrast. """
+    low, high = np.percentile(data, (lowPercentile, highPercentile))
+    if high <= low:
+        return np.zeros(data.shape, dtype=np.uint8)
+    data = (data - low) * (255. / (high - low))
+    return np.clip(data, 0, 255).astype(np.uint8)
+
+
+def readImage(srcPath, factor=1):
+    """ Return the first image of srcPath binned by factor. """
+    if os.path.splitext(srcPath)[1].lower() in MRC_EXTENSIONS:
+        import mrcfile
+        with mrcfile.mmap(srcPath, mode='r', permissive=True) as mrc:
+            return binImage(_firstImage(mrc.data), factor)
+    return binImage(openImage(srcPath), factor)
+
+
+def writeImage(data, dstPath, quality=JPEG_QUALITY, equalize=False):
+    """ Write data as 8 bits JPEG, or WebP if dstPath ends in .webp """
+    from PIL import Image, ImageOps
+    img = Image.fromarray(toUint8(data))
+    if equalize:
+        img = ImageOps.equalize(img)
+    tmpPath = _tmpPath(dstPath)
+    if dstPath.lower().endswith('.webp'):
+        img.save(tmpPath, format='WEBP', quality=quality, method=4)
+    else:
+        img.save(tmpPath, format='JPEG', quality=quality, optimize=True)
+    os.replace(tmpPath, dstPath)
+
+
+def makeThumbnail(srcPath, dstPath, scaleFactor=1, quality=JPEG_QUALITY,
+                  equalize=False):
+    """ Write a thumbnail of srcPath reduced scaleFactor times. The file
+    appears complete or not at all. """
+    writeImage(readImage(srcPath, scaleFactor), dstPath, quality, equalize)
+
+
+def makePsdThumbnail(srcPath, dstPath, quality=JPEG_QUALITY):
+    """ Write a centered, log scaled thumbnail of a xmipp .psd file, that
+    has the origin of frequencies in the corner. """
+    data = np.fft.fftshift(readImage(srcPath))
+    positive = data[data > 0]
+    floor = positive.min() if positive.size else 1.
+    writeImage(np.log10(np.maximum(data, floor)), dstPath, quality)
+
+
+def copyImage(srcPath, dstPath):
+    tmpPath = _tmpPath(dstPath)
+    pwutils.copyFile(srcPath, tmpPath)
+    os.replace(tmpPath, dstPath)
+
+
+def convertImage(srcPath, dstPath, index=0):
+    """ Convert srcPath, or image index of the stack, with xmipp. Used for
+    the formats and stacks the memory mapped readers do not handle. """
+    from pwem.emlib.image import ImageHandler
+    tmpPath = _tmpPath(dstPath)
+    ImageHandler().convert((index, srcPath), tmpPath)
+    os.replace(tmpPath, dstPath)
+
+
+class ThumbnailPool:
+    """ Bounded pool of worker processes with a work queue keyed by the
+    destination path of each thumbnail.
+
+    submit() ignores destinations that already exist or are queued, and
+    refuses new tasks when maxPending are waiting, so callers can
+    resubmit them later instead of growing the queue without limit.
+
+    Every destination accepted by submit() produces one completion event,
+    (dstPath, None) or (dstPath, errorMessage), read with popCompleted().
+    """
+    def __init__(self, workers=None, maxPending=None):
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.maxPending = maxPending or MAX_PENDING_PER_WORKER * self.workers
+        self._executor = None
+        self._pending = {}  # dstPath -> future
+        self._cond = threading.Condition()
+        self.done = 0
+        self.failed = {}  # dstPath -> error message
+        self._completed = deque()
+
+    def _getExecutor(self):
+        # workers are only started when there is something to do
+        if self._executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # the monitors run in threads, forking them can deadlock on
+            # locks held by other threads
+            methods = multiprocessing.get_all_start_methods()
+            method = 'forkserver' if 'forkserver' in methods else 'spawn'
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(method))
+        return self._executor
+
+    def isPending(self, dstPath):
+        with self._cond:
+            return dstPath in self._pending
+
+    def isFailed(self, dstPath):
+        with self._cond:
+            return dstPath in self.failed
+
+    def pendingCount(self):
+        with self._cond:
+            return len(self._pending)
+
+    def isFull(self):
+        return self.pendingCount() >= self.maxPending
+
+    def submit(self, dstPath, func, *args):
+        """ Queue func(*args, dstPath) unless dstPath exists or is queued.
+        Failed destinations are not retried.
+        Return False if the task was refused because the queue is full. """
+        with self._cond:
+            if dstPath in self._pending:
+                return True
+            if dstPath in self.failed:
+                self._completed.append((dstPath, self.failed[dstPath]))
+                return True
+            if os.path.exists(dstPath):
+                self._completed.append((dstPath, None))
+                return True
+            if len(self._pending) >= self.maxPending:
+                return False
+            future = self._getExecutor().submit(func, *(args + (dstPath,)))
+            self._pending[dstPath] = future
+        future.add_done_callback(lambda f: self._taskDone(dstPath, f))
+        return True
+
+    def _taskDone(self, dstPath, future):
+        error = None if future.cancelled() else future.exception()
+        with self._cond:
+            self._pending.pop(dstPath, None)
+            if error is None:
+                self.done += 1
+            else:
+                error = str(error) or type(error).__name__
+                self.failed[dstPath] = error
+            self._completed.append((dstPath, error))
+            self._cond.notify_all()
+        if error is not None:
+            print(red("Thumbnail %s could not be generated: %s"
+                      % (dstPath, error)))
+
+    def popCompleted(self):
+        """ Return the (dstPath, error) events since the last call. """
+        events = []
+        with self._cond:
+            while self._completed:
+                events.append(self._completed.popleft())
+        return events
+
+    def wait(self, timeout=None):
+        """ Wait for the queued tasks, return True if all of them ended. """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self, waitTasks=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=waitTasks)
+            self._executor = None
+
+
+def getThumbnailCacheDir(project):
+    """ Folder of the thumbnail cache shared by all protocols of project """
+    return os.path.join(project.getPath(), project.getTmpPath(THUMBNAIL_CACHE))
+
+
+class ThumbnailCache:
+    """ Rendered images of a project, stored by the hash of the source
+    path, its modification time and size, the render function and its
+    params. A changed source gets a new key and the old entry ages out:
+    the least recently used files are deleted when the cache grows over
+    maxBytes. Several processes can share the same cacheDir.
+    """
+    def __init__(self, cacheDir, maxBytes=THUMBNAIL_CACHE_MAX_BYTES):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        pwutils.makePath(cacheDir)
+        self.conn = lite.connect(os.path.join(cacheDir, 'index.sqlite'),
+                                 timeout=60, isolation_level=None)
+        self.cur = self.conn.cursor()
+        self.cur.execute("PRAGMA journal_mode=WAL")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS thumbnail("
+                         "key TEXT PRIMARY KEY,"
+                         "fileName TEXT,"
+                         "size INTEGER,"
+                         "lastUsed FLOAT)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS thumbnail_lastUsed "
+                         "ON thumbnail(lastUsed)")
+        self._createTotal()
+        self.hits = self.misses = 0
+
+    def _createTotal(self):
+        """ Total size of the files in a single row, kept by triggers so
+        all the processes sharing the cache see it. """
+        self.cur.execute("BEGIN IMMEDIATE")
+        try:
+            self.cur.execute("CREATE TABLE IF NOT EXISTS thumbnail_total("
+                             "id INTEGER PRIMARY KEY CHECK (id = 0),"
+                             "size INTEGER)")
+            # caches created before it had the total
+            self.cur.execute("INSERT OR IGNORE INTO thumbnail_total "
+                             "SELECT 0, COALESCE(SUM(size), 0) "
+                             "FROM thumbnail")
+            for event, change in [('INSERT', 'NEW.size'),
+                                  ('DELETE', '-OLD.size'),
+                                  ('UPDATE OF size',
+                                   'NEW.size - OLD.size')]:
+                self.cur.execute(
+                    "CREATE TRIGGER IF NOT EXISTS thumbnail_%s AFTER %s "
+                    "ON thumbnail BEGIN UPDATE thumbnail_total "
+                    "SET size = size + %s; END"
+                    % (event.split()[0].lower(), event, change))
+            self.cur.execute("COMMIT")
+        except lite.Error:
+            self.cur.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def getKey(srcPath, render, params):
+        st = os.stat(srcPath)
+        key = json.dumps([os.path.abspath(srcPath), st.st_mtime_ns,
+                          st.st_size, render.__module__, render.__name__,
+                          sorted(params.items())])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, srcPath, dstPath=None, render=makeThumbnail,
+            ext='jpg', **params):
+        """ Return the path of srcPath rendered with render(srcPath,
+        outPath, **params), rendering it only if it is not in the cache.
+        If dstPath is given the image is also linked (or copied) there.
+        """
+        key = self.getKey(srcPath, render, params)
+        fileName = os.path.join(key[:2], '%s.%s' % (key, ext))
+        cachedPath = os.path.join(self.cacheDir, fileName)
+        if os.path.exists(cachedPath):
+            self.hits += 1
+            self.cur.execute("UPDATE thumbnail SET lastUsed=? WHERE key=?",
+                             (time.time(), key))
+        else:
+            self.misses += 1
+            pwutils.makePath(os.path.dirname(cachedPath))
+            render(srcPath, cachedPath, **params)
+            # an upsert, REPLACE would not run the delete trigger
+            self.cur.execute("INSERT INTO thumbnail VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET "
+                             "fileName=excluded.fileName, "
+                             "size=excluded.size, "
+                             "lastUsed=excluded.lastUsed",
+                             (key, fileName, os.path.getsize(cachedPath),
+                              time.time()))
+            self.evict()
+        if dstPath is None:
+            return cachedPath
+        tmpPath = _tmpPath(dstPath)
+        try:
+            os.link(cachedPath, tmpPath)
+        except OSError:  # other file system or no hard links
+            pwutils.copyFile(cachedPath, tmpPath)
+        os.replace(tmpPath, dstPath)
+        return dstPath
+
+    def getSize(self):
+        self.cur.execute("SELECT size FROM thumbnail_total")
+        return self.cur.fetchone()[0]
+
+    def evict(self):
+        """ Delete the least recently used files over maxBytes. """
+        excess = self.getSize() - self.maxBytes
+        if excess <= 0:
+            return
+        while excess > 0:
+            self.cur.execute("SELECT key, fileName, size FROM thumbnail "
+                             "ORDER BY lastUsed LIMIT 100")
+            rows = self.cur.fetchall()
+            if not rows:
+                break
+            for key, fileName, size in rows:
+                if excess <= 0:
+                    break
+                pwutils.cleanPath(os.path.join(self.cacheDir, fileName))
+                self.cur.execute("DELETE FROM thumbnail WHERE key=?", (key,))
+                excess -= size
+
+    def close(self):
+        self.conn.close()
+
+
+_caches = {}
+
+
+def cachedImage(srcPath, dstPath, cacheDir, render=makeThumbnail, **params):
+    """ Pool task rendering srcPath through the cache at cacheDir. Each
+    worker process keeps its own connection to the cache. """
+    if cacheDir not in _caches:
+        _caches[cacheDir] = ThumbnailCache(cacheDir)
+    ext = os.path.splitext(dstPath)[1][1:] or 'jpg'
+    _caches[cacheDir].get(srcPath, dstPath, render, ext=ext, **params)
@@ -0,0 +1,82 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+"""
+Time the import of emfacilities.protocols as done by the Scipion plugin
+discovery, in a fresh interpreter each run. pwem.protocols is imported
+first so only the cost added by this plugin is measured.
+
+    scipion3 python -m emfacilities.tests.benchmarks.bench_import [-n 5]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+# modules that should only be loaded when the protocol using them runs
+HEAVY_MODULES = ['xmipp3', 'networkx', 'joblib', 'yaml', 'paramiko',
+                 'urllib3', 'pynvml', 'influxdb', 'pyarrow', 'orjson',
+                 'http.server', 'multiprocessing', 'asyncio',
+                 'emfacilities.protocols.getnifs',
+                 'emfacilities.protocols.pynvml',
+                 'emfacilities.protocols.report_server',
+                 'emfacilities.protocols.facility_dashboard',
+                 'emfacilities.protocols.columnar_export']
+
+SCRIPT = """
+import sys, time
+import pwem.protocols
+t = time.perf_counter()
+import emfacilities.protocols
+t = time.perf_counter() - t
+loaded = [m for m in %r if m in sys.modules]
+print(t, ' '.join(loaded))
+""" % (HEAVY_MODULES,)
+
+
+def timeImport():
+    """ Return (seconds, loaded heavy modules) of one import. """
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT],
+                                  stderr=subprocess.DEVNULL, text=True)
+    seconds, *loaded = out.strip().splitlines()[-1].split()
+    return float(seconds), loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', type=int, default=5, help="number of runs")
+    args = parser.parse_args(argv)
+
+    times = []
+    for _ in range(args.n):
+        seconds, loaded = timeImport()
+        times.append(seconds)
+
+    print("emfacilities.protocols import: median %.1f ms, min %.1f ms "
+          "(%d runs)" % (statistics.median(times) * 1000,
+                         min(times) * 1000, args.n))
+    print("Heavy modules loaded: %s" % (', '.join(loaded) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+"""
+Time and size of the report thumbnails of 4k x 4k and 6k x 4k float32
+micrographs, compared with a full size JPEG of the same image, that is
+what the report used to ship. Gaussian noise is the worst case for the
+compression, real micrographs give smaller files.
+
+    scipion3 python -m emfacilities.tests.benchmarks.bench_thumbnails [-n 3]
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from emfacilities.protocols.thumbnails import (makeThumbnail, readImage,
+                                               writeImage)
+
+# (rows, columns): Falcon 4, K3 and 6k x 4k micrographs
+SIZES = [(4096, 4096), (4092, 5760), (4000, 6000)]
+
+
+def writeMicrograph(path, shape):
+    import mrcfile
+    rng = np.random.default_rng(0)
+    with mrcfile.new_mmap(path, shape=shape, mrc_mode=2,
+                          overwrite=True) as mrc:
+        for y0 in range(0, shape[0], 512):
+            rows = mrc.data[y0:y0 + 512]
+            rows[:] = rng.normal(size=rows.shape)
+
+
+def timeIt(func, n):
+    times = []
+    for _ in range(n):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', type=int, default=3, help="number of runs")
+    parser.add_argument('--scale', type=int, default=6,
+                        help="micrograph scale factor of the report")
+    args = parser.parse_args(argv)
+
+    print("%-11s %-10s %10s %10s" % ('size', 'output', 'time (ms)',
+                                    'size (KB)'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for shape in SIZES:
+            src = os.path.join(tmp, 'mic.mrc')
+            writeMicrograph(src, shape)
+            outputs = [('full.jpg', lambda dst: writeImage(readImage(src),
+                                                           dst)),
+                       ('thumb.jpg', lambda dst: makeThumbnail(
+                           src, dst, args.scale)),
+                       ('thumb.webp', lambda dst: makeThumbnail(
+                           src, dst, args.scale))]
+            for name, func in outputs:
+                dst = os.path.join(tmp, name)
+                seconds = timeIt(lambda: func(dst), args.n)
+                print("%-11s %-10s %10.1f %10.1f"
+                      % ('%dx%d' % shape[::-1], name, seconds * 1000,
+                         os.path.getsize(dst) / 1024.))
+
+
+if __name__ == '__main__':
+    main()
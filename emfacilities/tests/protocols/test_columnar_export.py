@@ -0,0 +1,142 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import glob
+import os
+import sqlite3 as lite
+import unittest
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+
+from emfacilities.protocols import (CTF_LOG_SQLITE, GAIN_LOG_SQLITE,
+                                    SYSTEM_LOG_SQLITE, PipelineFunnel)
+from emfacilities.protocols.columnar_export import ColumnarExport, pa
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class TestColumnarExport(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        self.runDir = os.path.join(self.path, 'ProjectA', 'Runs',
+                                   '000100_ProtMonitorSummary')
+        pwutils.makePath(self.runDir)
+        self.outputDir = os.path.join(self.path, 'dataset')
+
+    def _addCtf(self, rows):
+        """ rows: (timestamp, defocusU) """
+        conn = lite.connect(os.path.join(self.runDir, CTF_LOG_SQLITE))
+        conn.execute("CREATE TABLE IF NOT EXISTS log(id INTEGER PRIMARY KEY "
+                     "AUTOINCREMENT, timestamp DATE, defocusU FLOAT)")
+        conn.executemany("INSERT INTO log (timestamp, defocusU) "
+                         "VALUES (?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    def _readTable(self, table, fmt='parquet'):
+        import pyarrow.dataset as ds
+        return ds.dataset(os.path.join(self.outputDir, table), format=fmt,
+                          partitioning='hive').to_table()
+
+    def test_incrementalCtf(self):
+        self._addCtf([('2024-05-01 23:59:00', 20000),
+                      ('2024-05-02 00:01:00', 21000.5)])
+        exporter = ColumnarExport(self.outputDir, tables=['ctf'])
+        self.assertEqual(exporter.exportRoots([self.path]), 2)
+        self.assertEqual(len(glob.glob(os.path.join(
+            self.outputDir, 'ctf', 'project=ProjectA', 'date=*', '*'))), 2)
+
+        # nothing new, and a new exporter continues from the saved state
+        self.assertEqual(exporter.exportRoots([self.path]), 0)
+        self._addCtf([('2024-05-02 00:02:00', 22000.)])
+        exporter = ColumnarExport(self.outputDir, tables=['ctf'])
+        self.assertEqual(exporter.exportRun(self.runDir), 1)
+
+        # the file of the date is rewritten with the new row
+        self.assertEqual(len(glob.glob(os.path.join(
+            self.outputDir, 'ctf', '*', 'date=2024-05-02', '*'))), 1)
+
+        data = self._readTable('ctf').sort_by('id').to_pydict()
+        self.assertEqual(data['id'], [1, 2, 3])
+        self.assertEqual(data['defocusU'], [20000., 21000.5, 22000.])
+        self.assertEqual(set(data['session']), {'000100_ProtMonitorSummary'})
+        # columns missing in the database are exported as nulls
+        self.assertEqual(data['resolution'], [None] * 3)
+
+        # an export that stopped before saving its state is not duplicated
+        exporter.state.clear()
+        self.assertEqual(exporter.exportRun(self.runDir), 3)
+        self.assertEqual(self._readTable('ctf').num_rows, 3)
+
+    def test_gainWithoutTimestamp(self):
+        """ Gain logs written before rows had times are not exported. """
+        conn = lite.connect(os.path.join(self.runDir, GAIN_LOG_SQLITE))
+        conn.execute("CREATE TABLE log(id INTEGER PRIMARY KEY, "
+                     "movieName TEXT, stddev FLOAT)")
+        conn.execute("INSERT INTO log (movieName, stddev) VALUES ('m', 1.)")
+        conn.commit()
+        conn.close()
+        exporter = ColumnarExport(self.outputDir, tables=['gain'])
+        self.assertEqual(exporter.exportRun(self.runDir), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.outputDir, 'gain')))
+
+    def test_systemAndLatency(self):
+        conn = lite.connect(os.path.join(self.runDir, SYSTEM_LOG_SQLITE))
+        conn.executescript(
+            "CREATE TABLE log(id INTEGER PRIMARY KEY, timestamp DATE);"
+            "CREATE TABLE log_metric(id INTEGER PRIMARY KEY, host TEXT, "
+            "                        name TEXT);"
+            "CREATE TABLE log_value(sampleId INTEGER, metricId INTEGER, "
+            "                       value FLOAT);"
+            "INSERT INTO log VALUES (1, '2024-05-01 10:00:00'), "
+            "                       (2, '2024-05-01 10:01:00');"
+            "INSERT INTO log_metric VALUES (1, '', 'cpu'), (2, '', 'mem');"
+            "INSERT INTO log_value VALUES (1, 1, 10), (1, 2, 20), "
+            "                             (2, 1, 30), (2, 2, 40);")
+        conn.commit()
+        conn.close()
+
+        funnel = PipelineFunnel(self.runDir)
+        funnel.cur.execute("INSERT INTO stage(stageId, protId, outputName, "
+                           "label) VALUES (1, 5, 'outputMovies', 'import'), "
+                           "(2, 7, 'outputCTF', 'ctf')")
+        funnel.cur.execute("INSERT INTO seen VALUES (1, 1, 100.), "
+                           "(1, 2, 110.), (2, 1, 160.)")
+        funnel.close()
+
+        exporter = ColumnarExport(self.outputDir, fmt='arrow',
+                                  tables=['system', 'latency'])
+        self.assertEqual(exporter.exportRun(self.runDir), 7)
+        self.assertEqual(exporter.exportRun(self.runDir), 0)
+
+        system = self._readTable('system', 'arrow').to_pydict()
+        self.assertEqual(sorted(system['value']), [10., 20., 30., 40.])
+        latency = self._readTable('latency', 'arrow').to_pydict()
+        self.assertEqual(sorted(zip(latency['label'], latency['latency'])),
+                         [('ctf', 60.), ('import', 0.), ('import', 0.)])
@@ -0,0 +1,73 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import numpy as np
+
+import pyworkflow.tests as pwtests
+
+from emfacilities.protocols.defocus_planner import (DefocusHistogram,
+                                                    DefocusPlanner,
+                                                    getReportEdges)
+
+
+class TestDefocusPlanner(pwtests.BaseTest):
+
+    def test_histogram(self):
+        edges = getReportEdges(1000, 40000, 5000)
+        self.assertEqual(list(edges), [1000, 5000, 10000, 15000, 20000,
+                                       25000, 30000, 35000, 40000])
+        values = np.random.RandomState(0).uniform(0, 45000, 500)
+        values[0] = 40000  # the last edge is in the last bin
+        histogram = DefocusHistogram(edges, recent=50)
+        # in several updates of different sizes
+        for start, end in [(0, 10), (10, 11), (11, 300), (300, 500)]:
+            histogram.add(values[start:end])
+
+        below, counts, above = histogram.getCounts()
+        self.assertEqual(list(counts), list(np.histogram(values, edges)[0]))
+        self.assertEqual(below, np.count_nonzero(values < 1000))
+        self.assertEqual(above, np.count_nonzero(values > 40000))
+        self.assertEqual(histogram.total, 500)
+
+        below, counts, above = histogram.getCounts(recent=True)
+        latest = values[-50:]
+        self.assertEqual(list(counts), list(np.histogram(latest, edges)[0]))
+        self.assertEqual(below + counts.sum() + above, 50)
+
+    def test_plan(self):
+        planner = DefocusPlanner(10000, 20000, 2500, numTargets=3)
+        plan = planner.getPlan()
+        self.assertEqual(len(plan['bins']), 4)
+        self.assertEqual(len(plan['underCovered']), 4)
+        self.assertEqual(plan['nextTargets'], [11250., 13750., 16250.])
+
+        planner.add([11000] * 6 + [14000] * 6 + [17000] + [30000])
+        plan = planner.getPlan()
+        self.assertEqual(plan['micrographs'], 14)
+        self.assertEqual((plan['inRange'], plan['above']), (13, 1))
+        self.assertEqual(plan['underCovered'], [[15000., 17500.],
+                                                [17500., 20000.]])
+        # the empty bin first, then the least covered ones in turn
+        self.assertEqual(plan['nextTargets'], [18750., 16250., 18750.])
+        self.assertEqual([b['deficit'] for b in plan['bins']],
+                         [0., 0., 3., 4.])
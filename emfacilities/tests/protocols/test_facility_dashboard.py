@@ -0,0 +1,198 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import json
+import os
+import sqlite3 as lite
+import time
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+
+from emfacilities.protocols import (CTF_LOG_SQLITE, GAIN_LOG_SQLITE,
+                                    SYSTEM_LOG_SQLITE)
+from emfacilities.protocols.facility_dashboard import FacilityDashboard
+
+
+class TestFacilityDashboard(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.root = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.root)
+        pwutils.makePath(self.root)
+        self.now = time.time()
+
+    def _runDir(self, project, run):
+        runDir = os.path.join(self.root, project, 'Runs', run)
+        pwutils.makePath(runDir)
+        return runDir
+
+    def _addCtf(self, runDir, rows):
+        """ rows: (seconds ago, defocusU, resolution) """
+        conn = lite.connect(os.path.join(runDir, CTF_LOG_SQLITE))
+        conn.execute("CREATE TABLE IF NOT EXISTS log(id INTEGER PRIMARY KEY "
+                     "AUTOINCREMENT, timestamp DATE, ctfID INTEGER, "
+                     "defocusU FLOAT, astigmatism FLOAT, resolution FLOAT)")
+        for ago, defocusU, resolution in rows:
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.localtime(self.now - ago))
+            conn.execute("INSERT INTO log (timestamp, defocusU, astigmatism, "
+                         "resolution) VALUES (?, ?, ?, ?)",
+                         (timestamp, defocusU, 100., resolution))
+        conn.commit()
+        conn.close()
+
+    def _addGain(self, runDir, rows):
+        """ rows: (stddev, ratio1, ratio2) """
+        conn = lite.connect(os.path.join(runDir, GAIN_LOG_SQLITE))
+        conn.execute("CREATE TABLE IF NOT EXISTS log(id INTEGER PRIMARY KEY, "
+                     "movieName TEXT, movieId INTEGER, stddev FLOAT, "
+                     "perc25 FLOAT, perc975 FLOAT, maxVal FLOAT, "
+                     "ratio1 FLOAT, ratio2 FLOAT, mtime FLOAT, "
+                     "timestamp FLOAT)")
+        conn.executemany("INSERT INTO log (stddev, ratio1, ratio2) "
+                         "VALUES (?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    def _addSystem(self, runDir, samples):
+        """ samples: list of dicts metric -> value of the local host """
+        conn = lite.connect(os.path.join(runDir, SYSTEM_LOG_SQLITE))
+        conn.execute("CREATE TABLE IF NOT EXISTS log(id INTEGER PRIMARY KEY "
+                     "AUTOINCREMENT, timestamp DATE)")
+        conn.execute("CREATE TABLE IF NOT EXISTS log_metric(id INTEGER "
+                     "PRIMARY KEY, host TEXT, name TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS log_value(sampleId INTEGER, "
+                     "metricId INTEGER, value FLOAT)")
+        for sample in samples:
+            sampleId = conn.execute("INSERT INTO log (timestamp) VALUES "
+                                    "(datetime('now'))").lastrowid
+            for name, value in sample.items():
+                row = conn.execute("SELECT id FROM log_metric WHERE host = '' "
+                                   "AND name = ?", (name,)).fetchone()
+                metricId = row[0] if row else conn.execute(
+                    "INSERT INTO log_metric (host, name) VALUES ('', ?)",
+                    (name,)).lastrowid
+                conn.execute("INSERT INTO log_value VALUES (?, ?, ?)",
+                             (sampleId, metricId, value))
+        conn.commit()
+        conn.close()
+
+    def test_incrementalRefresh(self):
+        runDir = self._runDir('ProjectA', '000100_ProtMonitorSummary')
+        self._addCtf(runDir, [(7200, 20000., 4.),
+                              (600, 22000., 3.),
+                              (60, 24000., 5.)])
+        self._addSystem(runDir, [{'cpu': 10., 'mem': 20., 'gpuUse_0': 30.},
+                                 {'cpu': 50., 'mem': 60., 'gpuUse_0': 70.,
+                                  'gpuUse_1': 90.}])
+
+        dashboard = FacilityDashboard([self.root])
+        dashboard.refresh(self.now)
+        session, = dashboard.getSummary(self.now)
+        self.assertEqual(session['project'], 'ProjectA')
+        self.assertEqual(session['micrographs'], 3)
+        self.assertEqual(session['micsPerHour'], 2)
+        self.assertEqual(session['resolution'], 4.)
+        self.assertEqual(session['defocus'], 22000.)
+        self.assertEqual(session['cpu'], 50.)
+        self.assertEqual(session['gpuUse'], 80.)
+        self.assertTrue(session['active'])
+
+        self._addCtf(runDir, [(0, 26000., 2.)])
+        self._addSystem(runDir, [{'cpu': 5.}])
+        dashboard.refresh(self.now)
+        session, = dashboard.getSummary(self.now)
+        self.assertEqual(session['micrographs'], 4)
+        self.assertEqual(session['micsPerHour'], 3)
+        self.assertEqual(session['resolution'], 3.5)
+        self.assertEqual(session['cpu'], 5.)
+        dashboard.close()
+
+    def test_unorderedCtf(self):
+        """ The ctf rows are not stored in the order of their micrographs,
+        the throughput counts all the rows in its window. """
+        runDir = self._runDir('ProjectA', '000100_ProtMonitorSummary')
+        self._addCtf(runDir, [(60, 20000., 3.),
+                              (7200, 20000., 3.),
+                              (120, 20000., 3.)])
+        dashboard = FacilityDashboard([self.root])
+        dashboard.refresh(self.now)
+        session, = dashboard.getSummary(self.now)
+        self.assertEqual(session['micsPerHour'], 2)
+        self.assertEqual(dashboard.sessions[runDir].lastMicTime,
+                         int(self.now - 60))
+        dashboard.close()
+
+    def test_gain(self):
+        runDir = self._runDir('ProjectA', '000100_ProtMonitorSummary')
+        self._addGain(runDir, [(0.01, 1.1, 4.), (0.03, 1.3, 5.)])
+        dashboard = FacilityDashboard([self.root])
+        dashboard.refresh(self.now)
+        self._addGain(runDir, [(0.02, 1.2, 6.)])
+        dashboard.refresh(self.now)
+        session, = dashboard.getSummary(self.now)
+        self.assertEqual(session['movies'], 3)
+        self.assertEqual((session['gainStd'], session['gainRatio1'],
+                          session['gainRatio2']), (0.02, 1.2, 5.))
+        self.assertIsNone(session['resolution'])
+
+        outputDir = self.getOutputPath(self._testMethodName, 'dashboard')
+        dashboard.write(outputDir, self.now)
+        with open(os.path.join(outputDir, 'index.html')) as f:
+            self.assertIn('<TD>0.020</TD>', f.read())
+        dashboard.close()
+
+    def test_sessions(self):
+        self._addCtf(self._runDir('ProjectA', '000100_ProtMonitorSummary'),
+                     [(60, 20000., 3.)])
+        self._addSystem(self._runDir('ProjectB', '000200_ProtMonitorSummary'),
+                        [{'cpu': 1.}])
+        # a single project folder can be given too
+        dashboard = FacilityDashboard([self.root,
+                                       os.path.join(self.root, 'ProjectB')])
+        dashboard.refresh(self.now)
+        # old sessions are listed after the active ones
+        sessions = dashboard.getSummary(self.now + 3600)
+        self.assertEqual([s['project'] for s in sessions],
+                         ['ProjectA', 'ProjectB'])
+        self.assertFalse(any(s['active'] for s in sessions))
+
+        outputDir = self.getOutputPath(self._testMethodName, 'dashboard')
+        dashboard.write(outputDir, self.now)
+        with open(os.path.join(outputDir, 'dashboard.json')) as f:
+            data = json.load(f)
+        self.assertEqual(len(data['sessions']), 2)
+        with open(os.path.join(outputDir, 'index.html')) as f:
+            page = f.read()
+        self.assertIn('000200_ProtMonitorSummary', page)
+        self.assertIn('refresh', page)
+
+        pwutils.cleanPath(os.path.join(self.root, 'ProjectB'))
+        dashboard.refresh(self.now)
+        self.assertEqual(len(dashboard.sessions), 1)
+        dashboard.close()
@@ -0,0 +1,71 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+from urllib.request import Request, urlopen
+
+import pyworkflow.tests as pwtests
+
+from emfacilities.protocols.metrics_exporter import (MetricsExporter,
+                                                     OPENMETRICS_TYPE)
+
+
+class TestMetricsExporter(pwtests.BaseTest):
+    """ Scrape the exporter with a plain HTTP client. """
+
+    def setUp(self):
+        self.exporter = MetricsExporter(0, host='127.0.0.1',
+                                        labels={'project': 'test'}).start()
+
+    def tearDown(self):
+        self.exporter.stop()
+
+    def _scrape(self, **headers):
+        request = Request(self.exporter.getUrl(), headers=headers)
+        with urlopen(request, timeout=5) as response:
+            return (response.headers['Content-Type'],
+                    response.read().decode('utf-8'))
+
+    def test_scrape(self):
+        self.exporter.update('system', {'cpu': 12.5,
+                                        ('gpu_mem', (('gpu', 0),)): 50,
+                                        ('gpu_mem', (('gpu', 1),)): 25})
+        self.exporter.update('ctf', {'defocusU': 15000., 'path': 'ignored'})
+
+        contentType, text = self._scrape(
+            Accept='application/openmetrics-text')
+        self.assertEqual(contentType, OPENMETRICS_TYPE)
+        self.assertIn('scipion_system_cpu{project="test"} 12.5', text)
+        self.assertIn('scipion_system_gpu_mem{project="test",gpu="0"} 50.0',
+                      text)
+        self.assertIn('scipion_system_gpu_mem{project="test",gpu="1"} 25.0',
+                      text)
+        self.assertEqual(text.count('# TYPE scipion_system_gpu_mem gauge'), 1)
+        self.assertIn('scipion_ctf_defocusU{project="test"} 15000.0', text)
+        self.assertNotIn('path', text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+        # the last update replaces the previous values of the monitor
+        self.exporter.update('system', {'cpu': 80})
+        _, text = self._scrape()
+        self.assertIn('scipion_system_cpu{project="test"} 80.0', text)
+        self.assertNotIn('gpu_mem', text)
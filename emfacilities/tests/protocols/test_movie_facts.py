@@ -0,0 +1,114 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import os
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+import pwem.objects as emobj
+
+from emfacilities.protocols.movie_facts import MovieFacts, alignmentShifts
+
+
+class TestMovieFacts(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+        self.facts = MovieFacts(self.path)
+
+    def tearDown(self):
+        self.facts.close()
+
+    def test_join(self):
+        """ Values from different monitors end in the same row. """
+        self.facts.updateMany([{'movieId': i, 'gainStddev': 0.01 * i}
+                               for i in range(1, 6)])
+        self.facts.updateMany([{'movieId': i, 'resolution': 10. - i,
+                                'unknown': 1}
+                               for i in range(1, 6)])
+        self.facts.update(3, maxShift=7.5)
+
+        movie = self.facts.getMovie(3)
+        self.assertAlmostEqual(movie['gainStddev'], 0.03)
+        self.assertEqual(movie['resolution'], 7.)
+        self.assertEqual(movie['maxShift'], 7.5)
+
+        worst = self.facts.getWorst('resolution', limit=2)
+        self.assertEqual([m['movieId'] for m in worst], [1, 2])
+        best = self.facts.getWorst('resolution', limit=2, descending=False)
+        self.assertEqual([m['movieId'] for m in best], [5, 4])
+        self.assertEqual(len(self.facts.getWorst('maxShift')), 1)
+        self.assertRaises(ValueError, self.facts.getWorst, 'movieId; --')
+
+    def test_alignmentShifts(self):
+        movie = emobj.Movie(location='movie.mrc')
+        self.assertEqual(alignmentShifts(movie), (None, None))
+        movie.setAlignment(emobj.MovieAlignment(first=1, last=4,
+                                                xshifts=[0, 3, 3, 4],
+                                                yshifts=[0, 4, 4, 4]))
+        self.assertEqual(alignmentShifts(movie), (6., 5.))
+
+    def test_unorderedAlignment(self):
+        """ Movies appended with a lower id than the last one read are
+        also joined. """
+        fileName = os.path.join(self.path, 'movies.sqlite')
+
+        class FakeAlignProtocol:
+            outputMovies = None
+
+        def addMovies(movieIds):
+            exists = os.path.exists(fileName)
+            movies = emobj.SetOfMovies(filename=fileName)
+            if exists:
+                movies.enableAppend()
+            movies.setSamplingRate(1.)
+            for movieId in movieIds:
+                movie = emobj.Movie(location='movie%d.mrc' % movieId,
+                                    objId=movieId)
+                movie.setAlignment(emobj.MovieAlignment(
+                    first=1, last=2, xshifts=[0, movieId],
+                    yshifts=[0, 0]))
+                movies.append(movie)
+            movies.write()
+            FakeAlignProtocol.outputMovies = movies
+
+        addMovies([1, 2, 5])
+        self.facts.readAlignment(FakeAlignProtocol)
+        addMovies([3, 4])
+        self.facts.readAlignment(FakeAlignProtocol)
+        for movieId in range(1, 6):
+            self.assertEqual(self.facts.getMovie(movieId)['totalShift'],
+                             movieId)
+
+        # a new instance starts from the stored movies
+        self.facts.close()
+        self.facts = MovieFacts(self.path)
+        addMovies([6])
+        self.facts.readAlignment(FakeAlignProtocol)
+        self.assertEqual(self.facts.getMovie(6)['movieName'], 'movie6.mrc')
@@ -0,0 +1,172 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import os
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+import pwem.objects as emobj
+
+from emfacilities.protocols.pipeline_funnel import (PipelineFunnel,
+                                                    formatSeconds)
+
+
+class TestPipelineFunnel(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+        self.funnel = PipelineFunnel(self.path)
+
+    def tearDown(self):
+        self.funnel.close()
+
+    def _addMics(self, micIds):
+        fileName = self.getOutputPath(self._testMethodName, 'mics.sqlite')
+        exists = os.path.exists(fileName)
+        mics = emobj.SetOfMicrographs(filename=fileName)
+        if exists:
+            mics.enableAppend()
+        mics.setSamplingRate(1.)
+        for micId in micIds:
+            mics.append(emobj.Micrograph(location='mic%d.mrc' % micId,
+                                         objId=micId))
+        mics.write()
+        return mics
+
+    def _addParticles(self, micIds):
+        fileName = self.getOutputPath(self._testMethodName, 'parts.sqlite')
+        exists = os.path.exists(fileName)
+        parts = emobj.SetOfParticles(filename=fileName)
+        if exists:
+            parts.enableAppend()
+        parts.setSamplingRate(1.)
+        for micId in micIds:
+            # two particles per micrograph
+            for _ in range(2):
+                coord = emobj.Coordinate()
+                coord.setMicId(micId)
+                part = emobj.Particle(location='parts.mrcs')
+                part.setCoordinate(coord)
+                parts.append(part)
+        parts.write()
+        return parts
+
+    def test_funnel(self):
+        self.funnel.readOutput(1, 'outputMicrographs',
+                               self._addMics([1, 2, 3]), now=0.)
+        self.funnel.readOutput(2, 'outputParticles',
+                               self._addParticles([1]), now=60.)
+        self.funnel.readOutput(1, 'outputMicrographs',
+                               self._addMics([4]), now=120.)
+        self.funnel.readOutput(2, 'outputParticles',
+                               self._addParticles([2, 3]), now=300.)
+
+        mics, parts = self.funnel.getStages()
+        self.assertEqual((mics['label'], mics['count'], mics['backlog']),
+                         ('outputMicrographs', 4, 0))
+        # micrograph 4 has no particles yet
+        self.assertEqual((parts['count'], parts['backlog']), (3, 1))
+        # percentiles of the histogram bins, 1% wide
+        self.assertAlmostEqual(parts['latency'][0], 300., delta=3.)
+        self.assertAlmostEqual(parts['latency'][-1], 300., delta=3.)
+        self.assertAlmostEqual(parts['stageLatency'][0], 300., delta=3.)
+        self.assertEqual(mics['latency'], [0., 0., 0.])
+        self.assertEqual(formatSeconds(300.), '5:00')
+
+    def test_earlierStage(self):
+        """ A micrograph seen in a stage before the ones already stored
+        moves their latencies. """
+        self.funnel.readOutput(2, 'outputParticles',
+                               self._addParticles([1]), now=600.)
+        self.funnel.readOutput(1, 'outputMicrographs',
+                               self._addMics([1]), now=0.)
+        mics, parts = self.funnel.getStages()
+        self.assertEqual(mics['label'], 'outputMicrographs')
+        self.assertAlmostEqual(parts['latency'][0], 600., delta=6.)
+        self.funnel.cur.execute("SELECT SUM(count) FROM latency")
+        self.assertEqual(self.funnel.cur.fetchone()[0], 4)
+
+    def _writeClasses(self, parts, partIds):
+        """ Write again the classes file, one class per list of ids. """
+        fileName = self.getOutputPath(self._testMethodName, 'classes.sqlite')
+        pwutils.cleanPath(fileName)
+        classes = emobj.SetOfClasses2D(filename=fileName)
+        classes.setImages(parts)
+        for classId, ids in enumerate(partIds, 1):
+            cls = emobj.Class2D(objId=classId)
+            cls.setAcquisition(parts.getAcquisition())
+            classes.append(cls)
+            for partId in ids:
+                cls.append(parts[partId])
+            classes.update(cls)
+        classes.write()
+        return classes
+
+    def test_classes(self):
+        """ Only the particles added to the classes since the last time
+        they changed are read. """
+        parts = self._addParticles([1, 2, 3])
+        self.funnel.readOutput(3, 'outputClasses',
+                               self._writeClasses(parts, [[1, 2, 3, 4]]),
+                               now=0.)
+        classes = self._writeClasses(parts, [[1, 3, 5], [2, 4, 6]])
+        self.funnel.readOutput(3, 'outputClasses', classes, now=10.)
+        self.funnel.cur.execute("SELECT micId, time FROM seen ORDER BY micId")
+        self.assertEqual(self.funnel.cur.fetchall(),
+                         [(1, 0.), (2, 0.), (3, 10.)])
+        self.funnel.cur.execute("SELECT lastId FROM stage")
+        self.assertEqual(self.funnel.cur.fetchone()[0], 6)
+
+    def test_reopen(self):
+        """ Items already stored are not read again. """
+        self.funnel.readOutput(1, 'outputMicrographs',
+                               self._addMics([1, 2]), now=0.)
+        self.funnel.close()
+        self.funnel = PipelineFunnel(self.path)
+        self.funnel.readOutput(1, 'outputMicrographs',
+                               self._addMics([3]), now=10.)
+        self.funnel.cur.execute("SELECT micId, time FROM seen ORDER BY micId")
+        self.assertEqual(self.funnel.cur.fetchall(),
+                         [(1, 0.), (2, 0.), (3, 10.)])
+
+    def test_unorderedItems(self):
+        """ Micrographs appended with lower ids than the last one read
+        are counted too. """
+        self.funnel.readOutput(1, 'outputMicrographs',
+                               self._addMics([1, 2, 5]), now=0.)
+        self.funnel.readOutput(1, 'outputMicrographs',
+                               self._addMics([3, 4]), now=10.)
+        self.funnel.readOutput(1, 'outputMicrographs',
+                               self._addMics([6]), now=20.)
+        self.funnel.cur.execute("SELECT micId, time FROM seen ORDER BY micId")
+        self.assertEqual(self.funnel.cur.fetchall(),
+                         [(1, 0.), (2, 0.), (3, 10.), (4, 10.), (5, 0.),
+                          (6, 20.)])
+        self.funnel.cur.execute("SELECT count, itemCount FROM stage")
+        self.assertEqual(self.funnel.cur.fetchone(), (6, 6))
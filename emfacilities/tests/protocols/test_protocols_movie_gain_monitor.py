@@ -0,0 +1,247 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import os
+
+import mrcfile
+import numpy as np
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+from pyworkflow.protocol.constants import STATUS_RUNNING
+
+from emfacilities.protocols.protocol_monitor_movie_gain import (
+    MonitorMovieGain, GAIN_SUMMARY, GAIN_WARNINGS)
+from emfacilities.protocols.gain_analyzer import GainImageAnalyzer, GainTrend
+
+# lines as written by the xmipp movie gain protocol
+GOOD = "movie_%06d_residual: 0.016680 0.976350 1.028174 17.423561\n"
+BAD = "movie_%06d_residual: 0.056680 0.976350 1.028174 17.423561\n"
+
+
+class FakeGainProtocol:
+    """ Just what the monitor needs from the gain protocol. """
+    def __init__(self, path):
+        self.path = path
+
+    def _getPath(self, *paths):
+        return os.path.join(self.path, *paths)
+
+    def _getExtraPath(self, *paths):
+        return os.path.join(self.path, 'extra', *paths)
+
+    def getStatus(self):
+        return STATUS_RUNNING
+
+
+def writeSpider(path, image):
+    """ Single SPIDER image, like the xmipp .xmp residual gains. """
+    ny, nx = image.shape
+    header = np.zeros(256, dtype='<f4')
+    header[[0, 1, 4, 11, 21]] = [1, ny, 1, nx, header.nbytes]
+    with open(path, 'wb') as f:
+        header.tofile(f)
+        image.astype('<f4').tofile(f)
+
+
+class ListNotifier:
+    def __init__(self):
+        self.messages = []
+
+    def notify(self, title, message):
+        self.messages.append(message)
+
+
+class TestMovieGainMonitor(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+        self.fnSummary = os.path.join(self.path, GAIN_SUMMARY)
+        self.notifier = ListNotifier()
+
+    def _createMonitor(self, influx=False):
+        monitor = MonitorMovieGain(FakeGainProtocol(self.path),
+                                   workingDir=self.path,
+                                   email=self.notifier,
+                                   stddevValue=0.04, ratio1Value=1.15,
+                                   ratio2Value=100, influx=influx)
+        monitor.initLoop()
+        return monitor
+
+    def _append(self, text):
+        with open(self.fnSummary, 'a') as f:
+            f.write(text)
+
+    def test_everyMovieIsChecked(self):
+        monitor = self._createMonitor()
+        # two bad movies before the first step, the last one is good
+        self._append(BAD % 1 + BAD % 2 + GOOD % 3)
+        monitor.step()
+        self.assertEqual(len(self.notifier.messages), 2)
+
+        # a partially written line is not parsed until it is complete
+        self._append((BAD % 4)[:10])
+        monitor.step()
+        self.assertEqual(len(monitor.getData()['idValues']), 3)
+        self._append((BAD % 4)[10:])
+        monitor.step()
+        self.assertEqual(len(self.notifier.messages), 3)
+        self.assertEqual(monitor.getData()['idValues'], [0, 1, 2, 3])
+
+    def test_offsetIsPersistent(self):
+        self._append(BAD % 1 + GOOD % 2)
+        self._createMonitor().step()
+        self.assertEqual(len(self.notifier.messages), 1)
+
+        # a new monitor does not warn twice about the same movies
+        monitor = self._createMonitor(influx=True)
+        self._append(GOOD % 3)
+        monitor.step()
+        self.assertEqual(len(self.notifier.messages), 1)
+        rows = monitor.getData(lastId=1)
+        self.assertEqual([r['idx'] for r in rows], [2, 3])
+        self.assertEqual([r['movieId'] for r in rows], [2, 3])
+        self.assertAlmostEqual(rows[-1]['timestamp'].timestamp(),
+                               os.path.getmtime(self.fnSummary), places=3)
+
+    def test_idsAfterTruncation(self):
+        """ A summary file parsed again gets new ids, and unparseable
+        lines do not take any. """
+        monitor = self._createMonitor(influx=True)
+        self._append(GOOD % 1 + 'movie_000002_residual: -\n' + GOOD % 3)
+        monitor.step()
+        self.assertEqual([r['idx'] for r in monitor.getData(lastId=0)],
+                         [1, 2])
+
+        os.remove(self.fnSummary)
+        self._append(GOOD % 4)
+        monitor.step()
+        rows = monitor.getData(lastId=2)
+        self.assertEqual([(r['idx'], r['movieId']) for r in rows], [(3, 4)])
+
+    def test_analyzeImages(self):
+        protocol = FakeGainProtocol(self.path)
+        protocol.getResidualGainPath = lambda movieId: os.path.join(
+            self.path, 'movie_%06d_residual_gain.mrc' % movieId)
+        rng = np.random.default_rng(0)
+        for movieId in range(1, 9):
+            gain = rng.normal(1., 0.01, (64, 64)).astype(np.float32)
+            if movieId > 5:
+                gain[:movieId, 0] = 2.  # more hot pixels each movie
+            with mrcfile.new(protocol.getResidualGainPath(movieId),
+                             data=gain, overwrite=True):
+                pass
+
+        monitor = MonitorMovieGain(protocol, workingDir=self.path,
+                                   email=self.notifier, stddevValue=1,
+                                   ratio1Value=10, ratio2Value=100,
+                                   analyzeImages=True)
+        monitor.trend = GainTrend(window=3, factor=2.)
+        monitor.initLoop()
+        # a movie without id is not analyzed
+        self._append(GOOD.replace('%06d', 'x'))
+        for movieId in range(1, 9):
+            self._append(GOOD % movieId)
+            monitor.step()
+            # warned once, when the latest lines double the first ones
+            self.assertEqual(len(self.notifier.messages),
+                             1 if movieId >= 6 else 0)
+        self.assertEqual([c[0] for c in monitor._getTrendCounts()],
+                         [1, 2, 3, 6, 7, 8])
+
+    def test_analyzeResidualSummary(self):
+        """ Summary lines and residual gains as written by xmipp. """
+        protocol = FakeGainProtocol(self.path)
+        pwutils.makePath(protocol._getExtraPath())
+        rng = np.random.default_rng(0)
+        for movieId in range(1, 5):
+            gain = rng.normal(1., 0.01, (64, 48))
+            gain[:movieId * 4, 0] = 2.  # growing hot pixels
+            writeSpider(protocol._getExtraPath(
+                'movie_%06d_residual_gain.xmp' % movieId), gain)
+        monitor = MonitorMovieGain(protocol, workingDir=self.path,
+                                   email=self.notifier, stddevValue=1,
+                                   ratio1Value=10, ratio2Value=100,
+                                   analyzeImages=True)
+        monitor.trend = GainTrend(window=2, factor=2.)
+        monitor.initLoop()
+        self._append(''.join(GOOD % movieId for movieId in range(1, 5)))
+        monitor.step()
+        monitor._cur.execute("SELECT movieId, hotPixels FROM log_image "
+                             "ORDER BY movieId")
+        self.assertEqual(monitor._cur.fetchall(),
+                         [(1, 4), (2, 8), (3, 12), (4, 16)])
+        self.assertEqual(len(self.notifier.messages), 1)
+
+    def test_warningsInMonitorDir(self):
+        workingDir = os.path.join(self.path, 'monitor')
+        pwutils.makePath(workingDir)
+        monitor = MonitorMovieGain(FakeGainProtocol(self.path),
+                                   workingDir=workingDir,
+                                   stddevValue=0.04, ratio1Value=1.15,
+                                   ratio2Value=100)
+        monitor.initLoop()
+        self._append(BAD % 7)
+        monitor.step()
+        with open(os.path.join(workingDir, GAIN_WARNINGS)) as f:
+            self.assertTrue(f.read().startswith('movie_000007_residual:'))
+        self.assertFalse(os.path.exists(os.path.join(self.path,
+                                                     GAIN_WARNINGS)))
+
+
+class TestGainImageAnalyzer(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def test_analyze(self):
+        rng = np.random.default_rng(0)
+        gain = rng.normal(1., 0.01, (300, 200)).astype(np.float32)
+        gain[10, 20] = 1.5     # hot pixel
+        gain[:, 50] = 1.2      # defective column
+        fn = self.getOutputPath('residual_gain.mrc')
+        with mrcfile.new(fn, data=gain, overwrite=True):
+            pass
+
+        # small chunks so several blocks are processed
+        stats = GainImageAnalyzer(chunkRows=64).analyzeFile(fn)
+        self.assertEqual(stats['badColumns'], 1)
+        self.assertEqual(stats['badRows'], 0)
+        self.assertGreaterEqual(stats['hotPixels'], 1)
+        self.assertAlmostEqual(stats['mean'], float(gain.mean(dtype=np.float64)))
+        self.assertAlmostEqual(stats['std'], float(gain.std(dtype=np.float64)))
+        self.assertEqual(len(stats['rowProfile']), 300)
+        self.assertEqual(len(stats['columnProfile']), 200)
+
+    def test_trend(self):
+        trend = GainTrend(window=5, factor=2.)
+        self.assertFalse(trend.isDegrading([3] * 9))
+        self.assertFalse(trend.isDegrading([3] * 10))
+        self.assertTrue(trend.isDegrading([3] * 5 + [10] * 5))
@@ -23,11 +23,13 @@
 
 import os.path
 
+import pyworkflow.object as pwobj
 import pyworkflow.tests as pwtests
 import pyworkflow.utils as pwutils
 
 import pwem.protocols as emprot
 import emfacilities.protocols as monitorsProt
+from emfacilities.protocols.protocol_monitor_system import MonitorSystem
 
 
 class TestStress(pwtests.BaseTest):
@@ -68,7 +70,7 @@ class TestStress(pwtests.BaseTest):
             "doGpu": False,
             "gpusToUse": "0",
             "doNetwork": True,
-            "netInterfaces": 1,
+            "netInterface": "",
             "doDiskIO": True}
 
         prot2 = self.newProtocol(monitorsProt.ProtMonitorSystem, **kwargs)
@@ -79,3 +81,22 @@ class TestStress(pwtests.BaseTest):
 
         # not sure what to test here
         self.assertTrue(os.path.isfile(baseFn))
+
+
+class TestNetInterface(pwtests.BaseTest):
+    def setUp(self):
+        self._nifs = MonitorSystem._nifsNameList
+        MonitorSystem._nifsNameList = ['lo', 'eth0', 'eth1']
+
+    def tearDown(self):
+        MonitorSystem._nifsNameList = self._nifs
+
+    def test_storedIndex(self):
+        """ Protocols saved with the index of the interface in the old
+        list still monitor it. """
+        prot = monitorsProt.ProtMonitorSystem()
+        self.assertEqual(MonitorSystem.getProtocolNifName(prot), 'eth0')
+        prot.netInterfaces = pwobj.Integer(2)
+        self.assertEqual(MonitorSystem.getProtocolNifName(prot), 'eth1')
+        prot.netInterface.set('eth0')
+        self.assertEqual(MonitorSystem.getProtocolNifName(prot), 'eth0')
@@ -0,0 +1,68 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import unittest
+
+from emfacilities.protocols.rate_estimator import RateEstimator, formatEta
+
+
+class TestRateEstimator(unittest.TestCase):
+
+    def test_constantRate(self):
+        rates = RateEstimator()
+        for minute in range(30):
+            rates.update(5, 'outputCTF', 10 * minute, now=60. * minute)
+        perMinute = rates.getRates(5, 'outputCTF')
+        for window in ['1m', '5m', '15m']:
+            self.assertAlmostEqual(perMinute[window], 10.)
+        self.assertEqual(rates.getTrend(5, 'outputCTF'), 0)
+        # 290 items done, 100 more at 10 items/min
+        self.assertAlmostEqual(rates.getEta(5, 'outputCTF', 390), 600.)
+        self.assertEqual(formatEta(600.), '0:10')
+
+    def test_slowDown(self):
+        rates = RateEstimator()
+        count = 0
+        for minute in range(30):
+            count += 10 if minute < 25 else 1
+            rates.update(1, 'outputMicrographs', count, now=60. * minute)
+        perMinute = rates.getRates(1, 'outputMicrographs')
+        # the short window follows the change first
+        self.assertLess(perMinute['1m'], perMinute['5m'])
+        self.assertLess(perMinute['5m'], perMinute['15m'])
+        self.assertEqual(rates.getTrend(1, 'outputMicrographs'), -1)
+
+    def test_outputsByProtocol(self):
+        rates = RateEstimator()
+        rates.update(1, 'outputMicrographs', 0, now=0)
+        rates.update(2, 'outputMicrographs', 0, now=0)
+        self.assertIsNone(rates.getRates(1, 'outputMicrographs'))
+        rates.update(1, 'outputMicrographs', 60, now=60)
+        rates.update(2, 'outputMicrographs', 0, now=60)
+        self.assertAlmostEqual(rates.getRates(1, 'outputMicrographs')['1m'], 60)
+        self.assertEqual(rates.getRates(2, 'outputMicrographs')['1m'], 0)
+        self.assertIsNone(rates.getEta(2, 'outputMicrographs', 10))
+        summary = {s['protId']: s for s in rates.getSummary(target=120)}
+        self.assertAlmostEqual(summary[1]['eta'], 60.)
+        self.assertIn('prot1_outputMicrographs_per_minute_5m',
+                      rates.getMetrics())
@@ -0,0 +1,105 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import base64
+import hashlib
+import os
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+
+from emfacilities.protocols.report_assets import (ASSETS, ASSETS_DIR,
+                                                  ASSET_RESOURCES,
+                                                  installAssets,
+                                                  checkIntegrity)
+
+PLUGIN_ASSETS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+    'templates', ASSETS_DIR)
+
+
+class TestReportAssets(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        self.assetsDir = os.path.join(self.path, 'plugin')
+        self.reportDir = os.path.join(self.path, 'report')
+        pwutils.makePath(self.reportDir)
+
+    def _writeAsset(self, relPath, text):
+        path = os.path.join(self.assetsDir, relPath)
+        pwutils.makePath(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_install(self):
+        jqueryPath = ASSETS['jqueryJs'][0]
+        self._writeAsset(jqueryPath, 'var jQuery;')
+        self._writeAsset('fonts/glyphicons-halflings-regular.woff', 'font')
+        urls = installAssets(self.reportDir, self.assetsDir, log=lambda m: None)
+
+        url = urls['jqueryJs']
+        self.assertTrue(url.startswith(ASSETS_DIR + '/js/jquery-3.1.0.'))
+        self.assertTrue(url.endswith('.min.js'))
+        self.assertEqual(urls['jqueryJsAttrs'], '')
+        self.assertTrue(os.path.exists(os.path.join(self.reportDir, url)))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.reportDir, ASSETS_DIR, 'fonts',
+            'glyphicons-halflings-regular.woff')))
+        # not in the plugin, checked by the browser if possible
+        self.assertEqual(urls['bootstrapJs'], ASSETS['bootstrapJs'][1])
+        self.assertEqual(urls['bootstrapJsAttrs'],
+                         ' integrity="%s" crossorigin="anonymous"'
+                         % ASSETS['bootstrapJs'][2])
+        self.assertTrue(urls['logoPng'].startswith(ASSETS_DIR + '/img/'))
+
+        # the same content keeps its name, a new one gets a new name
+        self.assertEqual(installAssets(self.reportDir, self.assetsDir,
+                                       log=lambda m: None)['jqueryJs'], url)
+        self._writeAsset(jqueryPath, 'var jQuery = 1;')
+        self.assertNotEqual(installAssets(self.reportDir, self.assetsDir,
+                                          log=lambda m: None)['jqueryJs'], url)
+
+    def test_integrity(self):
+        data = b'alert(1);'
+        integrity = 'sha384-' + base64.b64encode(
+            hashlib.sha384(data).digest()).decode('ascii')
+        self.assertTrue(checkIntegrity(data, integrity))
+        self.assertFalse(checkIntegrity(data + b' ', integrity))
+
+    def test_shipped(self):
+        """ The free libraries are shipped with the plugin, unmodified. """
+        for field, (relPath, _, integrity) in ASSETS.items():
+            path = os.path.join(PLUGIN_ASSETS_DIR, relPath)
+            if field.startswith('highcharts'):
+                continue
+            with open(path, 'rb') as f:
+                self.assertTrue(checkIntegrity(f.read(), integrity), relPath)
+        for relPath, _ in ASSET_RESOURCES:
+            self.assertTrue(os.path.exists(os.path.join(PLUGIN_ASSETS_DIR,
+                                                        relPath)), relPath)
@@ -0,0 +1,172 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import json
+import os
+import time
+
+import numpy as np
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+
+from emfacilities.protocols.report_data import (ReportDataWriter, DATA_DIR,
+                                                MIC_CHUNK_JS, SUMMARY_JS,
+                                                ReportManifest, ReportPublisher)
+
+
+class TestReportDataWriter(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+        self.writer = ReportDataWriter(self.path, chunkSize=10)
+        self.built = []
+
+    def _read(self, fileName):
+        """ Return the call and the arguments of a data script. """
+        with open(os.path.join(self.path, DATA_DIR, fileName)) as f:
+            text = f.read()
+        call, args = text.split('(', 1)
+        return call, json.loads('[%s]' % args.rstrip().rstrip(';')[:-1])
+
+    def _getRow(self, numReady):
+        def getRow(i):
+            self.built.append(i)
+            return [np.int64(i), 'imgMicThumbs/mic%d.jpg' % i
+                    if i < numReady else '', np.float64(i / 2.)]
+        return getRow
+
+    def test_chunks(self):
+        chunks = self.writer.writeMics(25, 12, self._getRow(12))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(self.writer.finalChunks, 1)
+        call, (chunk, rows) = self._read(MIC_CHUNK_JS % 1)
+        self.assertEqual(call, 'reportData.setMics')
+        self.assertEqual(chunk, 1)
+        self.assertEqual(rows[1], [11, 'imgMicThumbs/mic11.jpg', 5.5])
+        self.assertEqual(rows[2], [12, '', 6.])
+
+        # final chunks are not built again, unchanged ones keep the version
+        self.built = []
+        mtime = os.path.getmtime(os.path.join(self.path, DATA_DIR,
+                                              MIC_CHUNK_JS % 2))
+        os.utime(os.path.join(self.path, DATA_DIR, MIC_CHUNK_JS % 2),
+                 (mtime - 100, mtime - 100))
+        newChunks = self.writer.writeMics(25, 20, self._getRow(20))
+        self.assertEqual(self.built, list(range(10, 25)))
+        self.assertEqual(newChunks[0], chunks[0])
+        self.assertNotEqual(newChunks[1], chunks[1])
+        self.assertEqual(newChunks[2], chunks[2])
+        self.assertEqual(os.path.getmtime(os.path.join(
+            self.path, DATA_DIR, MIC_CHUNK_JS % 2)), mtime - 100)
+        self.assertEqual(self.writer.finalChunks, 2)
+
+    def test_summary(self):
+        self.writer.writeSummary({'numMics': np.int64(3), 'chunks': ['a']})
+        call, (summary,) = self._read(SUMMARY_JS)
+        self.assertEqual(call, 'reportData.setSummary')
+        self.assertEqual(summary, {'numMics': 3, 'chunks': ['a']})
+        # the pages get the arguments of the call
+        (fileName, version, call, argsJson), = self.writer.popChanged()
+        self.assertEqual((fileName, call), (SUMMARY_JS, 'setSummary'))
+        self.assertEqual(json.loads(argsJson), [summary])
+        self.assertEqual(self.writer.popChanged(), [])
+
+
+class TestReportPublisher(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        self.reportDir = os.path.join(self.path, 'report')
+        pwutils.makePath(os.path.join(self.reportDir, 'data'))
+        self.published = os.path.join(self.path, 'published.txt')
+        self.log = []
+
+    def _write(self, relPath, text):
+        with open(os.path.join(self.reportDir, relPath), 'w') as f:
+            f.write(text)
+
+    def _published(self):
+        if not os.path.exists(self.published):
+            return []
+        with open(self.published) as f:
+            return f.read().split()
+
+    def test_manifest(self):
+        self._write('index.html', 'page')
+        self._write('data/summary.js', 'summary')
+        manifest = ReportManifest(self.reportDir)
+        self.assertEqual(manifest.update(), ['data/summary.js', 'index.html'])
+        self.assertEqual(manifest.update(), [])
+
+        # same content with a new mtime is not a change
+        self._write('index.html', 'page')
+        self._write('data/summary.js', 'summary 2')
+        self._write('data/mics_0000.js.tmp123', 'being written')
+        # the manifest is kept between runs
+        manifest = ReportManifest(self.reportDir)
+        self.assertEqual(manifest.update(), ['data/summary.js'])
+
+    def test_publish(self):
+        cmd = 'sleep 0.5; cat %%(CHANGED_FILES)s >> %s' % self.published
+        publisher = ReportPublisher(cmd, self.reportDir, log=self.log.append)
+        t = time.time()
+        self.assertTrue(publisher.publish(['index.html', 'data/a.js']))
+        # does not wait for the running one, files are queued
+        self.assertFalse(publisher.publish(['data/b.js']))
+        self.assertLess(time.time() - t, 0.4)
+        self.assertTrue(publisher.wait(10))
+        self.assertEqual(self._published(), ['data/a.js', 'index.html'])
+
+        # the queued files are published on the next call
+        self.assertTrue(publisher.publish([]))
+        publisher.flush(['data/a.js'], timeout=10)
+        self.assertEqual(self._published(), ['data/a.js', 'index.html',
+                                             'data/b.js', 'data/a.js'])
+        self.assertFalse(publisher.publish([]))
+
+    def test_timeout(self):
+        # the commands started by the shell are stopped too
+        marker = os.path.join(self.reportDir, 'marker')
+        publisher = ReportPublisher('sh -c "sleep 1; touch %s"' % marker,
+                                    self.reportDir, timeout=0.2,
+                                    log=self.log.append)
+        publisher.publish(['index.html'])
+        self.assertTrue(publisher.wait(10))
+        self.assertIn('timeout', self.log[-1])
+        time.sleep(1.5)
+        self.assertFalse(os.path.exists(marker))
+        # published again with the next changes
+        publisher.cmd = 'cat %%(CHANGED_FILES)s >> %s' % self.published
+        publisher.flush(['data/a.js'], timeout=10)
+        self.assertEqual(self._published(), ['data/a.js', 'index.html'])
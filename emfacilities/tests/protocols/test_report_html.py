@@ -0,0 +1,236 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import os
+import zipfile
+from unittest import mock
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+
+from emfacilities.protocols import report_html
+from emfacilities.protocols.report_html import (ReportHtml, MIC_THUMBS,
+                                                SHIFT_THUMBS, PSD_PATH,
+                                                NO_IMAGE)
+
+
+class FakeFile:
+    def __init__(self, fileName):
+        self._fileName = fileName
+
+    def getFileName(self):
+        return self._fileName
+
+
+class FakeMic(FakeFile):
+    def __init__(self, micId, shiftPlot=None):
+        FakeFile.__init__(self, '/data/mic_%03d.mrc' % micId)
+        self._objId = micId
+        if shiftPlot:
+            self.plotGlobal = FakeFile('/data/mic_%03d_shifts.png' % micId)
+
+    def getObjId(self):
+        return self._objId
+
+
+class FakeSet:
+    """ Answers the id cursor queries of ReportHtml and counts them. """
+    def __init__(self):
+        self.items = []
+        self.queries = []
+
+    def iterItems(self, orderBy='id', where='1'):
+        self.queries.append(where)
+        column, op, value = where.split()
+        compare = {'>': int.__gt__, '<=': int.__le__}[op]
+        for item in sorted(self.items, key=lambda i: i.getObjId()):
+            if compare(item.getObjId(), int(value)):
+                yield item
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, micId):
+        raise AssertionError("Micrographs must not be read one by one")
+
+    def close(self):
+        pass
+
+
+class FakeProtocol:
+    _log = None
+
+    def __init__(self, reportDir, alignProtocol, ctfProtocol):
+        self.reportDir = reportDir
+        self.reportPath = os.path.join(reportDir, 'index.html')
+        self._align = alignProtocol
+        self._ctf = ctfProtocol
+
+    def _getCtfProtocol(self):
+        return self._ctf
+
+    def _getAlignProtocol(self):
+        return self._align
+
+    def getPlugin(self):
+        import emfacilities
+        return emfacilities.Plugin()
+
+    def getProject(self):
+        return mock.Mock(**{'getPath.return_value': self.reportDir,
+                            'getTmpPath.return_value': 'thumbnails'})
+
+
+class TestReportHtmlMics(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        reportDir = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(reportDir)
+        pwutils.makePath(reportDir)
+        self.outputSet = FakeSet()
+        alignProtocol = mock.Mock(spec=['outputMicrographs'],
+                                  outputMicrographs=self.outputSet)
+        patcher = mock.patch.object(report_html, 'getUpdatedProtocol',
+                                    lambda prot: prot)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.object(report_html, 'SummaryProvider'):
+            self.report = ReportHtml(FakeProtocol(reportDir, alignProtocol,
+                                                  mock.Mock()),
+                                     None, None, None)
+        self.addCleanup(self.report.close)
+
+    def _ctfData(self, micIds):
+        return {'idValues': micIds,
+                PSD_PATH: ['/ctf/mic_%03d/ctfEstimation.psd' % i
+                           for i in micIds]}
+
+    def test_streamNewMics(self):
+        self.outputSet.items = [FakeMic(1, True), FakeMic(2, True)]
+        self.report.getThumbPaths(ctfData=self._ctfData([1]))
+        self.assertEqual([m.micId for m in self.report.mics], [1])
+
+        self.outputSet.items.append(FakeMic(3, True))
+        self.report.getThumbPaths(ctfData=self._ctfData([1, 2, 3]))
+        self.assertEqual([m.micId for m in self.report.mics], [1, 2, 3])
+        # only the new micrographs are read on each call
+        self.assertEqual(self.outputSet.queries, ['id > 0', 'id > 2'])
+        mic = self.report.mics[2]
+        self.assertEqual(mic.micThumb, os.path.join(MIC_THUMBS, 'mic_003.jpg'))
+        self.assertEqual(mic.shiftThumb,
+                         os.path.join(SHIFT_THUMBS, 'mic_003_shifts.jpg'))
+        self.assertTrue(mic.psdThumb.endswith('mic_003_ctfEstimation.jpg'))
+
+    def test_unorderedMics(self):
+        """ Micrographs added with a lower id than the last one read. """
+        self.outputSet.items = [FakeMic(1, True), FakeMic(3, True)]
+        self.report.getThumbPaths(ctfData=self._ctfData([1, 3]))
+        self.outputSet.items.append(FakeMic(2, True))
+        self.report.getThumbPaths(ctfData=self._ctfData([1, 3, 2]))
+        self.assertEqual([m.micId for m in self.report.mics], [1, 3, 2])
+        self.assertEqual(self.report.mics[2].micThumb,
+                         os.path.join(MIC_THUMBS, 'mic_002.jpg'))
+        # all the ids are only looked at when some are missing
+        self.report.getThumbPaths(ctfData=self._ctfData([1, 3, 2]))
+        self.assertEqual(self.outputSet.queries,
+                         ['id > 0', 'id > 3', 'id <= 3', 'id > 3'])
+
+    def test_missingShiftPlot(self):
+        self.outputSet.items = [FakeMic(1, True), FakeMic(2, False),
+                                FakeMic(3, True)]
+        self.report.getThumbPaths(ctfData=self._ctfData([1, 2, 3]))
+        mics = self.report.mics
+        self.assertTrue(self.report.hasShifts)
+        self.assertIsNone(mics[1].shiftThumb)
+        self.assertIsNotNone(mics[0].shiftThumb)
+        self.assertIsNotNone(mics[2].shiftThumb)
+        self.assertEqual(len(self.report.getThumbnailTasks(1)), 2)
+        self.assertEqual(len(self.report.getThumbnailTasks(2)), 3)
+
+        # make the thumbnails of the micrographs
+        for mic in mics:
+            for thumb in mic.getThumbs():
+                path = os.path.join(self.report.reportDir, thumb)
+                pwutils.makePath(os.path.dirname(path))
+                open(path, 'w').close()
+        self.report.queueReportImages()
+        self.assertEqual(self.report.checkNewThumbsReady(), 3)
+        ctfData = {'defocusU': [1e4] * 3, 'astigmatism': [10] * 3,
+                   'resolution': [3] * 3, 'fitQuality': [0.1] * 3,
+                   'ratio': [1] * 3, 'phaseShift': [0] * 3}
+        row = self.report.getMicRow(1, ctfData)
+        self.assertEqual(row[:4], [2, mics[1].micThumb, NO_IMAGE,
+                                   mics[1].psdThumb])
+
+    def test_failedThumbnail(self):
+        # the source images do not exist
+        self.outputSet.items = [FakeMic(1, True), FakeMic(2, True)]
+        self.report.getThumbPaths(ctfData=self._ctfData([1, 2]))
+        mic1, mic2 = self.report.mics
+        # thumbnails of the second one are already done
+        for thumb in mic2.getThumbs():
+            path = os.path.join(self.report.reportDir, thumb)
+            pwutils.makePath(os.path.dirname(path))
+            open(path, 'w').close()
+        self.report.queueReportImages()
+        self.assertTrue(self.report.thumbnailPool.wait(60))
+
+        self.assertEqual(self.report.checkNewThumbsReady(), 2)
+        self.assertTrue(mic2.ready)
+        self.assertEqual(mic2.errors, {})
+        self.assertEqual(sorted(mic1.errors),
+                         ['micThumb', 'psdThumb', 'shiftThumb'])
+        self.assertTrue(all(mic1.errors.values()))
+        self.assertEqual(mic1.getThumbs(), [])
+
+    def test_export(self):
+        from PIL import Image
+        self.outputSet.items = [FakeMic(1, False), FakeMic(2, False)]
+        self.report.getThumbPaths(ctfData=self._ctfData([1, 2]))
+        # all the psds look the same
+        for mic in self.report.mics:
+            for thumb in mic.getThumbs():
+                path = os.path.join(self.report.reportDir, thumb)
+                pwutils.makePath(os.path.dirname(path))
+                color = 0 if thumb == mic.psdThumb else mic.micId * 100
+                Image.new('L', (64, 64), color).save(path, quality=95)
+        self.report.queueReportImages()
+        self.report.checkNewThumbsReady()
+        with open(os.path.join(self.report.reportDir, 'index.html'), 'w') as f:
+            f.write('<html></html>')
+
+        archivePath = self.report.export(workers=1)
+        with zipfile.ZipFile(archivePath) as archive:
+            names = archive.namelist()
+            chunk = archive.read('data/mics_0000.js').decode()
+        self.assertIn('index.html', names)
+        self.assertFalse([n for n in names if n.startswith(MIC_THUMBS)])
+        # two micrographs and one psd
+        images = [n for n in names if n.startswith('images/')]
+        self.assertEqual(len(images), 3)
+        for image in images:
+            self.assertIn(image, chunk)
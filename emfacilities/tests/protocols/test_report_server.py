@@ -0,0 +1,89 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import http.client
+import json
+import os
+import time
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+
+from emfacilities.protocols.report_server import ReportServer
+
+
+class TestReportServer(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(os.path.join(self.path, 'data'))
+        with open(os.path.join(self.path, 'index.html'), 'w') as f:
+            f.write('<html></html>')
+        self.server = ReportServer(self.path, 0, host='127.0.0.1').start()
+        self.addCleanup(self.server.stop)
+
+    def _get(self, path):
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.port,
+                                          timeout=10)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response.status, response.getheader('Content-Type'), body
+
+    def test_files(self):
+        status, contentType, body = self._get('/')
+        self.assertEqual((status, contentType, body),
+                         (200, 'text/html', b'<html></html>'))
+        self.assertEqual(self._get('/index.html?t=1')[0], 200)
+        self.assertEqual(self._get('/missing.js')[0], 404)
+        self.assertEqual(self._get('/../../index.html')[0], 404)
+        self.assertEqual(self._get('/%2e%2e/index.html')[0], 404)
+
+    def test_events(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.port,
+                                          timeout=10)
+        conn.request('GET', '/events')
+        response = conn.getresponse()
+        self.assertEqual(response.getheader('Content-Type'),
+                         'text/event-stream')
+        # wait for the page to be registered
+        for _ in range(100):
+            if self.server.clientCount():
+                break
+            time.sleep(0.01)
+        self.server.pushData([('mics_0001.js', 'abc', 'setMics',
+                               '[1,[{"mic":"a"}]]')])
+        self.assertEqual(response.fp.readline(), b'event: data\n')
+        data = response.fp.readline().decode()
+        self.assertTrue(data.startswith('data: '))
+        update = json.loads(data[len('data: '):])
+        self.assertEqual(update, {'file': 'mics_0001.js', 'version': 'abc',
+                                  'call': 'setMics',
+                                  'args': [1, [{'mic': 'a'}]]})
+        conn.close()
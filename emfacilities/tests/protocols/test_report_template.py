@@ -0,0 +1,117 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import os
+
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+
+from emfacilities.protocols.report_assets import ASSETS, IMAGE_ASSETS
+from emfacilities.protocols.report_template import (ReportTemplate,
+                                                    compileTemplate)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), '..', '..',
+                            'templates')
+
+
+class TestReportTemplate(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+        self.custom = os.path.join(self.path, 'custom.html')
+        self.default = os.path.join(self.path, 'default.html')
+
+    def _write(self, path, text, mtime=None):
+        with open(path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_compile(self):
+        text = 'a %(x)s b %% %(y)5.1f %(x)s%%(z)s'
+        self.assertEqual(compileTemplate(text),
+                         ['a ', ('x', '%s'), ' b % ', ('y', '%5.1f'), ' ',
+                          ('x', '%s'), '%(z)s'])
+        args = {'x': 'X', 'y': 2.25}
+        template = ReportTemplate(os.path.join(self.path, 'missing.html'),
+                                  self.default)
+        self._write(self.default, text)
+        self.assertTrue(template.load())
+        self.assertEqual(template.fields, {'x', 'y'})
+        self.assertEqual(template.renderText(args), text % args)
+
+    def test_report_template(self):
+        """ Same output as the % operator for the provided template. """
+        path = os.path.join(TEMPLATE_DIR, 'execution.summary.template.html')
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        args = {'projectName': 'project', 'refresh': 60}
+        args.update((field, 'assets/%s' % field)
+                    for field in list(ASSETS) + list(IMAGE_ASSETS))
+        args.update((field + 'Attrs', ' integrity="x"') for field in ASSETS)
+        template = ReportTemplate(path)
+        template.load()
+        self.assertEqual(template.renderText(args), text % args)
+
+    def test_reload(self):
+        template = ReportTemplate(self.custom, self.default)
+        self.assertFalse(template.load())
+        self._write(self.default, 'default %(x)s', mtime=1000)
+        self.assertTrue(template.load())
+        self.assertEqual(template.renderText({'x': 1}), 'default 1')
+
+        # a customized template is used as soon as it exists
+        self._write(self.custom, 'custom %(x)s', mtime=1000)
+        template.load()
+        self.assertEqual(template.path, self.custom)
+        self.assertEqual(template.renderText({'x': 1}), 'custom 1')
+
+        # and reloaded when modified
+        self._write(self.custom, 'new custom %(x)s', mtime=2000)
+        template.load()
+        self.assertEqual(template.renderText({'x': 1}), 'new custom 1')
+
+    def test_render_file(self):
+        self._write(self.default, '<p>%(x)s</p>')
+        template = ReportTemplate(self.default)
+        template.load()
+        out = os.path.join(self.path, 'index.html')
+        digest = template.renderFile(out, {'x': 1})
+        with open(out) as f:
+            self.assertEqual(f.read(), '<p>1</p>')
+
+        # unchanged output does not touch the file
+        os.utime(out, (1000, 1000))
+        self.assertEqual(template.renderFile(out, {'x': 1}, digest), digest)
+        self.assertEqual(os.path.getmtime(out), 1000)
+        self.assertNotEqual(template.renderFile(out, {'x': 2}, digest), digest)
+        with open(out) as f:
+            self.assertEqual(f.read(), '<p>2</p>')
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['default.html', 'index.html'])
@@ -0,0 +1,116 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import subprocess
+import sys
+import time
+
+import pyworkflow.tests as pwtests
+
+from emfacilities.protocols.system_agent import SampleCollector, SystemAgent
+from emfacilities.protocols.protocol_monitor_system import MonitorSystem
+
+
+class FakeSampler:
+    def __init__(self, values):
+        self.values = values
+
+    def initSampling(self):
+        pass
+
+    def sample(self):
+        return dict(self.values)
+
+
+class TestSystemAgent(pwtests.BaseTest):
+    """ Push samples from several agents to a collector. """
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.collector = SampleCollector(0, host='127.0.0.1').start()
+
+    def tearDown(self):
+        self.collector.stop()
+
+    def _waitSamples(self, hosts, timeout=20):
+        samples = {}
+        start = time.time()
+        while set(samples) != set(hosts) and time.time() - start < timeout:
+            samples.update(self.collector.popSamples())
+            time.sleep(0.1)
+        return samples
+
+    def test_agents(self):
+        for host, cpu in [('node1', 10), ('node2', 30)]:
+            agent = SystemAgent('127.0.0.1', self.collector.port,
+                                FakeSampler({'cpu': cpu, 'mem': 50}),
+                                samplingInterval=0, hostName=host)
+            agent.loop(count=1)
+
+        samples = self._waitSamples(['node1', 'node2'])
+        self.assertEqual(samples['node1'], {'cpu': 10., 'mem': 50.})
+        self.assertEqual(samples['node2'], {'cpu': 30., 'mem': 50.})
+        self.assertEqual(self.collector.popSamples(), {})
+
+    def test_invalidSamples(self):
+        self.assertFalse(self.collector.addSample('bad host', {'cpu': 1}))
+        self.assertFalse(self.collector.addSample('node1', [1, 2]))
+        self.assertTrue(self.collector.addSample('node1', {'cpu': 'x',
+                                                           'mem': 2}))
+        self.assertEqual(self.collector.popSamples(), {'node1': {'mem': 2.}})
+
+    def test_agentProcesses(self):
+        """ Run real agents, sampling the local machine. """
+        hosts = ['node%d' % i for i in range(3)]
+        procs = [subprocess.Popen(
+            [sys.executable, '-m', 'emfacilities.protocols.system_agent',
+             '--monitor', '127.0.0.1:%d' % self.collector.port,
+             '--interval', '0.1', '--count', '1', '--hostname', host])
+            for host in hosts]
+        for p in procs:
+            self.assertEqual(p.wait(timeout=60), 0)
+
+        samples = self._waitSamples(hosts)
+        self.assertEqual(sorted(samples), hosts)
+        for values in samples.values():
+            self.assertIn('cpu', values)
+            self.assertIn('mem', values)
+
+    def test_monitorStorage(self):
+        """ Samples of other hosts are stored and averaged in the report. """
+        monitor = MonitorSystem([], workingDir=self.getOutputPath(),
+                                samplingInterval=0, monitorTime=1,
+                                cpuAlert=101, memAlert=101, swapAlert=101,
+                                doGpu=False, doNetwork=False, doDiskIO=False)
+        monitor.collector = self.collector
+        monitor.initLoop()
+        self.collector.addSample('node1', {'cpu': 10, 'mem': 20})
+        monitor.step()
+
+        data = monitor.getData()
+        self.assertEqual(data['node1:cpu'], [10.])
+        self.assertEqual(data['cluster:cpu'],
+                         [(data['cpu'][0] + 10.) / 2])
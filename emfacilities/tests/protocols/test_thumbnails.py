@@ -0,0 +1,255 @@
+# ***************************************************************************
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import os
+import time
+
+import numpy as np
+import pyworkflow.tests as pwtests
+import pyworkflow.utils as pwutils
+
+from emfacilities.protocols.thumbnails import (ThumbnailPool, ThumbnailCache,
+                                               copyImage, binImage,
+                                               makeThumbnail, makePsdThumbnail,
+                                               cachedImage)
+
+
+def slowCopy(srcPath, dstPath):
+    time.sleep(0.3)
+    copyImage(srcPath, dstPath)
+
+
+def countingCopy(srcPath, dstPath):
+    # every call leaves a mark, to detect duplicated work
+    with open(srcPath + '.calls', 'a') as f:
+        f.write('%s\n' % dstPath)
+    copyImage(srcPath, dstPath)
+
+
+def failingCopy(srcPath, dstPath):
+    raise IOError("cannot read %s" % srcPath)
+
+
+class TestThumbnailPool(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+        self.src = os.path.join(self.path, 'mic.jpg')
+        with open(self.src, 'wb') as f:
+            f.write(b'\xff\xd8 not really a jpg')
+        self.pool = ThumbnailPool(workers=2, maxPending=4)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def _dst(self, i):
+        return os.path.join(self.path, 'thumb_%02d.jpg' % i)
+
+    def test_dedup(self):
+        """ The same destination is converted only once. """
+        for _ in range(3):
+            for i in range(3):
+                self.assertTrue(self.pool.submit(self._dst(i), countingCopy,
+                                                 self.src))
+        self.assertTrue(self.pool.wait(timeout=30))
+        # already generated, nothing is queued
+        self.assertTrue(self.pool.submit(self._dst(0), countingCopy, self.src))
+        self.assertEqual(self.pool.pendingCount(), 0)
+
+        with open(self.src + '.calls') as f:
+            calls = f.read().split()
+        self.assertEqual(sorted(calls), [self._dst(i) for i in range(3)])
+        self.assertEqual(self.pool.done, 3)
+        for i in range(3):
+            with open(self._dst(i), 'rb') as f:
+                self.assertEqual(f.read(), b'\xff\xd8 not really a jpg')
+
+    def test_backpressure(self):
+        """ Tasks beyond maxPending are refused until the queue drains. """
+        accepted = [self.pool.submit(self._dst(i), slowCopy, self.src)
+                    for i in range(6)]
+        self.assertEqual(accepted, [True] * 4 + [False] * 2)
+        self.assertTrue(self.pool.isFull())
+        self.assertTrue(self.pool.isPending(self._dst(0)))
+
+        self.assertTrue(self.pool.wait(timeout=30))
+        self.assertFalse(self.pool.isFull())
+        self.assertTrue(self.pool.submit(self._dst(4), slowCopy, self.src))
+        self.assertTrue(self.pool.wait(timeout=30))
+        self.assertTrue(os.path.exists(self._dst(4)))
+        self.assertFalse(os.path.exists(self._dst(5)))
+
+    def test_failure(self):
+        """ Failures are recorded and not retried. """
+        dst = self._dst(0)
+        self.pool.submit(dst, failingCopy, self.src)
+        self.assertTrue(self.pool.wait(timeout=30))
+        self.assertIn('cannot read', self.pool.failed[dst])
+        self.assertTrue(self.pool.submit(dst, failingCopy, self.src))
+        self.assertFalse(self.pool.isPending(dst))
+        self.assertEqual(self.pool.done, 0)
+
+
+class TestThumbnailEngine(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+
+    def _writeMrc(self, data, name='mic.mrc'):
+        import mrcfile
+        path = os.path.join(self.path, name)
+        with mrcfile.new(path, overwrite=True) as mrc:
+            mrc.set_data(data.astype(np.float32))
+        return path
+
+    def test_bin(self):
+        data = np.random.default_rng(1).normal(size=(103, 98))
+        binned = binImage(data, 4, chunkRows=10)
+        expected = data[:100, :96].reshape(25, 4, 24, 4).mean(axis=(1, 3))
+        self.assertEqual(binned.shape, (25, 24))
+        self.assertTrue(np.allclose(binned, expected, atol=1e-5))
+
+    def test_micrograph(self):
+        from PIL import Image
+        data = np.random.default_rng(2).normal(size=(400, 600))
+        data[:, :300] += 10
+        src = self._writeMrc(data)
+
+        for ext in ['jpg', 'webp']:
+            dst = os.path.join(self.path, 'mic.' + ext)
+            makeThumbnail(src, dst, scaleFactor=4)
+            with Image.open(dst) as img:
+                self.assertEqual(img.format, ext.replace('jpg', 'jpeg').upper())
+                self.assertEqual(img.size, (150, 100))
+                thumb = np.asarray(img.convert('L'), dtype=float)
+            # left half is brighter
+            self.assertGreater(thumb[:, :70].mean(), thumb[:, 80:].mean() + 100)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['mic.jpg', 'mic.mrc', 'mic.webp'])
+
+    def test_psd(self):
+        from PIL import Image
+        # power spectrum with the origin in the corner
+        y, x = np.meshgrid(np.fft.fftfreq(128), np.fft.fftfreq(128),
+                           indexing='ij')
+        src = self._writeMrc(np.exp(-np.hypot(x, y) * 20), 'mic.psd.mrc')
+        dst = os.path.join(self.path, 'psd.jpg')
+        makePsdThumbnail(src, dst)
+        with Image.open(dst) as img:
+            thumb = np.asarray(img.convert('L'), dtype=float)
+        self.assertGreater(thumb[60:68, 60:68].mean(), thumb[:8, :8].mean())
+
+
+class TestThumbnailCache(pwtests.BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def setUp(self):
+        self.path = self.getOutputPath(self._testMethodName)
+        pwutils.cleanPath(self.path)
+        pwutils.makePath(self.path)
+        self.src = os.path.join(self.path, 'mic.mrc')
+        self._writeMic(0)
+        self.cache = ThumbnailCache(os.path.join(self.path, 'cache'))
+
+    def tearDown(self):
+        self.cache.close()
+
+    def _writeMic(self, seed):
+        import mrcfile
+        data = np.random.default_rng(seed).normal(size=(256, 256))
+        with mrcfile.new(self.src, overwrite=True) as mrc:
+            mrc.set_data(data.astype(np.float32))
+
+    def test_render_once(self):
+        dst1 = os.path.join(self.path, 'report1.jpg')
+        dst2 = os.path.join(self.path, 'report2.jpg')
+        self.cache.get(self.src, dst1, scaleFactor=4)
+        self.cache.get(self.src, dst2, scaleFactor=4)
+        # other params are another thumbnail
+        self.cache.get(self.src, scaleFactor=2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        with open(dst1, 'rb') as f1, open(dst2, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        # the source changes
+        os.utime(self.src, (1, 1))
+        self.cache.get(self.src, dst1, scaleFactor=4)
+        self.assertEqual(self.cache.misses, 3)
+
+        # the pool task shares the cache
+        dst3 = os.path.join(self.path, 'report3.jpg')
+        cachedImage(self.src, dst3, self.cache.cacheDir, scaleFactor=4)
+        self.assertEqual(self.cache.misses, 3)
+        with open(dst1, 'rb') as f1, open(dst3, 'rb') as f3:
+            self.assertEqual(f1.read(), f3.read())
+
+    def test_eviction(self):
+        first = self.cache.get(self.src, scaleFactor=1)
+        second = self.cache.get(self.src, scaleFactor=1, quality=70)
+        # room for two of them
+        self.cache.maxBytes = self.cache.getSize()
+        self.cache.get(self.src, scaleFactor=1)  # first is used again
+        third = self.cache.get(self.src, scaleFactor=1, quality=60)
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+        self.assertLessEqual(self.cache.getSize(), self.cache.maxBytes)
+
+    def test_totalSize(self):
+        def assertTotal():
+            self.cache.cur.execute("SELECT COALESCE(SUM(size), 0) "
+                                   "FROM thumbnail")
+            total = self.cache.cur.fetchone()[0]
+            self.assertEqual(self.cache.getSize(), total)
+
+        first = self.cache.get(self.src, scaleFactor=1)
+        self.cache.get(self.src, scaleFactor=2)
+        assertTotal()
+        # rendered again with the same key
+        os.remove(first)
+        self.cache.get(self.src, scaleFactor=1)
+        assertTotal()
+
+        # caches created before the total was kept
+        self.cache.cur.execute("DROP TABLE thumbnail_total")
+        self.cache.close()
+        self.cache = ThumbnailCache(self.cache.cacheDir)
+        assertTotal()
+        self.cache.maxBytes = 0
+        self.cache.evict()
+        self.assertEqual(self.cache.getSize(), 0)
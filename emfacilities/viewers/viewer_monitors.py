@@ -24,8 +24,10 @@
 # *
 # **************************************************************************
 
+import os
 import sys
 import tkinter as tk
+from tkinter import ttk
 from matplotlib import animation
 
 from pyworkflow.gui.plotter import plt
@@ -38,7 +40,7 @@ import pyworkflow.viewer as pwviewer
 from pwem.viewers.plotter import EmPlotter
 
 import emfacilities.protocols as monitorProt
-from emfacilities.protocols.protocol_monitor_system import MonitorSystem
+from emfacilities.protocols.pipeline_funnel import formatSeconds
 
 # anim is a object created by FuncAnimation. 
 # The object created by FuncAnimation must be assigned to a global 
@@ -294,9 +296,8 @@ class ProtMonitorSystemViewer(pwviewer.Viewer):
         pwviewer.Viewer.__init__(self, **args)
 
     def _visualize(self, obj, **kwargs):
-        return [SystemMonitorPlotter(obj.createMonitor(),
-                                     nifName=MonitorSystem.getNifsNameList()[
-                                         self.protocol.netInterfaces.get()])]
+        monitor = obj.createMonitor()
+        return [SystemMonitorPlotter(monitor, nifName=monitor.nif)]
 
 
 class SystemMonitorPlotter(EmPlotter):
@@ -550,9 +551,13 @@ class SummaryWindow(pwgui.Window):
         content.rowconfigure(1, weight=1)
         treeFrame.grid(row=1, column=0, sticky='news', padx=5, pady=5)
 
+        funnelFrame = tk.LabelFrame(content, text='Pipeline')
+        funnelFrame.grid(row=2, column=0, sticky='new', padx=5, pady=5)
+
         buttonsFrame = tk.Frame(content)
-        buttonsFrame.grid(row=2, column=0, sticky='new', padx=5, pady=5)
+        buttonsFrame.grid(row=3, column=0, sticky='new', padx=5, pady=5)
 
+        self._fillFunnelFrame(funnelFrame)
         self._fillTreeFrame(treeFrame)
         # JMRT: We fill the top frame after the tree, to make sure
         # the provider has updated the Acquisition info
@@ -593,6 +598,41 @@ class SummaryWindow(pwgui.Window):
         updateLabel.grid(row=1, column=0, sticky='nw', padx=5, pady=5)
         self._updateLabel()
 
+    def _fillFunnelFrame(self, frame):
+        columns = [('stage', 'Stage', 250), ('count', 'Micrographs', 100),
+                   ('backlog', 'Backlog', 80),
+                   ('stageLatency', 'Stage latency (50/90/99%)', 200),
+                   ('latency', 'Total latency (50/90/99%)', 200)]
+        self.funnelTree = ttk.Treeview(frame, show='headings', height=6,
+                                       columns=[c[0] for c in columns])
+        for key, label, width in columns:
+            self.funnelTree.heading(key, text=label)
+            self.funnelTree.column(key, width=width)
+        self.funnelTree.grid(row=0, column=0, sticky='news', padx=5, pady=5)
+        self._updateFunnel()
+
+    def _updateFunnel(self):
+        """ Show the stages stored by the summary monitor, if any. """
+        dbPath = os.path.join(self.protocol.workingDir.get(),
+                              monitorProt.PIPELINE_FUNNEL_SQLITE)
+        if not os.path.exists(dbPath):
+            return
+        funnel = monitorProt.PipelineFunnel(self.protocol.workingDir.get())
+        try:
+            stages = funnel.getStages()
+        finally:
+            funnel.close()
+
+        def formatLatency(values):
+            return ' / '.join(formatSeconds(v) for v in values)
+
+        self.funnelTree.delete(*self.funnelTree.get_children())
+        for stage in stages:
+            self.funnelTree.insert('', 'end', values=(
+                stage['label'], stage['count'], stage['backlog'],
+                formatLatency(stage['stageLatency']),
+                formatLatency(stage['latency'])))
+
     def _fillButtonsFrame(self, frame):
         subframe = tk.Frame(frame)
         subframe.grid(row=0, column=0, sticky='nw')
@@ -629,9 +669,8 @@ class SummaryWindow(pwgui.Window):
         MovieGainMonitorPlotter(self.protocol.createMovieGainMonitor()).show()
 
     def _monitorSystem(self, e=None):
-        nifName = MonitorSystem.getNifsNameList()[self.protocol.netInterfaces.get()]
-        SystemMonitorPlotter(self.protocol.createSystemMonitor(),
-                             nifName).show()
+        monitor = self.protocol.createSystemMonitor()
+        SystemMonitorPlotter(monitor, monitor.nif).show()
 
     def _updateLabel(self):
         self.updateVar.set('Updated: %s' % pwutils.prettyTime(secs=True))
@@ -641,6 +680,7 @@ class SummaryWindow(pwgui.Window):
     def _updateData(self):
         self.provider.refreshObjects()
         self.tree.update()
+        self._updateFunnel()
         self._updateLabel()
 
     def _openHTML(self, e=None):